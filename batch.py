@@ -0,0 +1,216 @@
+from __future__ import print_function
+import os
+import sys
+import glob
+import json
+import time
+from cStringIO import StringIO
+
+from attrdict import AttrDict
+
+import kmlutil
+import profiling
+import compression
+
+# options that hold open files or per-run destinations and can't be shared by the files of a batch
+per_run_options = ['out_kml', 'out_diag', 'out_stats', 'out_list', 'out_nsmap', 'progress_json', 'profile_dump']
+# options a batch ignores, their output would be mixed up or lost, a note names the ones given
+batch_ignored_options = ['progress_json', 'profile', 'profile_dump']
+
+
+class BatchError(kmlutil.KMLError):
+    pass
+
+
+def read_manifest(manifest_path):
+    """
+    read input/output pairs, one per line separated by a tab, the output may be omitted, blank lines and lines
+    beginning with # are ignored
+    :return: list of (input, output) tuples, output is None when omitted
+    """
+    pairs = []
+    base_dir = os.path.dirname(manifest_path)
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            parts = [part.strip() for part in line.split('\t', 1)]
+            input_path = os.path.join(base_dir, parts[0])
+            output_path = os.path.join(base_dir, parts[1]) if len(parts) > 1 and parts[1] else None
+            pairs.append((input_path, output_path))
+    return pairs
+
+
+# output format: extension of the output files
+output_extensions = {'kml': '.kml', 'geojson': '.geojson', 'geojson-seq': '.geojson', 'gpkg': '.gpkg'}
+# extensions of the files taken from a directory, plain and compressed kml
+input_extensions = ['.kml'] + sorted('.kml' + extension for extension in compression.extensions)
+
+
+def output_name(input_path, output_dir, extension='.kml'):
+    base = os.path.basename(compression.strip_extension(input_path))
+    stem = base[:-4] if base.lower().endswith('.kml') else base
+    return os.path.join(output_dir, stem + extension)
+
+
+def is_manifest(path):
+    """
+    True if the file at path is a manifest rather than a document, documents are compressed or begin with '<', or
+    '{', '[' or a record separator for GeoJSON, after an optional byte order mark
+    """
+    with open(path, 'rb') as in_file:
+        head = in_file.read(256)
+    if compression.detect(head) is not None:
+        return False
+    return head.lstrip('\xef\xbb\xbf').lstrip()[:1] not in ('<', '{', '[', '\x1e')
+
+
+def find_inputs(spec, output_dir=None, extension='.kml'):
+    """
+    expand a batch specification into (input, output) pairs, spec may be a directory (all *.kml files in it,
+    compressed ones included), a manifest file (see read_manifest and is_manifest) or a glob pattern, outputs are
+    placed in output_dir unless the manifest names them
+    """
+    if os.path.isdir(spec):
+        inputs = sorted(path for extension in input_extensions for path in glob.glob(os.path.join(spec, '*' + extension)))
+        pairs = [(path, None) for path in inputs]
+    elif os.path.isfile(spec) and is_manifest(spec):
+        pairs = read_manifest(spec)
+    else:
+        pairs = [(path, None) for path in sorted(glob.glob(spec))]
+
+    if output_dir is not None:
+        pairs = [(input_path, output_path if output_path else output_name(input_path, output_dir, extension))
+                 for input_path, output_path in pairs]
+    return pairs
+
+
+def shareable_options(options):
+    """
+    plain dict copy of the options that can be pickled and sent to worker processes
+    """
+    shared = {}
+    for name, value in dict(options).items():
+        if name in per_run_options:
+            continue
+        if hasattr(value, 'read') and hasattr(value, 'name'):
+            value = value.name
+        shared[name] = list(value) if isinstance(value, tuple) else value
+    if 'profile' in shared:
+        shared['profile'] = False
+    return shared
+
+
+def result_counts(processor):
+    """
+    (placemarks, folders, points) of the document a processor produced, taken from the --stats counts when it
+    recorded them and otherwise counted with the tag filtered iterators of the tree, the points of a coordinates
+    element are taken from the feature table when it has them as the text may have been dropped
+    """
+    if processor.stats is not None:
+        element_counts, point_counts = processor.stats
+        return element_counts.get('Placemark', 0), element_counts.get('Folder', 0), point_counts.get('Document', 0)
+    doc = processor.kml_doc
+    table = processor.table
+    points = 0
+    for coords in doc.iter('{*}coordinates'):
+        part = table.part(coords) if table is not None else None
+        points += table.part_counts[part] if part is not None else len((coords.text or '').split())
+    return sum(1 for _ in doc.iter('{*}Placemark')), sum(1 for _ in doc.iter('{*}Folder')), points
+
+
+def process_one(job):
+    """
+    process one file of a batch, runs in a worker process so it must not raise
+    :param job: tuple of (input path, output path or None, shareable options)
+    :return: summary dict
+    """
+    input_path, output_path, shared = job
+    options = AttrDict(shared)
+    options.kmlfile = input_path
+    options.out_diag = StringIO()
+    options.out_stats = StringIO()
+    options.out_list = StringIO()
+    options.out_nsmap = options.out_list
+
+    summary = {'type': 'file', 'input': input_path, 'output': output_path, 'status': 'error'}
+    wall = time.time()
+    cpu = profiling.cpu_seconds()
+    try:
+        if output_path is not None and os.path.abspath(output_path) == os.path.abspath(input_path):
+            raise BatchError("output would overwrite input")
+        if output_path is not None:
+            out_dir = os.path.dirname(output_path)
+            if out_dir and not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+        level = options.compress_level if 'compress_level' in options else None
+        options.out_kml = compression.open_output(output_path, level=level) if output_path is not None else None
+        try:
+            processor = kmlutil.KMLProcessor(options)
+            processor.run()
+        finally:
+            if options.out_kml is not None:
+                options.out_kml.close()
+        summary['status'] = 'ok'
+        if processor.stats is not None or processor.kml_doc is not None:
+            summary['placemarks'], summary['folders'], summary['points'] = result_counts(processor)
+    except BatchError, e:
+        summary['message'] = e.message
+    except (Exception, SystemExit), e:
+        diag = options.out_diag.getvalue().strip().splitlines()
+        summary['message'] = diag[-1] if len(diag) else '%s: %s' % (type(e).__name__, e)
+
+    summary['wall'] = round(time.time() - wall, 4)
+    summary['cpu'] = round(profiling.cpu_seconds() - cpu, 4)
+    summary['input_bytes'] = os.path.getsize(input_path) if os.path.isfile(input_path) else None
+    if output_path is not None and os.path.isfile(output_path):
+        summary['output_bytes'] = os.path.getsize(output_path)
+    for name, stream in [('stats', options.out_stats), ('list', options.out_list)]:
+        if stream.getvalue():
+            summary[name] = stream.getvalue()
+    return summary
+
+
+def run_batch(spec, options, jobs=1, output_dir=None, summary_file=sys.stdout, diag_file=sys.stderr):
+    """
+    process every file matched by spec with the same options, spread over jobs worker processes so interpreter
+    startup and imports are paid once per worker rather than once per file, a summary line is written for each file
+    as it completes followed by a total line
+    :return: number of files that failed
+    """
+    ignored = ['--' + name.replace('_', '-') for name in batch_ignored_options if name in options and options[name]]
+    if ignored:
+        print("Note: %s can't be used with --batch and %s ignored" % (', '.join(ignored), 'is' if len(ignored) == 1 else 'are'),
+              file=diag_file)
+
+    no_output = options.no_kml_out
+    pairs = find_inputs(spec, output_dir=None if no_output else output_dir, extension=output_extensions[kmlutil.output_format(options)])
+    if not no_output and any(output_path is None for _, output_path in pairs):
+        raise BatchError("batch output requires --batch-output-dir, a manifest that names each output or --no-kml")
+
+    shared = shareable_options(options)
+    work = [(input_path, None if no_output else output_path, shared) for input_path, output_path in pairs]
+
+    started = time.time()
+    failed = 0
+    if jobs > 1 and len(work) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=jobs)
+        try:
+            results = pool.imap_unordered(process_one, work, chunksize=max(1, min(16, len(work) // (jobs * 4))))
+            for summary in results:
+                failed += summary['status'] != 'ok'
+                print(json.dumps(summary, sort_keys=True), file=summary_file)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in work:
+            summary = process_one(job)
+            failed += summary['status'] != 'ok'
+            print(json.dumps(summary, sort_keys=True), file=summary_file)
+
+    print(json.dumps({'type': 'total', 'files': len(work), 'failed': failed, 'jobs': jobs,
+                      'wall': round(time.time() - started, 4)}, sort_keys=True), file=summary_file)
+    return failed
@@ -0,0 +1,147 @@
+"""
+transparent gzip, bz2 and xz compression of input and output files
+
+compressed input is recognized by its first bytes whatever the file is called and decompressed as it is read, so
+neither the compressed nor the decompressed document is held in memory and no zcat process is needed, output is
+compressed when the name of the output file ends with .gz, .bz2 or .xz
+
+xz needs the lzma module, on Python 2 that is the backports.lzma package
+"""
+import os
+import importlib
+
+import util
+
+zlib = util.LazyModule('zlib')
+bz2 = util.LazyModule('bz2')
+gzip = util.LazyModule('gzip')
+
+magic = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz')]
+magic_length = max(len(prefix) for prefix, _ in magic)
+extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+default_levels = {'gzip': 6, 'bz2': 9, 'xz': 6}
+
+
+def lzma():
+    """
+    the lzma module, raises IOError if it isn't installed
+    """
+    for name in ['lzma', 'backports.lzma']:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+    raise IOError("xz compression needs the lzma module, install backports.lzma")
+
+
+def detect(head):
+    """
+    'gzip', 'bz2' or 'xz' for the first bytes of compressed data, None for anything else
+    """
+    for prefix, kind in magic:
+        if head.startswith(prefix):
+            return kind
+    return None
+
+
+def by_extension(path):
+    """
+    'gzip', 'bz2' or 'xz' if the extension of path names a compressed file, None otherwise
+    """
+    if not isinstance(path, basestring):
+        return None
+    return extensions.get(os.path.splitext(path)[1].lower())
+
+
+def strip_extension(path):
+    """
+    path without the extension of the compression, 'tracks.kml.gz' is 'tracks.kml'
+    """
+    return os.path.splitext(path)[0] if by_extension(path) else path
+
+
+class DecompressedFile(object):
+    """
+    read-only file object that decompresses a compressed stream as it is read, concatenated streams, like the
+    members of a gzip file that was appended to, are read one after the other
+    """
+
+    def __init__(self, raw_file, kind, name=None, chunk_size=64 * 1024):
+        self.raw_file = raw_file
+        self.kind = kind
+        self.name = name if name is not None else getattr(raw_file, 'name', '<stream>')
+        self.chunk_size = chunk_size
+        self.decompressor = None
+        self.buffer = ''
+        self.eof = False
+
+    def _new_decompressor(self):
+        if self.kind == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.kind == 'bz2':
+            return bz2.BZ2Decompressor()
+        return lzma().LZMADecompressor()
+
+    def _decompress(self, data):
+        chunks = []
+        while data:
+            if self.decompressor is None:
+                self.decompressor = self._new_decompressor()
+            try:
+                chunks.append(self.decompressor.decompress(data))
+            except EOFError:
+                # the stream ended exactly at the end of the last read, the data starts the next one
+                self.decompressor = None
+                continue
+            except Exception, e:
+                raise IOError("%s: the %s compressed data is not valid, %s" % (self.name, self.kind, e))
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = None
+        return ''.join(chunks)
+
+    def _fill(self, size):
+        """
+        decompress until the buffer holds size bytes or the input ends, all of it for a negative size
+        """
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while not self.eof and (size < 0 or length < size):
+            data = self.raw_file.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                if self.kind == 'gzip' and self.decompressor is not None:
+                    chunks.append(self.decompressor.flush())
+                break
+            chunk = self._decompress(data)
+            chunks.append(chunk)
+            length += len(chunk)
+        self.buffer = ''.join(chunks)
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.raw_file.close()
+
+
+def open_output(path, level=None):
+    """
+    open path for writing, compressed if its extension is .gz, .bz2 or .xz
+    :param level: compression level 1 (fastest) to 9 (smallest), by default 6 for gzip and xz and 9 for bz2
+    """
+    kind = by_extension(path)
+    if kind is None:
+        return open(path, 'w')
+    level = default_levels[kind] if level is None else level
+    if kind == 'gzip':
+        return gzip.GzipFile(path, 'wb', compresslevel=level)
+    if kind == 'bz2':
+        return bz2.BZ2File(path, 'w', compresslevel=level)
+    return lzma().LZMAFile(path, 'w', preset=level)
@@ -0,0 +1,280 @@
+"""
+out-of-core storage for the placemarks of kml documents too big to hold in memory as a tree
+
+the document is parsed with iterparse(), each placemark is serialized into a temporary SQLite database as soon as it
+has been parsed and removed from the tree, what remains is a skeleton of the containers (kml, Document and Folder),
+their names, the styles and everything else that is not a placemark, the skeleton is small enough to be processed
+with the usual tree operations
+
+the placemarks are stored with their name, styleUrl, envelope (in an R*Tree) and position among the skeleton
+children of their container, operations like folderize move placemarks by updating their container and the kml is
+written again in the original order by merging the skeleton with the placemarks of each container
+"""
+import os
+import re
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+import util
+
+sqlite3 = util.LazyModule('sqlite3')
+lxml_etree = util.LazyModule('lxml.etree')
+objectify = util.LazyModule('lxml.objectify')
+
+container_tags = ('{*}kml', '{*}Document', '{*}Folder')
+style_url_tag = '{*}styleUrl'
+# position of the placemarks appended to a container, after all its children
+end_position = 1 << 62
+
+namespace_declaration = re.compile(r'\sxmlns(?::([\w.-]+))?="([^"]*)"')
+first_tag = re.compile(r'^<[^>]*>')
+style_url_text = re.compile(r'<(?:[\w.-]+:)?styleUrl>([^<]*)</(?:[\w.-]+:)?styleUrl>')
+style_id_attr = re.compile(r'\sid="(S\d+)"')
+
+
+def _envelope(el):
+    """
+    (min x, max x, min y, max y) of the coordinates in el, None if it has none or they aren't numbers, tuples without
+    a y value are left out
+    """
+    xs = []
+    ys = []
+    try:
+        for coords in el.iter('{*}coordinates'):
+            text = coords.text or ''
+            tuples = text.split()
+            if not tuples:
+                continue
+            flat = text.replace(',', ' ').split()
+            width = len(flat) // len(tuples)
+            if width >= 2 and width * len(tuples) == len(flat) and set(t.count(',') for t in tuples) == set([width - 1]):
+                xs.extend(map(float, flat[0::width]))
+                ys.extend(map(float, flat[1::width]))
+            else:
+                for t in tuples:
+                    values = t.split(',')
+                    if len(values) >= 2:
+                        xs.append(float(values[0]))
+                        ys.append(float(values[1]))
+    except ValueError:
+        return None
+    if not xs:
+        return None
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def strip_declarations(xml, nsmap):
+    """
+    remove the namespace declarations from the first tag of serialized xml that are already in scope in nsmap
+    """
+    tag = first_tag.match(xml)
+    if tag is None:
+        return xml
+
+    def keep(match):
+        return '' if nsmap.get(match.group(1)) == match.group(2) else match.group(0)
+
+    return namespace_declaration.sub(keep, tag.group(0)) + xml[tag.end():]
+
+
+class FeatureStore(object):
+    """
+    temporary SQLite database of the placemarks of one document, see the module description
+    """
+
+    def __init__(self, max_memory_mb=256, batch_size=1000):
+        self.batch_size = batch_size
+        handle, self.path = tempfile.mkstemp(prefix='kmlutil-', suffix='.sqlite')
+        os.close(handle)
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        # the database only lives for this run, nothing is gained by making it crash safe
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        # a quarter of the memory budget for the page cache, in KB when negative
+        self.db.execute('PRAGMA cache_size = %d' % -max(1024, max_memory_mb * 1024 // 4))
+        self.db.execute('CREATE TABLE features (seq INTEGER PRIMARY KEY, parent INTEGER, position INTEGER, ord INTEGER, '
+                        'name TEXT, style_url TEXT, has_polygon INTEGER, xml BLOB)')
+        self.db.execute('CREATE VIRTUAL TABLE envelopes USING rtree(id, minx, maxx, miny, maxy)')
+        self.count = 0
+        self.containers = {}        # skeleton container element: key
+        self.original_index = {}    # skeleton child of a container: its index among the children when loaded
+        self.style_urls = set()     # all the styleUrls in the stored placemarks
+        self.style_ids = set()      # ids like the ones optimize_styles() generates in the stored placemarks
+        self.fetched = {}           # placemark element returned by first_polygon(): seq
+        self.parser = lxml_etree.XMLParser(strip_cdata=False, huge_tree=True)
+
+    def load(self, kml_file):
+        """
+        parse kml_file, store its placemarks and return the skeleton as an objectified ElementTree
+        """
+        rows = []
+        envelopes = []
+        keys = {}  # container element: key, numbered in document order
+        context = lxml_etree.iterparse(kml_file, events=('start', 'end'), tag=container_tags + ('{*}Placemark',),
+                                       remove_blank_text=True, strip_cdata=False, huge_tree=True)
+        for event, el in context:
+            if event == 'start':
+                if not el.tag.endswith('}Placemark'):
+                    keys[el] = len(keys)
+                continue
+            parent = el.getparent()
+            if not el.tag.endswith('}Placemark') or parent not in keys:
+                continue
+
+            self.count += 1
+            xml = lxml_etree.tostring(el, with_tail=False)
+            name = next(el.iterchildren('{*}name'), None)
+            style_url = next(el.iterchildren(style_url_tag), None)
+            for url in el.iter(style_url_tag):
+                self.style_urls.add((url.text or '').strip())
+            self.style_ids.update(style_id_attr.findall(xml))
+            rows.append((self.count, keys[parent], parent.index(el), self.count,
+                         name.text if name is not None else None,
+                         (style_url.text or '').strip() if style_url is not None else None,
+                         1 if next(el.iter('{*}Polygon'), None) is not None else 0,
+                         sqlite3.Binary(xml)))
+            envelope = _envelope(el)
+            if envelope is not None:
+                envelopes.append((self.count,) + envelope)
+            parent.remove(el)
+            if len(rows) >= self.batch_size:
+                self._insert(rows, envelopes)
+                rows = []
+                envelopes = []
+        self._insert(rows, envelopes)
+        with self.db:
+            self.db.execute('CREATE INDEX features_parent ON features (parent, position, ord)')
+            self.db.execute('CREATE INDEX features_name ON features (name)')
+            self.db.execute('CREATE INDEX features_style_url ON features (style_url)')
+
+        # the tree operations expect an objectified document, the skeleton is small so it is parsed again
+        skeleton = objectify.fromstring(lxml_etree.tostring(context.root.getroottree()),
+                                        objectify.makeparser(strip_cdata=False, huge_tree=True))
+        for key, el in enumerate(skeleton.iter(*container_tags)):
+            self.containers[el] = key
+            for i, child in enumerate(el.iterchildren()):
+                self.original_index[child] = i
+        return skeleton.getroottree()
+
+    def _insert(self, rows, envelopes):
+        with self.db:
+            self.db.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT INTO envelopes VALUES (?, ?, ?, ?, ?)', envelopes)
+
+    def parse(self, xml):
+        """
+        a stored placemark as an element
+        """
+        return lxml_etree.fromstring(str(xml), self.parser)
+
+    def first_polygon(self, container):
+        """
+        the first stored placemark in container that has a Polygon, as an element, None if there is none
+        """
+        row = self.db.execute('SELECT seq, xml FROM features WHERE parent = ? AND has_polygon = 1 ORDER BY position, ord '
+                              'LIMIT 1', (self.containers[container],)).fetchone()
+        if row is None:
+            return None
+        el = self.parse(row[1])
+        self.fetched[el] = row[0]
+        return el
+
+    def features_in(self, bounds, exclude=()):
+        """
+        (seq, placemark element) of the stored placemarks with an envelope that intersects one of the bounds, a list
+        of (min x, max x, min y, max y), in document order
+        """
+        if not bounds:
+            return
+        query = ' UNION '.join(['SELECT id FROM envelopes WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?'] * len(bounds))
+        values = []
+        for min_x, max_x, min_y, max_y in bounds:
+            values.extend([min_x, max_x, min_y, max_y])
+        exclude = set(exclude)
+        for seq, xml in self.db.execute('SELECT seq, xml FROM features WHERE seq IN (%s) ORDER BY seq' % query, values):
+            if seq not in exclude:
+                yield seq, self.parse(xml)
+
+    def append_to(self, moves):
+        """
+        move placemarks to the end of containers, moves is a list of (seq, container element) in document order
+        """
+        offset = self.count + 1
+        with self.db:
+            self.db.executemany('UPDATE features SET parent = ?, position = ?, ord = ? WHERE seq = ?',
+                                [(self.containers[container], end_position, offset + seq, seq) for seq, container in moves])
+
+    def write(self, root, out_file, style_map=None, pretty_print=False):
+        """
+        write the skeleton with the stored placemarks back in their places
+        :param style_map: old styleUrl: new styleUrl, applied to the stored placemarks
+        """
+        changed = dict((old, new) for old, new in (style_map or {}).items() if old != new)
+
+        def placemark(xml, nsmap):
+            xml = str(xml)
+            if changed and any(url.strip() in changed for url in style_url_text.findall(xml)):
+                el = self.parse(xml)
+                for url in el.iter(style_url_tag):
+                    url.text = changed.get((url.text or '').strip(), url.text)
+                xml = lxml_etree.tostring(el, with_tail=False)
+            elif pretty_print:
+                xml = lxml_etree.tostring(self.parse(xml), pretty_print=True)
+            out_file.write(strip_declarations(xml, nsmap))
+
+        def emit(el, nsmap):
+            if el not in self.containers:
+                out_file.write(strip_declarations(lxml_etree.tostring(el, pretty_print=pretty_print), nsmap))
+                return
+            out_file.write(self._start_tag(el, nsmap))
+            if el.text:
+                out_file.write(escape(el.text).encode('ascii', 'xmlcharrefreplace'))
+            rows = self.db.execute('SELECT position, xml FROM features WHERE parent = ? ORDER BY position, ord',
+                                   (self.containers[el],))
+            row = next(rows, None)
+            for child in el.iterchildren():
+                index = self.original_index.get(child)
+                while row is not None and index is not None and row[0] <= index:
+                    placemark(row[1], el.nsmap)
+                    row = next(rows, None)
+                emit(child, el.nsmap)
+            while row is not None:
+                placemark(row[1], el.nsmap)
+                row = next(rows, None)
+            out_file.write('</%s>' % self._qname(el.tag, el.nsmap))
+            if el.tail:
+                out_file.write(escape(el.tail).encode('ascii', 'xmlcharrefreplace'))
+
+        # comments and processing instructions outside the root element
+        for sibling in reversed(list(root.itersiblings(preceding=True))):
+            out_file.write(lxml_etree.tostring(sibling, with_tail=False))
+        emit(root, {})
+        for sibling in root.itersiblings():
+            out_file.write(lxml_etree.tostring(sibling, with_tail=False))
+        out_file.write('\n')
+
+    @staticmethod
+    def _qname(tag, nsmap):
+        if not tag.startswith('{'):
+            return tag
+        uri, local = tag[1:].split('}', 1)
+        if nsmap.get(None) == uri:
+            return local
+        for prefix, prefix_uri in sorted(nsmap.items()):
+            if prefix_uri == uri:
+                return '%s:%s' % (prefix, local)
+        return local
+
+    def _start_tag(self, el, parent_nsmap):
+        parts = ['<' + self._qname(el.tag, el.nsmap)]
+        for prefix, uri in sorted(el.nsmap.items()):
+            if parent_nsmap.get(prefix) != uri:
+                parts.append(' xmlns%s=%s' % (':' + prefix if prefix else '', quoteattr(uri)))
+        for name, value in el.attrib.items():
+            parts.append(' %s=%s' % (self._qname(name, el.nsmap), quoteattr(value)))
+        return (''.join(parts) + '>').encode('ascii', 'xmlcharrefreplace')
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
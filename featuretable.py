@@ -0,0 +1,281 @@
+"""
+columnar copy of the placemark geometry of a parsed kml document
+
+the coordinates of all placemarks are parsed once into one contiguous buffer of doubles, 16 bytes per point for
+x,y and 24 for x,y,z instead of a Python tuple of floats per point, each coordinates element is a part with an offset,
+point count and width in parallel arrays and each placemark is a row with the range of its parts, an interned name
+and styleUrl and the index of its parent folder
+
+operations that only read or rewrite coordinates (lengths, point-in-polygon tests, simplification) work on the
+table, changed parts are written back to their coordinates elements with write_back()
+"""
+from array import array
+
+import util
+
+objectify = util.LazyModule('lxml.objectify')
+
+placemark_xpath = ur'//kml:Placemark'
+# bytes of coordinates text dropped by from_document(strip=True) between two util.release_memory() calls
+release_size = 4 * 1024 * 1024
+
+
+def _parse_part(text):
+    """
+    (flat list of floats, width, ragged) of a coordinates text, tuples with fewer values than the widest are padded
+    with NaN when ragged, raises ValueError for text parse_coords() would not accept
+    """
+    tuples = text.split()
+    if not tuples:
+        return [], 2, False
+    flat = text.replace(',', ' ').split()
+    width = len(flat) // len(tuples)
+    if width * len(tuples) == len(flat) and all(t.count(',') == width - 1 for t in tuples):
+        return map(float, flat), width, False
+    values = [t.split(',') for t in tuples]
+    width = max(map(len, values))
+    nan = float('nan')
+    padded = []
+    for value in values:
+        padded.extend(map(float, value))
+        padded.extend([nan] * (width - len(value)))
+    return padded, width, True
+
+
+def _clear_text(el):
+    # the text of objectify data elements is read only
+    if hasattr(el, '_setText'):
+        el._setText(None)
+    else:
+        el.text = None
+
+
+class FeatureTable(object):
+    """
+    the placemark coordinates, names, styleUrls and folders of a document in columns, see the module description
+
+    rows are looked up by placemark element with row(), placemarks added to the document after the table was built
+    have no row and callers fall back to the element
+    """
+
+    def __init__(self):
+        self.coords = array('d')        # all parts, each a run of count * width values
+        self.part_offsets = array('l')  # index of the first value of the part in coords
+        self.part_counts = array('l')   # number of points
+        self.part_widths = array('b')   # values per point, negative when shorter tuples are padded with NaN
+        self.part_elements = []         # the coordinates element of the part
+        self.first_parts = array('l')   # index of the first part of the row, one extra entry ends the last row
+        self.names = array('l')         # index into strings, -1 if the placemark has no name
+        self.style_urls = array('l')    # index into strings, -1 if the placemark has no styleUrl
+        self.folders = array('l')       # index into folder_elements, -1 for placemarks outside a Folder
+        self.strings = []
+        self.string_index = {}
+        self.folder_elements = []
+        self.folder_index = {}
+        self.rows = {}                  # placemark element: row
+        self.dirty = set()              # parts changed since the last write_back()
+        self.part_index = None          # id of the coordinates element: part, built by part()
+
+    @classmethod
+    def from_document(cls, doc, strip=False):
+        """
+        build the table of the kml Placemarks in doc
+        :param strip: drop the coordinates text of each placemark as soon as it is in the table, see strip(), the
+                      memory of the text is then reused for the table and the peak is about that of the tree
+        """
+        table = cls()
+        stripped = 0
+        for el in util.xp(doc, placemark_xpath):
+            stripped += table._add(el, strip)
+            if stripped >= release_size:
+                util.release_memory()
+                stripped = 0
+        table.first_parts.append(len(table.part_offsets))
+        if stripped:
+            util.release_memory()
+        return table
+
+    def _add(self, el, strip=False):
+        """
+        add the row of a placemark element and its parts, returns the length of the coordinates text dropped
+        """
+        try:
+            parts = [(coords,) + _parse_part(coords.text or '') for coords in el.iter('{*}coordinates')]
+        except ValueError:
+            # left to the element, where the error is reported as before
+            parts = None
+        self.add_row(el, len(self.part_offsets), parts is not None)
+        stripped = 0
+        for coords, values, width, ragged in parts or []:
+            self.part_offsets.append(len(self.coords))
+            self.part_counts.append(len(values) // width)
+            self.part_widths.append(-width if ragged else width)
+            self.part_elements.append(coords)
+            self.coords.extend(values)
+            if strip:
+                stripped += len(coords.text or '')
+                _clear_text(coords)
+        return stripped
+
+    def add_row(self, el, first_part, decoded):
+        """
+        add the row of a placemark element whose parts start at first_part
+        :param decoded: False if the coordinates of the placemark are left to the element
+        """
+        row = len(self.names)
+        self.first_parts.append(first_part)
+        name = next(el.iterchildren('{*}name'), None)
+        style_url = next(el.iterchildren('{*}styleUrl'), None)
+        self.names.append(self.intern(name.text) if name is not None else -1)
+        self.style_urls.append(self.intern((style_url.text or '').strip()) if style_url is not None else -1)
+        folder = next(el.iterancestors('{*}Folder'), None)
+        self.folders.append(self.folder(folder) if folder is not None else -1)
+        if decoded:
+            self.rows[el] = row
+
+    def intern(self, text):
+        if text not in self.string_index:
+            self.string_index[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_index[text]
+
+    def folder(self, el):
+        if el not in self.folder_index:
+            self.folder_index[el] = len(self.folder_elements)
+            self.folder_elements.append(el)
+        return self.folder_index[el]
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, el):
+        """
+        the row of a placemark element, None if it isn't in the table
+        """
+        return self.rows.get(el)
+
+    def part(self, coords):
+        """
+        the part of a coordinates element, None if it isn't in a row of the table
+        """
+        if self.part_index is None:
+            # objectify elements compare and hash by their text, the ids stay valid as part_elements holds the proxies
+            self.part_index = dict((id(self.part_elements[part]), part) for row in self.rows.values() for part in self.parts(row))
+        return self.part_index.get(id(coords))
+
+    def discard(self, el):
+        """
+        remove the row of a placemark element whose coordinates were changed without the table
+        """
+        self.rows.pop(el, None)
+        self.part_index = None
+
+    def name(self, row):
+        return self.strings[self.names[row]] if self.names[row] >= 0 else None
+
+    def style_url(self, row):
+        return self.strings[self.style_urls[row]] if self.style_urls[row] >= 0 else None
+
+    def folder_element(self, row):
+        return self.folder_elements[self.folders[row]] if self.folders[row] >= 0 else None
+
+    def parts(self, row):
+        return xrange(self.first_parts[row], self.first_parts[row + 1])
+
+    def point_count(self, row):
+        return sum(self.part_counts[part] for part in self.parts(row))
+
+    def part_points(self, part):
+        """
+        the points of a part as tuples, like parse_coords()
+        """
+        width = self.part_widths[part]
+        start = self.part_offsets[part]
+        values = self.coords[start:start + self.part_counts[part] * abs(width)]
+        points = zip(*[iter(values)] * abs(width))
+        if width < 0:
+            points = [tuple(v for v in point if v == v) for point in points]
+        return points
+
+    def points(self, row):
+        """
+        the points of all the parts of a row, like parse_coords() of their joined text
+        """
+        points = []
+        for part in self.parts(row):
+            points.extend(self.part_points(part))
+        return points
+
+    def envelope(self, row):
+        """
+        (min x, max x, min y, max y) of a row, None if it has no points
+        """
+        xs = []
+        ys = []
+        for part in self.parts(row):
+            width = abs(self.part_widths[part])
+            start = self.part_offsets[part]
+            end = start + self.part_counts[part] * width
+            xs.extend(self.coords[start:end:width])
+            ys.extend(self.coords[start + 1:end:width])
+        if not xs:
+            return None
+        return min(xs), max(xs), min(ys), max(ys)
+
+    def set_part_points(self, part, points):
+        """
+        replace the points of a part, in place when there are no more points than before
+        """
+        width = max(len(point) for point in points) if points else 2
+        ragged = any(len(point) != width for point in points)
+        values = []
+        for point in points:
+            values.extend(point)
+            values.extend([float('nan')] * (width - len(point)))
+        if len(values) <= self.part_counts[part] * abs(self.part_widths[part]):
+            start = self.part_offsets[part]
+            self.coords[start:start + len(values)] = array('d', values)
+        else:
+            self.part_offsets[part] = len(self.coords)
+            self.coords.extend(values)
+        self.part_counts[part] = len(points)
+        self.part_widths[part] = -width if ragged else width
+        self.dirty.add(part)
+
+    def simplify(self, row, error_limit, min_points=10):
+        """
+        simplify the parts of a row with more than min_points points, see simplify.simplify()
+        """
+        from simplify import simplify
+        for part in self.parts(row):
+            if self.part_counts[part] > min_points:
+                self.set_part_points(part, simplify(self.part_points(part), error_limit))
+
+    def move(self, row, folder):
+        """
+        record that the placemark of a row was moved to the folder element
+        """
+        self.folders[row] = self.folder(folder)
+
+    def strip(self):
+        """
+        drop the coordinates text of all parts from their elements, the table is then the only copy of the coordinates
+        and the document can't be written or have its coordinates read from the text until write_back() rewrote them
+        """
+        for coords in self.part_elements:
+            _clear_text(coords)
+        util.release_memory()
+
+    def write_back(self, format_coords, rows=None):
+        """
+        write the changed parts to their coordinates elements
+        :param format_coords: function of a list of points returning the coordinates text
+        :param rows: only write the parts of these rows
+        """
+        parts = self.dirty if rows is None else [part for row in rows for part in self.parts(row) if part in self.dirty]
+        for part in sorted(parts):
+            geometry = self.part_elements[part].getparent()
+            geometry.coordinates = objectify.StringElement(format_coords(self.part_points(part)))
+            self.part_elements[part] = geometry.coordinates
+        self.part_index = None
+        self.dirty.difference_update(parts)
@@ -0,0 +1,343 @@
+"""
+read GeoJSON and newline-delimited GeoJSON (GeoJSON-seq) as a kml document
+
+features are decoded one at a time from the input and fed to the xml parser as kml Placemarks so neither the JSON
+nor the kml text of the whole document is held in memory, only the resulting tree
+
+the simplestyle properties (stroke, fill, marker-color ...) of the features become shared Styles, one per distinct
+combination, 'name' and 'description' become elements, a 'folder' property like the one written by --geojson puts
+the placemark in nested Folders and the other properties are kept as ExtendedData
+"""
+import os
+import re
+import codecs
+from itertools import chain
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+import util
+
+json = util.LazyModule('json')
+objectify = util.LazyModule('lxml.objectify')
+
+geojson_extensions = frozenset(['.geojson', '.json', '.geojsonl', '.geojsons', '.geojsonseq', '.ndjson', '.jsonl'])
+geometry_types = frozenset(['Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon',
+                            'GeometryCollection'])
+style_properties = frozenset(['stroke', 'stroke-width', 'stroke-opacity', 'fill', 'fill-opacity', 'marker-color',
+                              'marker-size'])
+marker_scales = {'small': 0.8, 'medium': 1.0, 'large': 1.2}
+
+# whitespace and the record separator of RFC 8142 GeoJSON text sequences
+json_whitespace = re.compile(ur'[ \t\r\n\x1e]*')
+
+kml_header = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+kml_footer = '</Document>\n</kml>\n'
+
+
+def is_geojson(path, peek_length=64):
+    """
+    True if path names GeoJSON input, by its extension or for an existing file by its first character, path may also
+    be a file object with a name and peek(), see kmlinput
+    """
+    if hasattr(path, 'peek'):
+        if os.path.splitext(getattr(path, 'name', ''))[1].lower() in geojson_extensions:
+            return True
+        start = path.peek(peek_length)
+    else:
+        if not isinstance(path, basestring):
+            return False
+        if os.path.splitext(path)[1].lower() in geojson_extensions:
+            return True
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as in_file:
+            start = in_file.read(peek_length)
+    return start.lstrip(codecs.BOM_UTF8).lstrip(' \t\r\n')[:1] in ('{', '\x1e')
+
+
+class JSONStream(object):
+    """
+    read JSON values one at a time from a file, the buffer holds the value being decoded and at least one read
+    """
+
+    def __init__(self, in_file, chunk_size=65536):
+        self.in_file = in_file
+        self.chunk_size = chunk_size
+        self.decode = codecs.getincrementaldecoder('utf-8-sig')().decode
+        self.decoder = json.JSONDecoder()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        read more input, reads grow with the unconsumed part of the buffer so a value larger than a chunk is
+        decoded a bounded number of times
+        """
+        if self.eof:
+            return False
+        data = self.in_file.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + self.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """
+        next character after whitespace, '' at the end of the input
+        """
+        while True:
+            self.pos = json_whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("expected one of '%s' but found '%s' at character %d of the current read" % (chars, char, self.pos))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next read
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(in_file):
+    """
+    GeoJSON features of a FeatureCollection, a Feature, a bare geometry or a sequence of any of them, one per line
+    or separated by RS characters, the features of a FeatureCollection are decoded one at a time
+    """
+    stream = JSONStream(in_file)
+    while stream.peek():
+        stream.expect('{')
+        members = {}
+        streamed = False
+        if stream.peek() == '}':
+            stream.pos += 1
+        else:
+            while True:
+                key = stream.value()
+                stream.expect(':')
+                if key == 'features' and stream.peek() == '[':
+                    stream.pos += 1
+                    streamed = True
+                    if stream.peek() == ']':
+                        stream.pos += 1
+                    else:
+                        while True:
+                            yield stream.value()
+                            if stream.expect(',]') == ']':
+                                break
+                else:
+                    members[key] = stream.value()
+                if stream.expect(',}') == '}':
+                    break
+        if streamed:
+            continue
+        if members.get('type') == 'Feature':
+            yield members
+        elif members.get('type') in geometry_types:
+            yield {'type': 'Feature', 'properties': {}, 'geometry': members}
+        else:
+            raise ValueError("not a GeoJSON object, type '%s'" % members.get('type'))
+
+
+def kml_color(color, opacity=None):
+    """
+    convert a css style color (#rrggbb or #rgb) and opacity to a kml color (aabbggrr), None if it isn't valid
+    """
+    color = unicode(color).strip().lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    if len(color) != 6 or not re.match(ur'^[0-9a-fA-F]{6}$', color):
+        return None
+    alpha = 255 if opacity is None else max(0, min(255, int(round(float(opacity) * 255))))
+    return ('%02x' % alpha) + color[4:6].lower() + color[2:4].lower() + color[0:2].lower()
+
+
+def style_kml(style):
+    """
+    kml sub-styles for a tuple of (simplestyle property, value) pairs
+    """
+    props = dict(style)
+    parts = []
+    if 'stroke' in props or 'stroke-width' in props or 'stroke-opacity' in props:
+        color = kml_color(props.get('stroke', '#000000'), props.get('stroke-opacity'))
+        line = '<color>%s</color>' % color if color else ''
+        if 'stroke-width' in props:
+            line += '<width>%s</width>' % escape(unicode(props['stroke-width']))
+        parts.append('<LineStyle>%s</LineStyle>' % line)
+    if 'fill' in props or 'fill-opacity' in props:
+        color = kml_color(props.get('fill', '#555555'), props.get('fill-opacity'))
+        parts.append('<PolyStyle>%s</PolyStyle>' % ('<color>%s</color>' % color if color else ''))
+    if 'marker-color' in props or 'marker-size' in props:
+        icon = ''
+        color = kml_color(props['marker-color']) if 'marker-color' in props else None
+        if color:
+            icon += '<color>%s</color>' % color
+        if props.get('marker-size') in marker_scales:
+            icon += '<scale>%s</scale>' % marker_scales[props['marker-size']]
+        parts.append('<IconStyle>%s</IconStyle>' % icon)
+    return ''.join(parts)
+
+
+def coordinates_kml(positions):
+    """
+    kml coordinates of a list of positions, repr() keeps every digit of the values, when all positions have the same
+    number of values they are formatted by one % operation
+    """
+    widths = set(map(len, positions))
+    if len(widths) == 1:
+        text = ' '.join([','.join(['%r'] * widths.pop())] * len(positions)) % tuple(chain.from_iterable(positions))
+    else:
+        text = ' '.join(','.join(repr(v) for v in position) for position in positions)
+    return '<coordinates>%s</coordinates>' % text
+
+
+def geometry_kml(geometry):
+    """
+    kml of a GeoJSON geometry, Multi* geometries and GeometryCollections become MultiGeometry
+    """
+    if not geometry or 'type' not in geometry:
+        return ''
+    kind = geometry['type']
+    coords = geometry.get('coordinates')
+    if kind == 'Point':
+        return '<Point>%s</Point>' % coordinates_kml([coords]) if coords else ''
+    if kind == 'LineString':
+        return '<LineString>%s</LineString>' % coordinates_kml(coords) if coords else ''
+    if kind == 'Polygon':
+        if not coords:
+            return ''
+        rings = ['<outerBoundaryIs><LinearRing>%s</LinearRing></outerBoundaryIs>' % coordinates_kml(coords[0])]
+        rings.extend('<innerBoundaryIs><LinearRing>%s</LinearRing></innerBoundaryIs>' % coordinates_kml(ring)
+                     for ring in coords[1:])
+        return '<Polygon>%s</Polygon>' % ''.join(rings)
+    if kind.startswith('Multi') and kind[5:] in ('Point', 'LineString', 'Polygon'):
+        parts = [{'type': kind[5:], 'coordinates': part} for part in coords or []]
+    elif kind == 'GeometryCollection':
+        parts = geometry.get('geometries') or []
+    else:
+        return ''
+    return '<MultiGeometry>%s</MultiGeometry>' % ''.join(geometry_kml(part) for part in parts)
+
+
+def data_value(value):
+    return value if isinstance(value, basestring) else json.dumps(value)
+
+
+class KMLFeeder(object):
+    """
+    build a kml document from GeoJSON features, the kml is fed to the parser as it is produced
+    """
+
+    def __init__(self, parser, name=None, flush_length=65536):
+        self.parser = parser
+        self.flush_length = flush_length
+        self.parts = []
+        self.length = 0
+        self.folders = []   # names of the open folders
+        self.styles = OrderedDict()  # tuple of (simplestyle property, value) pairs: style id
+        self.count = 0
+        self._write(kml_header)
+        if name:
+            self._write('<name>%s</name>\n' % escape(name))
+
+    def _write(self, text):
+        self.parts.append(text.encode('utf-8') if isinstance(text, unicode) else text)
+        self.length += len(self.parts[-1])
+        if self.length >= self.flush_length:
+            self._flush()
+
+    def _flush(self):
+        self.parser.feed(''.join(self.parts))
+        self.parts = []
+        self.length = 0
+
+    def _open_folders(self, path):
+        names = path.split('/') if path else []
+        common = 0
+        while common < min(len(names), len(self.folders)) and names[common] == self.folders[common]:
+            common += 1
+        for _ in range(len(self.folders) - common):
+            self._write('</Folder>\n')
+        for name in names[common:]:
+            self._write('<Folder><name>%s</name>\n' % escape(name))
+        self.folders = names
+
+    def _style_id(self, properties):
+        style = tuple(sorted((key, value) for key, value in properties.iteritems()
+                             if key in style_properties and value is not None))
+        if not style:
+            return None
+        if style not in self.styles:
+            self.styles[style] = 'simplestyle-%d' % (len(self.styles) + 1)
+        return self.styles[style]
+
+    def add(self, feature):
+        properties = feature.get('properties') or {}
+        folder = properties.get('folder')
+        self._open_folders(folder if isinstance(folder, basestring) else None)
+
+        parts = ['<Placemark%s>' % (' id=%s' % quoteattr(unicode(feature['id'])) if feature.get('id') is not None else '')]
+        for tag in ['name', 'description']:
+            if properties.get(tag) is not None:
+                parts.append('<%s>%s</%s>' % (tag, escape(data_value(properties[tag])), tag))
+        style_id = self._style_id(properties)
+        if style_id:
+            parts.append('<styleUrl>#%s</styleUrl>' % style_id)
+        data = [(key, value) for key, value in sorted(properties.iteritems())
+                if key not in style_properties and key not in ('name', 'description', 'folder')]
+        if data:
+            parts.append('<ExtendedData>%s</ExtendedData>' % ''.join(
+                '<Data name=%s><value>%s</value></Data>' % (quoteattr(key), escape(data_value(value))) for key, value in data))
+        parts.append(geometry_kml(feature.get('geometry')))
+        parts.append('</Placemark>\n')
+        self._write(''.join(parts))
+        self.count += 1
+
+    def close(self):
+        """
+        finish the document and return its ElementTree, the shared styles are inserted before the first feature
+        """
+        self._open_folders(None)
+        self._write(kml_footer)
+        self._flush()
+        root = self.parser.close()
+
+        if self.styles:
+            styles = objectify.fromstring('<Document xmlns="http://www.opengis.net/kml/2.2">%s</Document>' % ''.join(
+                '<Style id="%s">%s</Style>' % (style_id, style_kml(style))
+                for style, style_id in self.styles.iteritems()))
+            document = root.Document
+            position = 1 if len(document.xpath('./*[local-name()="name"]')) else 0
+            for style in reversed(styles.getchildren()):
+                document.insert(position, style)
+        return root.getroottree()
+
+
+def parse(in_file, name=None):
+    """
+    parse GeoJSON or GeoJSON-seq from a file object or path into a kml ElementTree like pykml.parser.parse()
+    """
+    if isinstance(in_file, basestring):
+        with open(in_file, 'rb') as opened:
+            return parse(opened, name=name if name is not None else os.path.splitext(os.path.basename(in_file))[0])
+    feeder = KMLFeeder(objectify.makeparser(strip_cdata=False), name=name)
+    for feature in iter_features(in_file):
+        feeder.add(feature)
+    return feeder.close()
@@ -0,0 +1,227 @@
+"""
+write GeoJSON style features to a GeoPackage (http://www.geopackage.org) using only the sqlite3 module
+
+the features go into one table with a GeoPackage geometry blob (header, envelope and ISO WKB) in the 'geom' column,
+the name, description, folder and simplestyle properties in their own columns and an R*Tree spatial index so the
+table can be queried by bounding box, rows are inserted with executemany() in one transaction per batch
+"""
+import struct
+from itertools import chain
+
+import util
+
+sqlite3 = util.LazyModule('sqlite3')
+
+application_id = 0x47504B47  # 'GPKG'
+user_version = 10200         # GeoPackage 1.2
+wgs84_srs_id = 4326
+
+# (GeoJSON property, column, sql type)
+property_columns = [
+    ('name', 'name', 'TEXT'),
+    ('description', 'description', 'TEXT'),
+    ('folder', 'folder', 'TEXT'),
+    ('stroke', 'stroke', 'TEXT'),
+    ('stroke-width', 'stroke_width', 'REAL'),
+    ('stroke-opacity', 'stroke_opacity', 'REAL'),
+    ('fill', 'fill', 'TEXT'),
+    ('fill-opacity', 'fill_opacity', 'REAL'),
+    ('marker-color', 'marker_color', 'TEXT'),
+]
+
+wkb_types = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4, 'MultiLineString': 5, 'MultiPolygon': 6,
+             'GeometryCollection': 7}
+
+metadata_sql = [
+    """CREATE TABLE gpkg_spatial_ref_sys (
+        srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,
+        organization_coordsys_id INTEGER NOT NULL, definition  TEXT NOT NULL, description TEXT)""",
+    """INSERT INTO gpkg_spatial_ref_sys VALUES
+        ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+        ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+        ('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid')""",
+    """CREATE TABLE gpkg_contents (
+        table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '',
+        last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+        CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))""",
+    """CREATE TABLE gpkg_geometry_columns (
+        table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+        z TINYINT NOT NULL, m TINYINT NOT NULL,
+        CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+        CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+        CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))""",
+    """CREATE TABLE gpkg_extensions (
+        table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL, scope TEXT NOT NULL,
+        CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))""",
+]
+
+# the triggers of the GeoPackage R*Tree extension that keep the index up to date when the table is edited by other
+# programs, the ST_ functions are provided by those programs so the triggers are created after the table is filled
+rtree_triggers_sql = [
+    """CREATE TRIGGER rtree_{t}_{c}_insert AFTER INSERT ON {t} WHEN (new.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+        BEGIN INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c})); END""",
+    """CREATE TRIGGER rtree_{t}_{c}_update1 AFTER UPDATE OF {c} ON {t} WHEN OLD.{i} = NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+        BEGIN INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c})); END""",
+    """CREATE TRIGGER rtree_{t}_{c}_update2 AFTER UPDATE OF {c} ON {t} WHEN OLD.{i} = NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+        BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.{i}; END""",
+    """CREATE TRIGGER rtree_{t}_{c}_update3 AFTER UPDATE ON {t} WHEN OLD.{i} != NEW.{i} AND (NEW.{c} NOTNULL AND NOT ST_IsEmpty(NEW.{c}))
+        BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.{i};
+        INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c})); END""",
+    """CREATE TRIGGER rtree_{t}_{c}_update4 AFTER UPDATE ON {t} WHEN OLD.{i} != NEW.{i} AND (NEW.{c} ISNULL OR ST_IsEmpty(NEW.{c}))
+        BEGIN DELETE FROM rtree_{t}_{c} WHERE id IN (OLD.{i}, NEW.{i}); END""",
+    """CREATE TRIGGER rtree_{t}_{c}_delete AFTER DELETE ON {t} WHEN old.{c} NOT NULL
+        BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.{i}; END""",
+]
+
+
+def _dims(geometry):
+    """
+    3 if any position of the geometry has an altitude, 2 otherwise
+    """
+    if geometry['type'] == 'GeometryCollection':
+        return max([_dims(part) for part in geometry['geometries']] or [2])
+    coords = geometry['coordinates']
+    depth = {'Point': 0, 'LineString': 1, 'MultiPoint': 1, 'Polygon': 2, 'MultiLineString': 2, 'MultiPolygon': 3}[geometry['type']]
+    positions = [coords]
+    for _ in range(depth):
+        positions = list(chain.from_iterable(positions))
+    return 3 if any(len(position) > 2 for position in positions) else 2
+
+
+def _flat(positions, dims):
+    """
+    the values of a list of positions in one list, positions with missing or extra values are padded or cut to dims
+    """
+    if set(map(len, positions)) == set([dims]):
+        return list(chain.from_iterable(positions))
+    return list(chain.from_iterable((tuple(position) + (0.0,) * dims)[:dims] for position in positions))
+
+
+class _Envelope(object):
+    def __init__(self):
+        self.min_x = self.min_y = float('inf')
+        self.max_x = self.max_y = float('-inf')
+
+    def add(self, flat, dims):
+        if flat:
+            xs = flat[0::dims]
+            ys = flat[1::dims]
+            self.min_x = min(self.min_x, min(xs))
+            self.max_x = max(self.max_x, max(xs))
+            self.min_y = min(self.min_y, min(ys))
+            self.max_y = max(self.max_y, max(ys))
+
+    def extend(self, other):
+        self.min_x = min(self.min_x, other.min_x)
+        self.max_x = max(self.max_x, other.max_x)
+        self.min_y = min(self.min_y, other.min_y)
+        self.max_y = max(self.max_y, other.max_y)
+
+    def is_empty(self):
+        return self.min_x > self.max_x
+
+
+def wkb(geometry, dims, envelope):
+    """
+    little endian ISO WKB of a GeoJSON geometry, the envelope is extended by its positions
+    """
+    code = wkb_types[geometry['type']] + (1000 if dims == 3 else 0)
+    kind = geometry['type']
+    coords = geometry.get('coordinates')
+    if kind == 'Point':
+        flat = _flat([coords], dims)
+        envelope.add(flat, dims)
+        return struct.pack('<BI%dd' % dims, 1, code, *flat)
+    if kind == 'LineString':
+        flat = _flat(coords, dims)
+        envelope.add(flat, dims)
+        return struct.pack('<BII%dd' % len(flat), 1, code, len(coords), *flat)
+    if kind == 'Polygon':
+        parts = [struct.pack('<BII', 1, code, len(coords))]
+        for ring in coords:
+            flat = _flat(ring, dims)
+            envelope.add(flat, dims)
+            parts.append(struct.pack('<I%dd' % len(flat), len(ring), *flat))
+        return ''.join(parts)
+    if kind == 'GeometryCollection':
+        parts = geometry['geometries']
+    else:
+        parts = [{'type': kind[5:], 'coordinates': part} for part in coords]
+    return struct.pack('<BII', 1, code, len(parts)) + ''.join(wkb(part, dims, envelope) for part in parts)
+
+
+def gpkg_geometry(geometry, srs_id=wgs84_srs_id):
+    """
+    GeoPackage geometry blob of a GeoJSON geometry and its envelope
+    """
+    envelope = _Envelope()
+    body = wkb(geometry, _dims(geometry), envelope)
+    # flags: little endian, xy envelope
+    header = struct.pack('<2sBBi4d', 'GP', 0, 0x03, srs_id, envelope.min_x, envelope.max_x, envelope.min_y, envelope.max_y)
+    return header + body, envelope
+
+
+class GeoPackageWriter(object):
+    """
+    write GeoJSON features (see kmlutil.geojson_feature) to a new GeoPackage file
+    """
+
+    def __init__(self, path, table='placemarks', batch_size=10000):
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+        self.index_rows = []
+        self.count = 0
+        self.extent = _Envelope()
+
+        # an existing file is replaced, not added to
+        open(path, 'wb').close()
+        self.db = sqlite3.connect(path)
+        # the file is new and useless if the export fails, so it is written without syncing or a rollback journal on disk
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA journal_mode = MEMORY')
+        self.db.execute('PRAGMA application_id = %d' % application_id)
+        self.db.execute('PRAGMA user_version = %d' % user_version)
+        for sql in metadata_sql:
+            self.db.execute(sql)
+        self.db.execute('CREATE TABLE "%s" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom GEOMETRY, %s)' % (
+            table, ', '.join('"%s" %s' % (column, sql_type) for _, column, sql_type in property_columns)))
+        self.db.execute('CREATE VIRTUAL TABLE "rtree_%s_geom" USING rtree(id, minx, maxx, miny, maxy)' % table)
+        self.insert_sql = 'INSERT INTO "%s" (fid, geom, %s) VALUES (?, ?, %s)' % (
+            table, ', '.join('"%s"' % column for _, column, _ in property_columns), ', '.join('?' * len(property_columns)))
+        self.index_sql = 'INSERT INTO "rtree_%s_geom" VALUES (?, ?, ?, ?, ?)' % table
+
+    def write(self, feature):
+        if feature.get('geometry') is None:
+            return
+        self.count += 1
+        blob, envelope = gpkg_geometry(feature['geometry'])
+        properties = feature['properties']
+        self.rows.append([self.count, sqlite3.Binary(blob)] + [properties.get(name) for name, _, _ in property_columns])
+        if not envelope.is_empty():
+            self.index_rows.append((self.count, envelope.min_x, envelope.max_x, envelope.min_y, envelope.max_y))
+            self.extent.extend(envelope)
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        with self.db:
+            self.db.executemany(self.insert_sql, self.rows)
+            self.db.executemany(self.index_sql, self.index_rows)
+        self.rows = []
+        self.index_rows = []
+
+    def close(self):
+        self._flush()
+        bounds = [None] * 4 if self.extent.is_empty() else [self.extent.min_x, self.extent.min_y, self.extent.max_x, self.extent.max_y]
+        with self.db:
+            self.db.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [self.table, 'features', self.table] + bounds + [wgs84_srs_id])
+            self.db.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.table, 'geom', 'GEOMETRY', wgs84_srs_id, 2, 0))
+            self.db.execute('INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                            (self.table, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only'))
+            for sql in rtree_triggers_sql:
+                self.db.execute(sql.format(t=self.table, c='geom', i='fid'))
+        self.db.close()
@@ -0,0 +1,301 @@
+"""
+sidecar index of the Folders and Placemarks of a kml file for parsing only the features a run needs, see --index
+
+the index is built by a scanner that finds the tags in the bytes of the file without building a tree, it records for
+every Document, Folder and Placemark its byte offsets, its container, its names, the geometry type the list shows and
+the envelope of its coordinates, a document is then put together from the byte ranges of the features that were
+asked for, the containers they are in and everything else that is not a feature (styles, names ...) and parsed
+
+the index is kept next to the kml file as FILE.kmlidx, it is built again when the size or modification time of the
+file changes, the file is not read again to check its content because the point of the index is not to read all of it
+
+file layout: the magic line, one line of JSON header, then one JSON array per entry in document order
+"""
+import os
+import re
+
+import util
+
+json = util.LazyModule('json')
+
+magic = 'KMLUTIL-INDEX\n'
+version = 1
+extension = '.kmlidx'
+kml_namespace = 'http://www.opengis.net/kml/2.2'
+
+feature_tags = frozenset(['Document', 'Folder', 'Placemark'])
+# the geometry that gives a placemark its type in a listing, as a child or a child of a MultiGeometry child
+geometry_tags = frozenset(['LineString', 'Point', 'Polygon', 'LinearRing'])
+
+markup_tag = re.compile(r'<(/?)(?:([\w.-]+):)?([\w.-]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>')
+namespace_declaration = re.compile(r'\sxmlns(?::([\w.-]+))?\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+xml_declaration_encoding = re.compile(r'<\?xml[^>]*encoding\s*=\s*["\']([\w.-]+)["\']')
+entity = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+cdata_section = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.S)
+xml_whitespace = re.compile(ur'[ \t\r\n]+')
+end_tags = dict((local, re.compile(r'</(?:[\w.-]+:)?%s\s*>' % local)) for local in ['name', 'coordinates'])
+named_entities = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'apos': u"'"}
+
+# positions in an entry
+TAG, START, HEAD_END, CLOSE_START, END, PARENT, NAMES, NAME_RANGE, TYPE, ENVELOPE = range(10)
+
+
+def index_path(kml_file):
+    return kml_file + extension
+
+
+def normalize_name(text):
+    """
+    a name as the normalize-space() of the kml name xpaths sees it
+    """
+    return xml_whitespace.sub(u' ', text).strip(u' ')
+
+
+def _unescape(match):
+    name = match.group(1)
+    if name.startswith('#x'):
+        return unichr(int(name[2:], 16))
+    if name.startswith('#'):
+        return unichr(int(name[1:]))
+    return named_entities[name]
+
+
+def element_text(raw):
+    """
+    the text of the serialized content of an element without child elements, entities replaced and CDATA unwrapped
+    """
+    parts = []
+    pos = 0
+    for match in cdata_section.finditer(raw):
+        parts.append(entity.sub(_unescape, raw[pos:match.start()].decode('utf-8')))
+        parts.append(match.group(1).decode('utf-8'))
+        pos = match.end()
+    parts.append(entity.sub(_unescape, raw[pos:].decode('utf-8')))
+    return u''.join(parts)
+
+
+def _extend_envelope(envelope, text):
+    """
+    extend [min x, max x, min y, max y] with the points of a coordinates text, returns the envelope, tuples without a
+    y value are left out, raises ValueError for values that aren't numbers
+    """
+    tuples = text.split()
+    if not tuples:
+        return envelope
+    flat = text.replace(',', ' ').split()
+    width = len(flat) // len(tuples)
+    if width >= 2 and width * len(tuples) == len(flat) and all(t.count(',') == width - 1 for t in tuples):
+        xs = map(float, flat[0::width])
+        ys = map(float, flat[1::width])
+    else:
+        values = [value for value in (t.split(',') for t in tuples) if len(value) >= 2]
+        xs = [float(value[0]) for value in values]
+        ys = [float(value[1]) for value in values]
+        if not xs:
+            return envelope
+    if envelope is None:
+        return [min(xs), max(xs), min(ys), max(ys)]
+    return [min(envelope[0], min(xs)), max(envelope[1], max(xs)), min(envelope[2], min(ys)), max(envelope[3], max(ys))]
+
+
+def scan(buf):
+    """
+    the entries of the Document, Folder and Placemark elements in the bytes of a kml document, in document order,
+    raises ValueError for documents the scanner can't read
+    """
+    declaration = xml_declaration_encoding.match(buf[:200])
+    if declaration is not None and declaration.group(1).lower().replace('_', '-') not in ('utf-8', 'utf8', 'us-ascii', 'ascii'):
+        raise ValueError('only UTF-8 documents can be indexed, the document is %s' % declaration.group(1))
+
+    entries = []
+    stack = []          # (local name, entry position or None, nsmap) of the open elements
+    features = []       # positions of the open Document, Folder and Placemark entries
+    nsmap = {}
+    pos = 0
+    size = len(buf)
+    while True:
+        lt = buf.find('<', pos)
+        if lt < 0:
+            break
+        head = buf[lt:lt + 9]
+        if head.startswith('<!--'):
+            pos = buf.find('-->', lt + 4)
+            if pos < 0:
+                raise ValueError('unterminated comment at byte %d' % lt)
+            pos += 3
+            continue
+        if head == '<![CDATA[':
+            pos = buf.find(']]>', lt + 9)
+            if pos < 0:
+                raise ValueError('unterminated CDATA section at byte %d' % lt)
+            pos += 3
+            continue
+        if head.startswith(('<?', '<!')):
+            pos = buf.find('>', lt) + 1 or size
+            continue
+
+        match = markup_tag.match(buf, lt)
+        if match is None:
+            raise ValueError('unreadable markup at byte %d' % lt)
+        pos = match.end()
+        closing, prefix, local, attrs, empty = match.groups()
+
+        if closing:
+            if not stack or stack[-1][0] != local:
+                raise ValueError("unexpected end tag '%s' at byte %d" % (local, lt))
+            _, position, nsmap = stack.pop()
+            if position is not None:
+                entries[position][CLOSE_START] = lt
+                entries[position][END] = pos
+                features.pop()
+            continue
+
+        element_nsmap = nsmap
+        if 'xmlns' in attrs:
+            element_nsmap = dict(nsmap)
+            for declared in namespace_declaration.finditer(attrs):
+                element_nsmap[declared.group(1)] = declared.group(2) if declared.group(2) is not None else declared.group(3)
+        is_kml = element_nsmap.get(prefix) == kml_namespace
+        parent = features[-1] if features else None
+        feature = entries[parent] if features else None
+
+        if is_kml and local in feature_tags:
+            entries.append([local, lt, pos, pos, pos, parent, [], None, None, None])
+            if not empty:
+                stack.append((local, len(entries) - 1, nsmap))
+                features.append(len(entries) - 1)
+                nsmap = element_nsmap
+            continue
+
+        if is_kml and not empty and local in end_tags and feature is not None:
+            end_tag = end_tags[local].search(buf, pos)
+            if end_tag is None:
+                raise ValueError("unterminated '%s' at byte %d" % (local, lt))
+            if local == 'name' and stack[-1][1] == parent:
+                feature[NAMES].append(normalize_name(element_text(buf[pos:end_tag.start()])))
+                if feature[NAME_RANGE] is None:
+                    feature[NAME_RANGE] = [lt, end_tag.end()]
+            elif local == 'coordinates' and feature[TAG] == 'Placemark':
+                feature[ENVELOPE] = _extend_envelope(feature[ENVELOPE], buf[pos:end_tag.start()])
+            pos = end_tag.end()
+            continue
+
+        if is_kml and local in geometry_tags and feature is not None and feature[TAG] == 'Placemark' and feature[TYPE] is None:
+            if stack[-1][1] == parent or (stack[-1][0] == 'MultiGeometry' and stack[-2][1] == parent):
+                feature[TYPE] = local
+        if not empty:
+            stack.append((local, None, nsmap))
+            nsmap = element_nsmap
+
+    if stack:
+        raise ValueError("the element '%s' is not closed" % stack[-1][0])
+    return entries
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class KMLIndex(object):
+    """
+    the entries of the features of one kml file, see the module description
+    """
+
+    def __init__(self, entries, source):
+        self.entries = entries
+        self.source = source
+
+    @classmethod
+    def build(cls, buf, source_path):
+        """
+        index the bytes buf of the kml file at source_path
+        """
+        return cls(scan(buf), source_signature(source_path))
+
+    @classmethod
+    def load(cls, path, source_path):
+        """
+        (the index saved at path, None) if it was made from source_path as it is now, otherwise (None, the reason)
+        """
+        if not os.path.isfile(path):
+            return None, 'there is no index file'
+        with open(path, 'rb') as in_file:
+            if in_file.read(len(magic)) != magic:
+                return None, 'the file is not an index'
+            header = json.loads(in_file.readline())
+            if header['version'] != version:
+                return None, 'the index was written by another version'
+            source = source_signature(source_path)
+            if header['source']['size'] != source['size'] or header['source']['mtime'] != source['mtime']:
+                return None, 'the input changed'
+            entries = [json.loads(line) for line in in_file]
+        return cls(entries, source), None
+
+    def save(self, path):
+        with open(path, 'wb') as out_file:
+            out_file.write(magic)
+            out_file.write(json.dumps({'version': version, 'source': self.source, 'count': len(self.entries)}) + '\n')
+            for entry in self.entries:
+                out_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def nested_documents(self):
+        return any(entry[TAG] == 'Document' and entry[PARENT] is not None for entry in self.entries)
+
+    def select(self, names):
+        """
+        positions of the Folders and Placemarks with one of the names, matched like DocumentIndex.find()
+        """
+        names = set(normalize_name(name.decode('utf-8') if isinstance(name, str) else name) for name in names)
+        return set(i for i, entry in enumerate(self.entries)
+                   if entry[TAG] != 'Document' and any(name in names for name in entry[NAMES]))
+
+    def document(self, buf, selected=None):
+        """
+        the bytes of a document made of the features at the selected positions with everything in them, the
+        containers they are in and everything that isn't a feature, with selected None the document has all the
+        containers and each Placemark with only its first name and an empty geometry of its type
+        """
+        keep = set()
+        if selected is not None:
+            for i in selected:
+                while i is not None and i not in keep:
+                    keep.add(i)
+                    i = self.entries[i][PARENT]
+        children = {}
+        for i, entry in enumerate(self.entries):
+            children.setdefault(entry[PARENT], []).append(i)
+
+        parts = []
+
+        def stub(entry):
+            parts.append(buf[entry[START]:entry[HEAD_END]])
+            if entry[NAME_RANGE] is not None:
+                parts.append(buf[entry[NAME_RANGE][0]:entry[NAME_RANGE][1]])
+            if entry[TYPE] is not None:
+                prefix = markup_tag.match(buf, entry[START]).group(2)
+                parts.append('<%s%s/>' % (prefix + ':' if prefix else '', entry[TYPE]))
+            parts.append(buf[entry[CLOSE_START]:entry[END]])
+
+        def emit(start, end, parent):
+            # the bytes from start to end with the features that are children of parent kept, stubbed or left out
+            for i in children.get(parent, []):
+                entry = self.entries[i]
+                parts.append(buf[start:entry[START]])
+                start = entry[END]
+                if entry[TAG] != 'Placemark' and (selected is None or entry[TAG] == 'Document' or
+                                                  (i in keep and i not in selected)):
+                    parts.append(buf[entry[START]:entry[HEAD_END]])
+                    emit(entry[HEAD_END], entry[CLOSE_START], i)
+                    parts.append(buf[entry[CLOSE_START]:entry[END]])
+                elif selected is None:
+                    stub(entry)
+                elif i in selected:
+                    parts.append(buf[entry[START]:entry[END]])
+            parts.append(buf[start:end])
+
+        emit(0, len(buf), None)
+        return ''.join(parts)
@@ -0,0 +1,137 @@
+"""
+open the input document once for everything that reads it
+
+a local file is memory mapped, the namespace sniff looks at the start of the mapping and the parser reads from it
+through a file-like object, so the file is neither opened nor read twice, stdin and other streams that can't seek are
+wrapped so the start of the stream stays available to peek() after the parser has read past it
+
+gzip, bz2 and xz compressed input is recognized by its first bytes and decompressed as it is read, see compression
+"""
+import os
+import sys
+import mmap
+
+import compression
+
+# bytes of a stream kept for peek()
+peek_limit = 64 * 1024
+
+
+class MappedFile(object):
+    """
+    read-only file object for a memory mapped local file with peek()
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self.raw_file = open(path, 'rb')
+        size = os.fstat(self.raw_file.fileno()).st_size
+        # an empty file can't be mapped
+        self.buffer = mmap.mmap(self.raw_file.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        self.position = 0
+
+    def peek(self, size):
+        """
+        the first size bytes of the file, wherever the file is positioned
+        """
+        return self.buffer[:size]
+
+    def read(self, size=-1):
+        end = len(self.buffer) if size is None or size < 0 else min(self.position + size, len(self.buffer))
+        data = self.buffer[self.position:end]
+        self.position = max(self.position, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.buffer)
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        return self.raw_file.fileno()
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.raw_file.close()
+
+
+class PeekStream(object):
+    """
+    file object for a stream that can't seek, the first limit bytes are kept so peek() works before and after the
+    stream has been read
+    """
+
+    def __init__(self, stream, name='<stdin>', limit=peek_limit):
+        self.name = name
+        self.stream = stream
+        self.limit = limit
+        self.head = None
+        self.position = 0
+
+    def _fill(self):
+        if self.head is None:
+            chunks = []
+            length = 0
+            while length < self.limit:
+                chunk = self.stream.read(self.limit - length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length += len(chunk)
+            self.head = ''.join(chunks)
+
+    def peek(self, size):
+        """
+        the first size bytes of the stream, at most limit
+        """
+        self._fill()
+        return self.head[:size]
+
+    def read(self, size=-1):
+        self._fill()
+        whole = size is None or size < 0
+        if self.position < len(self.head):
+            # a short read of the rest of the head, the stream is read once it is used up
+            end = len(self.head) if whole else min(self.position + size, len(self.head))
+            data = self.head[self.position:end]
+            if whole:
+                data += self.stream.read()
+        else:
+            data = self.stream.read() if whole else self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.stream is not sys.stdin:
+            self.stream.close()
+
+
+def is_local(kml_file):
+    return isinstance(kml_file, basestring) and (kml_file == '-' or os.path.isfile(kml_file))
+
+
+def open_input(kml_file):
+    """
+    a file object with peek() for a local file path, '-' for stdin or an open file, the content is decompressed if
+    it is compressed and the name of the file object is the name without the extension of the compression
+    """
+    if kml_file == '-':
+        in_file = PeekStream(sys.stdin)
+    elif isinstance(kml_file, basestring):
+        in_file = MappedFile(kml_file)
+    else:
+        in_file = PeekStream(kml_file, name=getattr(kml_file, 'name', '<stream>'))
+    kind = compression.detect(in_file.peek(compression.magic_length))
+    if kind is None:
+        return in_file
+    name = compression.strip_extension(in_file.name)
+    return PeekStream(compression.DecompressedFile(in_file, kind, name=name), name=name)
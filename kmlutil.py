@@ -4,15 +4,31 @@ from __future__ import print_function
 import os
 import re
 import sys
+import string
 import operator
+from cStringIO import StringIO
+from contextlib import contextmanager
 from math import radians, cos, sin, asin, sqrt
-from copy import deepcopy
 
-from pykml import parser as kmlparser
-from lxml import objectify, etree as lxml_etree
-
-from simplify import simplify
-from ordered_set import OrderedSet as oSet
+import util
+import profiling
+import progress
+
+# loaded on first use to keep startup fast, simplify, ordered_set and copy are imported by the functions using them
+kmlparser = util.LazyModule('pykml.parser')
+objectify = util.LazyModule('lxml.objectify')
+lxml_etree = util.LazyModule('lxml.etree')
+json = util.LazyModule('json')
+geojsonreader = util.LazyModule('geojsonreader')
+gpkgwriter = util.LazyModule('gpkgwriter')
+featurestore = util.LazyModule('featurestore')
+featuretable = util.LazyModule('featuretable')
+snapshot = util.LazyModule('snapshot')
+kmlinput = util.LazyModule('kmlinput')
+kmlindex = util.LazyModule('kmlindex')
+parallelparse = util.LazyModule('parallelparse')
+pipeline = util.LazyModule('pipeline')
+compression = util.LazyModule('compression')
 
 placemark_name_and_type_xpath = \
     ur'.//kml:Placemark[kml:{type} and kml:name[text()={name}]]'
@@ -45,9 +61,7 @@ all_root_features = \
 child_features = \
     ur'*[local-name()="Folder" or local-name()="Placemark"]'
 
-import util
 from util import encode_xpath_string_literal as encode4xpath
-import json
 from attrdict import AttrDict
 
 
@@ -58,10 +72,13 @@ defaults = AttrDict({
     'region_file': None,
     'optimize_paths': False,
     'optimize_styles': False,
+    'hoist_styles': False,
     'optimize_coordinates': False,
     'path_error_limit': 0.00001,
     'stats': False,
     'stats_format': 'text',
+    'stats_detail': False,
+    'stream_stats': False,
     'out_kml': None,
     'output_file': None,
     'pretty_print': False,
@@ -72,6 +89,8 @@ defaults = AttrDict({
     'filter': None,
     'no_kml_out': False,
     'list_detail': False,
+    'list_with_xpaths': False,
+    'list_only': [],
     'folderize': [],
     'folderize_limit': 0.35,
     'serialize_names': False,
@@ -79,6 +98,18 @@ defaults = AttrDict({
     'paths_only': False,
     'multi_flatten': False,
     'dump': [],
+    'dump_path': [],
+    'geojson': False,
+    'geojson_seq': False,
+    'output_format': 'kml',
+    'max_memory': None,
+    'feature_table': False,
+    'index': False,
+    'parse_jobs': None,
+    'pipeline': False,
+    'save_snapshot': None,
+    'load_snapshot': None,
+    'verify_snapshot': False,
     'extract': [],
     'delete': [],
     'rename': [],
@@ -86,15 +117,19 @@ defaults = AttrDict({
     'combine_filter': [],
     'validate_styles': False,
     'reraise_errors': False,
+    'debug': False,
+    'error_exit_status': 1,
+    'profile': False,
+    'profile_format': 'text',
+    'profile_dump': None,
+    'progress_json': None,
+    'progress_interval': 1.0,
+    'batch': None,
+    'jobs': 1,
+    'batch_output_dir': None,
+    'batch_summary': None,
 })
 
-args = None
-verboseness = 0
-
-out_diag = sys.stderr
-out_stats = sys.stderr
-out_kml = sys.stdout
-
 # first element of array is used for output
 alias_map = {
     'Point': ['Point', 'Placemark', 'Waypoint'],
@@ -106,6 +141,23 @@ all_polygon_names = ur'//*[local-name()="Placemark" and *[local-name()="Polygon"
 all_elementX_names = ur'//*[local-name()="Placemark" and *[local-name()="%s"]]/*[local-name()="name"]/text()'
 all_style_data = ur'//*[local-name()="Style" or local-name()="StyleMap"]|//*[local-name()="Placemark"]/*[local-name()="styleUrl"]'
 
+# rough size of a parsed document relative to its kml file, used to decide when --max-memory is exceeded
+tree_bytes_per_file_byte = 3
+# options that need the whole document in memory, see KMLProcessor.stored()
+stored_unsupported = ['stats', 'combine', 'multi_flatten', 'extract', 'paths_only', 'delete', 'delete_styles', 'rename',
+                      'serialize_names', 'region', 'optimize_paths', 'optimize_coordinates', 'hoist_styles',
+                      'validate_styles', 'dump_path', 'tree', 'list']
+# options that need features the --index doesn't select, see KMLProcessor.indexed()
+indexed_unsupported = ['stats', 'combine', 'multi_flatten', 'save_snapshot', 'load_snapshot']
+# options that change or check the whole document, without --extract the index is only used when none of them is
+indexed_whole_document = ['paths_only', 'delete', 'delete_styles', 'rename', 'serialize_names', 'region', 'optimize_paths',
+                          'optimize_styles', 'hoist_styles', 'optimize_coordinates', 'folderize', 'validate_styles',
+                          'list_detail']
+# options that need the whole document, with any of them --pipeline is not used, see KMLProcessor.pipelined()
+pipeline_unsupported = ['stats', 'combine', 'multi_flatten', 'extract', 'paths_only', 'delete', 'delete_styles', 'rename',
+                        'region', 'optimize_styles', 'hoist_styles', 'folderize', 'validate_styles', 'dump_path', 'tree',
+                        'list', 'pretty_print', 'save_snapshot', 'load_snapshot']
+
 
 class KMLError(Exception):
     def __init__(self, message):
@@ -132,6 +184,23 @@ def haversine(lon1, lat1, lon2, lat2):
     return km
 
 
+def kml_color_opacity(kml_color, default=('000000', 1.0)):
+    """
+    convert a kml color (aabbggrr) to (rrggbb, opacity)
+    """
+    if kml_color is None:
+        return default
+    return kml_color[6:8] + kml_color[4:6] + kml_color[2:4], int(kml_color[0:2], 16)/255.0
+
+
+def path_color_width_opacity(kml_color, width):
+    """
+    convert a kml LineStyle color (aabbggrr) and width to [rrggbb, width, opacity], missing values get defaults
+    """
+    color, opacity = kml_color_opacity(kml_color)
+    return [color, 3.0 if width is None else float(width), opacity]
+
+
 def path_length(coords_list):
     length = 0
     if len(coords_list) > 1:
@@ -160,12 +229,41 @@ def parse_coords(coords_text):
     return [tuple([float(n) for n in coordinates.split(',')]) for coordinates in coords_text.strip().split()]
 
 
+def format_coords(coords, optimize_coordinates=False):
+    if optimize_coordinates:
+        return ' '.join([','.join([("%.6f" % v).rstrip('0').rstrip('.') for v in node]) for node in coords])
+    return ' '.join([','.join([(str(v)).rstrip('0').rstrip('.') for v in node]) for node in coords])
+
+
+def parse_input(kml_file, geojson=None, name=None):
+    """
+    parse a kml document from a path, url or file object, GeoJSON and GeoJSON-seq input is converted to kml, see
+    geojsonreader, compressed local files and open files are decompressed, see kmlinput
+    :param geojson: True if kml_file is GeoJSON, by default it is recognized by the extension or content of a path
+    :param name: name of the Document converted from GeoJSON, by default the name of the file
+    """
+    if kmlinput.is_local(kml_file) or isinstance(kml_file, file):
+        in_file = kmlinput.open_input(kml_file)
+        try:
+            if name is None and in_file.name != '<stdin>':
+                name = os.path.splitext(os.path.basename(in_file.name))[0]
+            return parse_input(in_file, geojson=geojsonreader.is_geojson(in_file) if geojson is None else geojson, name=name)
+        finally:
+            in_file.close()
+    if geojson is None:
+        geojson = geojsonreader.is_geojson(kml_file)
+    if geojson:
+        return geojsonreader.parse(kml_file, name=name)
+    return kmlparser.parse(kml_file)
+
+
 class Placemark:
     km_doc = None
 
-    def __init__(self, element, kml_doc=None):
+    def __init__(self, element, kml_doc=None, out_diag=sys.stderr):
         self.__dict__['placemark_element'] = element
         self.__dict__['kml_doc'] = kml_doc
+        self.__dict__['out_diag'] = out_diag
         self.__dict__['name'] = element.name if hasattr(element, "name") else None
 
     def get_alias(self):
@@ -178,12 +276,12 @@ class Placemark:
         joined_coords_list = " ".join(coords_list).strip()
         if len(coords_list) == 0 or joined_coords_list == '':
             if raise_on_failure:
-                print(u"Feature does not contain any coordinates '%s'" % self.get_name(default='<unnamed>'), file=out_diag)
+                print(u"Feature does not contain any coordinates '%s'" % self.get_name(default='<unnamed>'), file=self.out_diag)
                 raise KMLError("Feature coordinates not found")
             self.__dict__['coordinates'] = None
         elif hasattr(self.placemark_element, "MultiGeometry") and not self.is_multi_polygon() and not self.is_multi_path():
             if raise_on_failure:
-                print(u"Unexpected MultiGeometry element %s " % self.get_alias(), file=out_diag)
+                print(u"Unexpected MultiGeometry element %s " % self.get_alias(), file=self.out_diag)
                 print(lxml_etree.tostring(self.__dict__, pretty_print=True))
                 raise KMLError(u"Feature coordinates not available for this type of MultiGeometry feature")
             self.__dict__['coordinates'] = None
@@ -226,6 +324,15 @@ class Placemark:
     def has_coords(self):
         return self.get_coords() is not None and len(self.__dict__['coordinates']) > 0
 
+    def set_coords(self, coords):
+        """
+        use coords, e.g. from a FeatureTable, instead of parsing the coordinates text, features that
+        parse_coords(raise_on_failure=False) finds no coordinates for get none
+        """
+        if not coords or (self.is_multi_geometry() and not self.is_multi_polygon() and not self.is_multi_path()):
+            coords = None
+        self.__dict__['coordinates'] = coords
+
     def get_name(self, default=None):
         namelist_list = self.placemark_element.xpath('.//*[local-name()="name"]/text()')
         return namelist_list[0] if len(namelist_list) else default
@@ -278,46 +385,26 @@ class Placemark:
         if hasattr(self, 'Style') and hasattr(self.Style, 'LineStyle') and hasattr(self.Style.LineStyle, 'color'):
             kml_color = self.Style.LineStyle.color.text
 
-    def get_path_color_width_opacity(self, cache=None):
-        result = ['000000', 3.0, 1.0]
-        for chain in [
-            "Style;LineStyle;color;text",
-            "StyleMap;{kml:Pair[kml:key[text()='normal']]};Style;LineStyle;color;text",
-            "styleUrl;text;@;{kml:Pair[kml:key[text()='normal']]};Style;LineStyle;color;text",
-            "styleUrl;text;@;{kml:Pair[kml:key[text()='normal']]};styleUrl;text;@;LineStyle;color;text",
-        ]:
-            color = util.chain(self, chain, cache=cache)
-            if color is not None:
-                result[0] = color[6:8] + color[4:6] + color[2:4]
-                result[2] = int(color[0:2], 16)/255.0
-                break
-        for chain in [
-            "Style;LineStyle;width;text",
-            "StyleMap;{kml:Pair[kml:key[text()='normal']]};Style;LineStyle;width;text",
-            "styleUrl;text;@;{kml:Pair[kml:key[text()='normal']]};Style;LineStyle;width;text",
-            "styleUrl;text;@;{kml:Pair[kml:key[text()='normal']]};styleUrl;text;@;LineStyle;width;text",
-        ]:
-            width = util.chain(self, chain, cache=cache)
-            if width is not None:
-                result[1] = float(width)
-                break
-        return result
+    def get_path_color_width_opacity(self, cache=None, resolver=None):
+        """
+        [rrggbb, width, opacity] of the normal LineStyle, pass the same StyleResolver for all placemarks of a document
+        """
+        if resolver is None:
+            resolver = StyleResolver(self.placemark_element, cache=cache)
+        return resolver.path_color_width_opacity(self.placemark_element)
 
     def delete(self):
         self.placemark_element.getparent().remove(self.placemark_element)
 
-    def simplify_path(self):
+    def simplify_path(self, error_limit, optimize_coordinates=False):
         coords = util.xp(self.placemark_element, ur'.//kml:coordinates')
         for coord in coords:
             text = coord.text
             clist = [tuple([float(v) for v in node.split(',')]) for node in text.split()]
             if len(clist) > 10:
-                cnew = simplify(clist, args.path_error_limit)
-                if args.optimize_coordinates:
-                    new = ' '.join([','.join([("%.6f" % v).rstrip('0').rstrip('.') for v in node]) for node in cnew])
-                else:
-                    new = ' '.join([','.join([(str(v)).rstrip('0').rstrip('.') for v in node]) for node in cnew])
-                coord.getparent().coordinates = objectify.StringElement(new)
+                from simplify import simplify
+                cnew = simplify(clist, error_limit)
+                coord.getparent().coordinates = objectify.StringElement(format_coords(cnew, optimize_coordinates))
 
     def optimize_coordinates(self):
         coords = util.xp(self.placemark_element, ur'.//kml:coordinates')
@@ -327,30 +414,30 @@ class Placemark:
             coord.getparent().coordinates = objectify.StringElement(new)
 
     @staticmethod
-    def find_folder_by_name(folder_name, context):
+    def find_folder_by_name(folder_name, context, trace_file=None):
         xpath = folder_by_name.format(name=encode4xpath(folder_name))
-        if args.verbose > 2:
-            print(xpath, file=out_diag)
+        if trace_file is not None:
+            print(xpath, file=trace_file)
         element_list = context.xpath(xpath)
 
         return None if element_list is None or len(element_list) == 0 else element_list[0]
 
     @staticmethod
-    def find_by_type(placemark_type, context):
+    def find_by_type(placemark_type, context, trace_file=None):
 
-        if args.verbose > 2:
-            print(placemark_type_xpath % placemark_type, file=out_diag)
+        if trace_file is not None:
+            print(placemark_type_xpath % placemark_type, file=trace_file)
 
         element_list = context.xpath(placemark_type_xpath % placemark_type)
 
         return None if element_list is None or len(element_list) == 0 else Placemark(element_list[0])
 
     @staticmethod
-    def find_by_name_and_type(placemark_name, placemark_type, context):
+    def find_by_name_and_type(placemark_name, placemark_type, context, trace_file=None):
 
-        if args.verbose > 2:
+        if trace_file is not None:
             print(placemark_name_and_type_xpath.format(name=encode4xpath(placemark_name),
-                                                       type=placemark_type), file=out_diag)
+                                                       type=placemark_type), file=trace_file)
 
         element_list = util.xp(context, placemark_name_and_type_xpath.format(name=encode4xpath(placemark_name),
                                                                              type=placemark_type))
@@ -360,32 +447,26 @@ class Placemark:
 
 class ComplexBoundry(object):
     def __init__(self, outer_boundries, inner_boundries):
+        # plain tuples of (min_x, min_y, max_x, max_y, coords, factor), reading an AttrDict attribute copies the
+        # coordinate list on every access which made each point test as slow as the whole boundry
         self.boundries = []
-        for boundry in outer_boundries:
-            self.boundries.append(AttrDict({
-                'min_x': min(a[0] for a in boundry),
-                'min_y': min(a[1] for a in boundry),
-                'max_x': max(a[0] for a in boundry),
-                'max_y': max(a[1] for a in boundry),
-                'coords': boundry,
-                'factor': 1
-            }))
-        for boundry in inner_boundries:
-            self.boundries.append(AttrDict({
-                'min_x': min(a[0] for a in boundry),
-                'min_y': min(a[1] for a in boundry),
-                'max_x': max(a[0] for a in boundry),
-                'max_y': max(a[1] for a in boundry),
-                'coords': boundry,
-                'factor': -1
-            }))
+        for boundries, factor in [(outer_boundries, 1), (inner_boundries, -1)]:
+            for boundry in boundries:
+                self.boundries.append((
+                    min(a[0] for a in boundry),
+                    min(a[1] for a in boundry),
+                    max(a[0] for a in boundry),
+                    max(a[1] for a in boundry),
+                    boundry,
+                    factor
+                ))
 
     def is_point_in(self, x, y):
         total = 0
-        for boundry in self.boundries:
-            if x < boundry.min_x or x > boundry.max_x or y < boundry.min_y or y > boundry.max_y:
+        for min_x, min_y, max_x, max_y, coords, factor in self.boundries:
+            if x < min_x or x > max_x or y < min_y or y > max_y:
                 continue
-            total += boundry.factor if is_point_inside(x, y, boundry.coords) else 0
+            total += factor if is_point_inside(x, y, coords) else 0
         return total > 0
 
 
@@ -413,161 +494,8 @@ def get_kml_name(element):
     return element.name if hasattr(element, 'name') else None
 
 
-def find_boundry_folders(doc, folder_kmlids):
-    folder_list = []
-
-    for folder in list_nodes(doc, folder_kmlids):
-        polygon_list = util.xp(folder, ur'kml:Placemark[kml:Polygon or kml:MultiGeometry/kml:Polygon]')
-        polygon = polygon_list[0] if len(polygon_list) else None
-
-        if polygon is not None:
-            folder_info = AttrDict({
-                'name': get_kml_name(folder),
-                'element': folder,
-                'polygon': polygon,
-                'outer': [],
-                'inner': []
-            })
-
-            outer_coords_list = util.xp(polygon, ur'.//kml:Polygon/kml:outerBoundaryIs//kml:coordinates/text()')
-            inner_coords_list = util.xp(polygon, ur'.//kml:Polygon/kml:innerBoundaryIs//kml:coordinates/text()')
-
-            area = 0.0
-            for outer in outer_coords_list:
-                coords = parse_coords(outer)
-                area += area_of_polygon(coords)
-                folder_info.outer.append(coords)
-
-            for inner in inner_coords_list:
-                coords = parse_coords(inner)
-                area -= area_of_polygon(coords)
-                folder_info.inner.append(coords)
-
-            folder_info.complex = ComplexBoundry(folder_info.outer, folder_info.inner)
-
-            folder_list.append(folder_info)
-
-    if len(folder_list) == 0:
-        print('Error: folderize folder list is empty', file=out_diag)
-
-    return folder_list
-
-
-def folderize(doc, folder_kmlids, limit):
-
-        if args.verbose > 3:
-            print("{name:20s} {place:20s} {inout:6s} {per:7s}   {dump:s}".format(
-                name="Boundry",
-                place="Placemark",
-                inout="in/out",
-                per="Contain",
-                dump="Deatil (begins, ends, any, all,count,total,seg)"),
-                file=out_diag)
-
-            print("{name:20s} {place:20s} {inout:6s} {per:7s}   {dump:s}".format(
-                name="-" * 20,
-                place="-" * 20,
-                inout="-" * 6,
-                per="-" * 7,
-                dump="-" * 47),
-                file=out_diag)
-
-        folders = find_boundry_folders(doc, folder_kmlids)
-
-        boundry_map = {}
-
-        for folder in folders:
-            boundry_map[folder.polygon] = True
-            folder.new_children = []
-
-        points = 0
-
-        els = util.xp(doc, all_placemarks)
-        for el in els:
-            if el in boundry_map:
-                continue
-
-            coords_text = " ".join(util.xp(el, ur'.//kml:coordinates/text()'))
-            coords = parse_coords(coords_text)
-
-            points += len(coords)
-
-            in_folders = []
-            for folder in folders:
-                bounds = folder.complex
-
-                points_in = 0
-                for point in coords:
-                    points_in += 1 if bounds.is_point_in(point[0],point[1]) else 0
-
-                if points_in:
-                    in_folders.append([float(points_in) / len(coords), folder])
-
-            if len(in_folders):
-                ratio, folder = max(in_folders)
-                if ratio >= limit:
-                    folder.element.append(el)
-                    folder.new_children.append(el)
-
-        if args.verbose >= 1:
-            msg = "Folderization processed {placemarks:d} placemarks with {points:d} coordinates against {folders:d} folders"
-            print(msg.format(placemarks=len(els), points=points, folders=len(folders)), file=out_diag)
-            for folder in folders:
-                print("Folder: '{name:s}' children appended: {appended:d}".format(name=folder.name, appended=len(folder.new_children)), file=out_diag)
-
-
-def count_points(element):
-    count = 0
-    tag = util.tag(element)
-    if tag == "Document" or tag == "LineString" or tag == "LinearRing" or tag == "Polygon" or tag == "Point":
-        coords = util.xp(element, ur'.//kml:coordinates/text()')
-        for coord in coords:
-            count += len(coord.strip().split())
-    return count
-
-
-def rename_placemarks(doc, renames):
-    for (kml_id, new_name) in renames:
-        nodes = list_nodes(doc, kml_id)
-        if args.verbose > 1:
-            print("renaming {0:d} item(s) to '{1:s}'".format(len(nodes), new_name), file=out_diag)
-        for node in nodes:
-            node.name = objectify.StringElement(new_name)
-
-
-def delete_nodes(doc, kml_ids):
-
-    nodes = list_nodes(doc, kml_ids)
-
-    print("Deleteing %d item(s)" % len(nodes), file=out_diag)
-
-    for node in reversed(nodes):
-
-        if args.verbose > 1:
-            print("Deleteing %d item(s) named '%s'" % (len(nodes), node.name), file=out_diag)
-
-        node.getparent().remove(node)
-
-
-def extract_nodes(doc, kml_ids):
-
-    nodes = list_nodes(doc, kml_ids)
-
-    if args.verbose > 1:
-        print("Located %d features to extract" % len(nodes), file=out_diag)
-
-    all_top_level = doc.xpath(top_level_folder_or_placemarks)
-
-    for node in reversed(all_top_level):
-        node.getparent().remove(node)
-
-    document_element = util.xp(doc, ur'/*/kml:Document')[0]
-
-    for node in nodes:
-        document_element.append(node)
-
-
 def multi_flatten(doc):
+    from copy import deepcopy
 
     # all the multi-segment linestrings
     multis = util.xp(doc, ur'//kml:Placemark[kml:MultiGeometry/kml:LineString]')
@@ -605,397 +533,130 @@ def multi_flatten(doc):
                 node.name = objectify.StringElement("%s part %s" % (base_name, i+1))
 
 
-def paths_only(doc):
-    paths = util.xp(doc, all_placemark_paths)
-
-    if args.verbose > 1:
-            print("Located %d paths" % len(paths), file=out_diag)
+stats_point_tags = frozenset(['Document', 'LineString', 'LinearRing', 'Polygon', 'Point'])
 
-    all_top_level = doc.xpath(top_level_folder_or_placemarks)
 
-    for node in reversed(all_top_level):
-        node.getparent().remove(node)
+def count_coordinate_tuples(coords_text):
+    return len(coords_text.split()) if coords_text else 0
 
-    document_element = doc.xpath(ur'/*/*[local-name()="Document"]')[0]
-
-    for path in paths:
-        document_element.append(path)
 
+class StatsCollector(object):
+    """
+    accumulate element and coordinate point counts from start/end element events, shared by the tree walk in
+    doc_stats() and the streaming parser so both produce identical maps
+    """
 
-def remove_all_styles(doc):
-    nodes = doc.xpath(all_style_data)
+    def __init__(self):
+        self.element_counts = {}
+        self.point_counts = {}
+        self.open_point_tags = []
 
-    if args.verbose > 1:
-            print("Deleteing %d style related item(s)" % len(nodes), file=out_diag)
+    def start(self, el_tag):
+        if el_tag[0] not in string.ascii_lowercase:
+            self.element_counts[el_tag] = self.element_counts.get(el_tag, 0) + 1
+        if el_tag in stats_point_tags:
+            self.open_point_tags.append(el_tag)
 
-    for node in reversed(nodes):
-        node.getparent().remove(node)
+    def end(self, el_tag, text=None):
+        if el_tag == 'coordinates':
+            count = count_coordinate_tuples(text)
+            if count:
+                for point_tag in self.open_point_tags:
+                    self.point_counts[point_tag] = self.point_counts.get(point_tag, 0) + count
+        elif el_tag in stats_point_tags:
+            self.open_point_tags.pop()
 
 
-def doc_stats(doc, points=False):
+def doc_stats(doc):
     """
-    calculate statistics for the specified document
-    {
-        element-tag: count,
-        ...
-    }
+    calculate statistics for the specified document in a single pass over the tree
+    (
+        { element-tag: element count, ... },
+        { element-tag: coordinate point count, ... }
+    )
+    coordinate points are only tallied for Document, LineString, LinearRing, Polygon and Point elements
     :param doc: pykml document (root)
-    :return: map as above
+    :return: tuple of maps as above
     """
-    stats_map = {}
-    predicate = ur'translate(substring(local-name(),1,1),"abcdefghijkmlnopqrstuvwxyz","ABCDEFGHIJKMLNOPQRSTUVWXYZ")=substring(local-name(),1,1)'
-    all_uppercase = ur'//*[' + predicate + ']'
-    all_with_coords = ur'//*[' + predicate + ur' and .//kml:coordinates]'
-    for el in util.xp(doc, all_with_coords if points else all_uppercase):
-        tag = util.tag(el)
-        if tag not in stats_map:
-            stats_map[tag] = 0
-        stats_map[tag] += count_points(el) if points else 1
+    collector = StatsCollector()
+    for event, el in lxml_etree.iterwalk(doc, events=('start', 'end')):
+        if not isinstance(el.tag, basestring):
+            continue
+        el_tag = el.tag.split('}')[-1]
+        if event == 'start':
+            collector.start(el_tag)
+        else:
+            collector.end(el_tag, el.text)
 
-    return stats_map
+    return collector.element_counts, collector.point_counts
 
 
 def list_filter(tag, filter_list):
     return True if filter_list is None else tag in filter_list
 
 
-def lister(element, filter_list, tree=False, indent=0, recursive=True, children_only=False):
-    node_list = []
-
-    for el in util.xp(element, ur'kml:Document|kml:Folder|kml:Placemark'):
-        el_tag = el.tag.split('}')[-1]
-        name = unicode(el.name if hasattr(el, 'name') else u'UNNAMED')
-        type_list = util.xp(el, ur'kml:LineString|kml:Point|kml:Polygon|kml:LinearRing|kml:MultiGeometry/kml:LineString|' +
-                            'kml:MultiGeometry/kml:Point|kml:MultiGeometry/kml:Polygon|kml:MultiGeometry/kml:LinearRing')
-        if el_tag in ['Folder', 'Document']:
-            type_tag = el_tag
-        elif len(type_list) == 0:
-            type_tag = 'UNKNOWN'
-        else:
-            type_tag = type_list[0].tag.split('}')[-1]
-        node_item = None
-        if not children_only and list_filter(type_tag, filter_list):
-            node_item = AttrDict({
-                'name': name,
-                'type': list_type_mapper(type_tag),
-                'indent': indent,
-                'el': el
-            })
-            if args.list_detail and (node_item.type == 'Path' or node_item.type == 'Polygon'):
-                els = util.xp(el, ur'.//kml:coordinates/text()')
-                if els is not None and len(els):
-                    coords = parse_coords(els[0])
-                    if len(coords) > 1:
-                        node_item.count = len(coords)
-                        node_item.length = path_length(coords)
-            node_list.append(node_item)
-        if recursive and (el_tag == 'Folder' or el_tag == 'Document'):
-            nodes = lister(el, filter_list, tree=tree, indent=indent + (0 if children_only else 1), recursive=recursive)
-            node_list += nodes
-            if node_item and args.list_detail:
-                node_item.length = sum([node.length if 'length' in node and node.type == 'Path' else 0 for node in nodes])
-                node_item.count = sum([node.count if 'count' in node else 0 for node in nodes])
-    return node_list
-
-
 def list_type_mapper(unmapped_type):
     return alias_map[unmapped_type][0] if unmapped_type in alias_map else unmapped_type
 
 
-def kml_id_to_xpath(kml_id):
-
-    if kml_id.startswith(('.', '/')):
-        return kml_id
-    elif kml_id.startswith('@'):
-        name = kml_id[1:]
-        if name == 'Path':
-            name = 'LineString'
-        elif name == 'Waypoint':
-            name = 'Point'
-        if name == 'Folder':
-            return './/kml:Folder'
-        elif name in ['Point', 'Polygon', 'LineString', 'LinearRing', 'MultiGeometry', 'Model']:
-            return ur'.//*[kml:{type:s}]'.format(type=name)
-        elif name in ['Folder']:
-            return ur'.//kml:Folder'
-        print("WARNING: unknown feature type '%s'" % name, file=out_diag)
-        return 'UNKNOWN_FEATURE_TYPE'
-    elif kml_id.startswith('&'):
-        return folder_or_placemark_by_name.format(name=encode4xpath(kml_id[1:]))
-    elif kml_id.startswith('%'):
-        pat = kml_id[1:].split('*')
-        if len(pat) > 2:
-            print("ERROR: only one * (wildcard) is permitted in a name pattern", file=out_diag)
-            sys.exit(5)
-        if len(pat) == 1 or len(pat[1]) == 0:
-            return folder_or_placemark_by_name_starts_with.format(part0=encode4xpath(pat[0]))
-        if len(pat[0]) == 0 and len(pat[1]):
-            return folder_or_placemark_by_name_ends_with.format(part0=encode4xpath(pat[1]))
-        else:
-            return folder_or_placemark_by_name_match.format(part0=encode4xpath(pat[0]), part1=encode4xpath(pat[1]))
-
-    return folder_or_placemark_by_name.format(name=encode4xpath(kml_id))
-
-
-def list_nodes(doc, kml_ids):
-    if isinstance(kml_ids, list) or isinstance(kml_ids, tuple):
-        xpaths = map(kml_id_to_xpath, kml_ids)
-    else:
-        xpaths = [kml_id_to_xpath(kml_ids)]
-
-    try:
-        nodes = util.xp(doc, '|'.join(xpaths))
-    except lxml_etree.XPathEvalError, e:
-        print("KMLUTIL ERROR: invalid xpath expression", file=out_diag)
-        if args.debug:
-            print("DEBUG: Expression '%s'" % xpaths, file=out_diag)
-            for attr in ['level_name', 'file', 'line', 'column', 'type_name']:
-                if hasattr(e.error_log.last_error, attr):
-                    print("DEBUG:     %s: %s" % (attr, repr(getattr(e.error_log.last_error, attr))), file=out_diag)
-        if args.reraise_errors:
-            raise
-        raise KMLError("Error evaluating xpath expression")
-    return nodes
-
-
-def dump(kml_doc, line_name, out_list=sys.stdout):
-
-    node_list = list_nodes(kml_doc, line_name)
-
-    for node in node_list:
-        placemark = Placemark(node, kml_doc)
-        if args.verbose:
-            name = placemark.get_name()
-            print("# %s" % "<unnamed>" if name is None else name, file=out_diag)
-        for point in placemark.coordinates:
-            print(u','.join(map(unicode, point)), file=out_list)
-
-
-class FilteringAttrDictEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, AttrDict):
-            d = dict(obj)
-            d.pop('el', None)
-            return d
-        if isinstance(obj, objectify.ObjectifiedElement):
-            return None
-        return json.JSONEncoder.default(self, obj)
-
-
-preprint_buf = None
-preprint_file = sys.stdout
-preprint_count = 0
-
-
-def preprint(message=None, out_file=sys.stdout):
-    global preprint_buf, preprint_file, preprint_count
-    str_match = preprint_buf is not None and message is not None and preprint_buf == message and preprint_file == out_file
-    if preprint_count > 0 and not str_match:
-        print(preprint_buf + ('' if preprint_count == 1 else ' [%d occurances]' % preprint_count), file=preprint_file)
-        preprint_count = 0
-    if str_match:
-        preprint_count += 1
-    else:
-        preprint_count = 0 if message is None else 1
-        preprint_file = out_file
-        preprint_buf = message
-
-
-def print_list(doc, filter_list, tree=False, xpaths=False, list_format='text', out_list=sys.stdout):
-
-    # map filter alias to real kml terms
-    mapped_filter = filter_list
-    if filter_list is not None:
-        for term in filter_list.split(','):
-            term_to_add = term
-            for aliased_term, terms in alias_map.iteritems():
-                if term in terms:
-                    term_to_add = aliased_term
-                    break
-            mapped_filter = term_to_add
-
-    if hasattr(doc, 'Document'):
-        root = doc.Document
-    elif hasattr(doc, 'Folder'):
-        root = doc.Folder
-    else:
-        raise KMLError("Unsupported document root")
-
-    node_list = lister(root, mapped_filter, tree=True, children_only=False)
-    etree = lxml_etree.ElementTree(doc) if xpaths else None
-
-    if list_format == 'json':
-
-        serializable_list = []
-        for node in node_list:
-            serializable_node = dict(node)
-            serializable_node.pop('el', None)
-            if xpaths:
-                serializable_node['xpath'] = etree.getpath(node.el)
-            serializable_list.append(serializable_node)
-        json.dump(serializable_list, out_list, indent=2 if args.pretty_print else None, cls=FilteringAttrDictEncoder)
-
-    else:
+def filtering_json_default(obj):
+    """
+    'default' for json.dump(s) that serializes AttrDict objects without their 'el' element and elements as null
+    """
+    if isinstance(obj, AttrDict):
+        d = dict(obj)
+        d.pop('el', None)
+        return d
+    if isinstance(obj, objectify.ObjectifiedElement):
+        return None
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
-        name_len = 0
-        type_len = 0
-        for node in node_list:
-            if len(node.name) > name_len:
-                name_len = len(node.name) + (node.indent * 2 if tree else 0)
-            type_len = len(node.type) if len(node.type) > type_len else type_len
 
-        line = u"{name:<{name_width:d}s} {type:<{type_width:d}s}"
+# attributes added by lxml.objectify, not part of the kml
+annotation_namespaces = ('{http://codespeak.net/lxml/objectify/pytype}', '{http://www.w3.org/2001/XMLSchema-instance}')
 
-        for node in node_list:
-            name = (u"  " * node.indent if tree else u'') + node.name
-            if args.list_detail and 'length' in node:
-                detail = line + u" {count:6d} {length:7.2f}km {rate:7.2f}m/pt" + (u" {xpath:s}" if xpaths else u"")
-                rate = node.length / node.count * 1000 if node.count > 0 else 0.0
-                model = {
-                    "name_width": name_len,
-                    "name": name,
-                    "type": node.type,
-                    "type_width": type_len,
-                    "count": node.count,
-                    "length": node.length,
-                    "rate": rate,
-                    "xpath": etree.getpath(node.el) if xpaths else u""
-                }
-                preprint(detail.format(**model), out_file=out_list)
-            else:
-                simple = line + (u" {xpath:s}" if xpaths else u"")
-                model = {
-                    "name_width": name_len,
-                    "name": name,
-                    "type": node.type,
-                    "type_width": type_len,
-                    "xpath": etree.getpath(node.el) if xpaths else u""
-                }
-                preprint(simple.format(**model), out_file=out_list)
-
-        preprint(None)
-
-
-style_dir = AttrDict({
-    'styles': {},   # (old) id: signature
-    'uniques': {},  # signature: array of [ (old) ids ... ] sharing the same signature
-    'ids': {},      # all ids in the document NOT belonging to Style and StyleMap elements
-    'old2new': {},  # map of (old) id: (new) id
-})
 
-sigmap = {
-    'Style': {
-        'LineStyle': {
-            'color': 'text',
-            'width': 'text',
-        },
-        'IconStyle': {
-            'scale': 'text',
-            'Icon': {'href': 'text'},
-        },
-    }
-}
+# styles whose children style_canonical() sorts
+unordered_style_tags = frozenset(['Style', 'StyleMap'])
 
 
-def _sig(el, loc):
-    sig = ''
-    if isinstance(loc, dict):
-        for name in loc.keys():
-            if hasattr(el, name):
-                sig += '-' + name + _sig(el[name], loc[name])
-    else:
-        if loc == 'text':
-            sig += '=' + el.text.strip()
-        else:
-            if loc in el.attrib:
-                sig += '@' + el.attrib[loc]
-    return sig
-
-
-def get_sig(el, style_info=None):
-    tag = el.tag.split('}')[-1]
-    sig = tag + '|'
-    if tag == 'StyleMap':
-        sig += '['
-        for child in el.getchildren():
-            ctag = child.tag.split('}')[-1]
-            if ctag == 'Pair' and hasattr(child, 'key') and hasattr(child, 'styleUrl'):
-                style_id = child.styleUrl.text[1:]
-                if style_id not in style_dir.styles:
-                    print('Error: style not found with id of "%s"' % style_id, file=out_diag)
-                sig += '#' + child.key + '=' + style_dir.styles[style_id][0]
-        sig += ']'
-    else:
-        sig += _sig(el, sigmap[tag])
-    if style_info is not None:
-        if 'id' in el.attrib:
-            style_id = el.attrib['id']
-            style_info.styles[style_id] = (sig, el)
-            if sig not in style_info.uniques:
-                style_info.uniques[sig] = oSet()
-            style_info.uniques[sig].add(style_id)
-    return sig
-
-
-def optimize_styles(doc):
-    styles = doc.xpath(ur"//*[local-name()='Style' and @id]")
-    style_detail = args.verbose > 4
-    for el in styles:
-        get_sig(el, style_dir)
-        if style_detail:
-            print(ur'%30s - %s' % (el.attrib['id'], get_sig(el, style_dir)), file=out_diag)
-    styles = doc.xpath(ur"//*[local-name()='StyleMap' and @id]")
-    for el in styles:
-        get_sig(el, style_dir)
-        if style_detail:
-            print(ur'%30s - %s' % (el.attrib['id'], get_sig(el, style_dir)), file=out_diag)
-    if style_detail:
-        print(ur'Styles:%d uniques:%d' % (len(style_dir['styles']), len(style_dir['uniques'])), file=out_diag)
-
-    style_dir.ids = {str(idattr): True for idattr in doc.xpath(ur"//*[local-name()!='StyleMap' and local-name()!='Style']/@id")}
-
-    c = 0
-    for sig in style_dir.uniques.keys():
-        c += 1
-        sid = 'S'+str(c)
-        # change id on the delegate Style and StyleMap elements we are keeping
-        while sid in style_dir.ids:
-            c += 1
-            sid = 'S'+str(c)
-        did = style_dir.uniques[sig][0]
-        delegate = style_dir.styles[did][1]
-        delegate.attrib['id'] = sid
-        # build old2new mapping
-        for oldid in style_dir.uniques[sig]:
-            style_dir.old2new[oldid] = sid
-        # remove orphaned Style and StyleMap elements
-        for xid in style_dir.uniques[sig][1:]:
-            xel = style_dir.styles[xid][1]
-            xparent = xel.getparent()
-            if xparent is not None:
-                xparent.remove(xel)
-    for el in doc.xpath(ur"//*[*[local-name()='styleUrl']]"):
-        oldid = el.styleUrl.text[1:]
-        el.styleUrl = objectify.StringElement('#' + style_dir.old2new[oldid])
-
-    # targets = {str(el.attrib['id']): el for el in doc.xpath(ur"//*[@id]")}
-    # find orphans (mostly just Style that were only used by removes StyleMaps)
-    references = {str(el.text)[1:]: True for el in doc.xpath("//*[local-name()='styleUrl']")}
-    for el in doc.xpath(ur"//*[@id and (local-name()='StyleMap' or local-name()='Style')]"):
-        style_id = str(el.attrib['id'])
-        if style_id not in references:
-            oparent = el.getparent()
-            if oparent is not None:
-                oparent.remove(el)
+def style_canonical(el, resolve, refs=None):
+    """
+    canonical text of a Style/StyleMap subtree, equal for styles that render the same: ids and annotations are
+    dropped, whitespace is collapsed and the children of Style and StyleMap are sorted, the sub styles of a Style and
+    the Pairs of a StyleMap are told apart by their tag and key so their order does not matter, the order of all
+    other children is kept
+    :param resolve: function returning the canonical text to use in place of a styleUrl's text, None to keep the text
+    :param refs: list the styleUrl elements found in the subtree are appended to
+    """
+    tag = el.tag[el.tag.rfind('}') + 1:]
+    text = u' '.join(el.text.split()) if el.text else u''
+    if tag == 'styleUrl':
+        if refs is not None:
+            refs.append(el)
+        text = resolve(text) or text
+    attrs = el.items()
+    if attrs:
+        attrs = u''.join(u' %s="%s"' % item for item in sorted(attrs)
+                         if item[0] != 'id' and not item[0].startswith(annotation_namespaces))
+    children = el.getchildren()
+    if children:
+        children = [style_canonical(child, resolve, refs) for child in children if isinstance(child.tag, basestring)]
+        children = u''.join(sorted(children) if tag in unordered_style_tags else children)
+    return u'<%s%s>%s%s</>' % (tag, attrs or u'', text, children or u'')
 
 
 def read_namespaces(filepath_or_url, root_element='kml', peek_length=10240):
     """
     read namespaces and prefixes used in the document
+    :param filepath_or_url: path or a file object with peek(), see kmlinput
     :rtype : dict
     """
-    with open(filepath_or_url) as kml_file:
-        beginning = kml_file.read(peek_length)
+    if hasattr(filepath_or_url, 'peek'):
+        beginning = filepath_or_url.peek(peek_length)
+    else:
+        with open(filepath_or_url) as kml_file:
+            beginning = kml_file.read(peek_length)
 
     match = re.search(r'<%s([^>]*)>' % re.escape(root_element), beginning)
 
@@ -1034,48 +695,233 @@ def dump_namespace_table(namespaces_dict, outfile=sys.stdout, prefix_title='Pref
 all_placemark_paths = ur'//kml:Placemark[kml:LineString or kml:MultiGeometry[kml:LineString]]'
 all_placemarks = ur'//kml:Placemark'
 all_placemarks_no_ns = ur'//*[local-name()="Placemark"]'
+# the xpaths of _process() for a part of the document, see KMLProcessor.pipelined()
+part_placemark_paths = 'descendant-or-self::' + all_placemark_paths.lstrip('/')
+part_serial_paths = placemark_2name_and_type_xpath.replace('.//', 'descendant-or-self::', 1).format(
+    name1="'Path'", name2="'Untitled Path'", type='LineString')
+part_multi_paths = 'descendant-or-self::*[local-name()="MultiGeometry" and *[local-name()="LineString"]]'
 
 
-def export_geojson(doc, out_file=None, pretty=False):
+def parse_coord_array(coords_text):
+    """
+    coordinates text as a list of (x, y[, z]) tuples, when every tuple has the same number of values, the usual
+    case, the whole text is converted in one pass instead of tuple by tuple
+    """
+    tuples = coords_text.split()
+    if not tuples:
+        return []
+    flat = coords_text.replace(',', ' ').split()
+    width = len(flat) // len(tuples)
+    if width * len(tuples) == len(flat) and set(t.count(',') for t in tuples) == set([width - 1]):
+        return zip(*[iter(map(float, flat))] * width)
+    return [tuple([float(n) for n in t.split(',') if n]) for t in tuples]
 
-    paths = util.xp(doc, all_placemark_paths)
-    cache = {}
 
-    geo = {
-        'type': "FeatureCollection",
-        'features': []
-    }
+def _local_tag(el):
+    return el.tag[el.tag.rfind('}') + 1:] if isinstance(el.tag, basestring) else None
 
-    for el in paths:
 
-        place = Placemark(el, doc)
-        style = place.get_path_color_width_opacity(cache=cache)
-        color = '#'+style[0]
-        opacity = round(style[2], 3)
-        width = style[1]
-        feature = {
-            'type': "Feature",
-            'properties': {
-                "stroke": color,
-                "stroke-width": float(width),
-                "stroke-opacity": opacity
-            }
-        }
-        name = place.get_name()
-        if name and name != '':
-            feature['properties']['name'] = name
-        o = {
-            'type': 'LineString',
-            'coordinates': place.coordinates
-        }
-        feature['geometry'] = o
-
-        geo['features'].append(feature)
-
-    print(json.dumps(geo, indent=4 if pretty else None, cls=FilteringAttrDictEncoder), file=out_file)
-
-
-def validate_styles(doc):
+def _child_text(el, tag):
+    child = next(el.iterchildren('{*}' + tag), None)
+    return child.text if child is not None else None
+
+
+def _geometry_coords(el, feature_table=None):
+    coords = next(el.iterchildren('{*}coordinates'), None)
+    part = feature_table.part(coords) if feature_table is not None and coords is not None else None
+    if part is not None:
+        return feature_table.part_points(part)
+    return parse_coord_array(coords.text) if coords is not None and coords.text else []
+
+
+geojson_geometry_tags = frozenset(['Point', 'LineString', 'LinearRing', 'Polygon', 'MultiGeometry'])
+
+
+def geojson_geometry(el, feature_table=None):
+    """
+    GeoJSON geometry of a kml geometry element, None for empty and unsupported geometries, the coordinates are taken
+    from feature_table, a FeatureTable, when it has them
+
+    a MultiGeometry becomes a MultiPoint, MultiLineString or MultiPolygon when all its parts have the same type and a
+    GeometryCollection otherwise, nested MultiGeometry elements are flattened and a LinearRing is a LineString
+    """
+    tag = _local_tag(el)
+    if tag == 'Point':
+        coords = _geometry_coords(el, feature_table)
+        return {'type': 'Point', 'coordinates': coords[0]} if coords else None
+    if tag in ('LineString', 'LinearRing'):
+        coords = _geometry_coords(el, feature_table)
+        return {'type': 'LineString', 'coordinates': coords} if coords else None
+    if tag == 'Polygon':
+        # the outer ring first, then the holes
+        rings = [_geometry_coords(ring, feature_table) for boundary in ['outerBoundaryIs', 'innerBoundaryIs']
+                 for boundary_el in el.iterchildren('{*}' + boundary)
+                 for ring in boundary_el.iterchildren('{*}LinearRing')]
+        if not rings or not rings[0]:
+            return None
+        return {'type': 'Polygon', 'coordinates': [ring for ring in rings if ring]}
+    if tag == 'MultiGeometry':
+        parts = []
+        for child in el.iterchildren():
+            part = geojson_geometry(child, feature_table)
+            if part is None:
+                continue
+            parts.extend(part['geometries'] if part['type'] == 'GeometryCollection' else [part])
+        if not parts:
+            return None
+        types = set(part['type'] for part in parts)
+        if len(types) == 1 and not types & set(['MultiPoint', 'MultiLineString', 'MultiPolygon']):
+            return {'type': 'Multi' + parts[0]['type'], 'coordinates': [part['coordinates'] for part in parts]}
+        return {'type': 'GeometryCollection', 'geometries': parts}
+    return None
+
+
+def geojson_style_properties(fields, geometry_types):
+    """
+    simplestyle properties for the normal fields of a resolved style (see StyleResolver) and the geometry types of a
+    feature, lines and polygons get stroke properties, polygons fill properties and points a marker color
+    """
+    properties = {}
+    if geometry_types & set(['LineString', 'Polygon']):
+        color, width, opacity = path_color_width_opacity(fields.get('LineStyle/color'), fields.get('LineStyle/width'))
+        if 'Polygon' in geometry_types and fields.get('PolyStyle/outline') == '0':
+            opacity = 0.0
+        properties.update({'stroke': '#' + color, 'stroke-width': float(width), 'stroke-opacity': round(opacity, 3)})
+    if 'Polygon' in geometry_types:
+        color, opacity = kml_color_opacity(fields.get('PolyStyle/color'), default=('ffffff', 1.0))
+        if fields.get('PolyStyle/fill') == '0':
+            opacity = 0.0
+        properties.update({'fill': '#' + color, 'fill-opacity': round(opacity, 3)})
+    if 'Point' in geometry_types and 'IconStyle/color' in fields:
+        properties['marker-color'] = '#' + kml_color_opacity(fields['IconStyle/color'])[0]
+    return properties
+
+
+def geojson_feature(el, resolver, style_cache=None, feature_table=None):
+    """
+    GeoJSON feature of a Placemark element with its geometry, name, description, the names of the folders it is in
+    and the simplestyle properties of its style, None if the placemark has no supported geometry
+
+    :param style_cache: dict shared by the features of a document, the style properties are computed once for each
+                        resolved style and set of geometry types
+    :param feature_table: optional FeatureTable of the document, see geojson_geometry()
+    """
+    geometry = None
+    for child in el.iterchildren():
+        if _local_tag(child) in geojson_geometry_tags:
+            geometry = geojson_geometry(child, feature_table)
+            if geometry is not None:
+                break
+    if geometry is None:
+        return None
+
+    types = set(part['type'].replace('Multi', '') for part in geometry.get('geometries', [geometry]))
+    fields = resolver.resolve(el)['normal']
+    key = (id(fields), frozenset(types))
+    if style_cache is None or key not in style_cache:
+        style = geojson_style_properties(fields, types)
+        if style_cache is not None:
+            style_cache[key] = style
+    else:
+        style = style_cache[key]
+
+    properties = dict(style)
+    for name in ['name', 'description']:
+        value = _child_text(el, name)
+        if value:
+            properties[name] = value
+    folders = [_child_text(folder, 'name') or '' for folder in el.iterancestors('{*}Folder')]
+    if folders:
+        properties['folder'] = '/'.join(reversed(folders))
+
+    return {'type': "Feature", 'properties': properties, 'geometry': geometry}
+
+
+class GeoJSONWriter(object):
+    """
+    write GeoJSON features as they are produced instead of building the whole FeatureCollection in memory, the
+    output is the same as json.dumps() of the collection, with seq=True it is newline-delimited GeoJSON: one feature
+    per line and no collection
+    """
+
+    def __init__(self, out_file, pretty=False, seq=False):
+        self.out_file = out_file
+        self.indent = 4 if pretty and not seq else None
+        self.seq = seq
+        self.count = 0
+
+    def _dumps(self, obj):
+        return json.dumps(obj, indent=self.indent, default=filtering_json_default)
+
+    def write(self, feature):
+        if self.seq:
+            self.out_file.write(self._dumps(feature) + '\n')
+        elif self.indent:
+            self.out_file.write(('{\n    "type": "FeatureCollection", \n    "features": [\n' if self.count == 0 else ', \n') +
+                                '\n'.join(' ' * 8 + line for line in self._dumps(feature).split('\n')))
+        else:
+            self.out_file.write(('{"type": "FeatureCollection", "features": [' if self.count == 0 else ', ') +
+                                self._dumps(feature))
+        self.count += 1
+
+    def close(self):
+        if self.seq:
+            pass
+        elif self.count == 0:
+            self.out_file.write(self._dumps({'type': "FeatureCollection", 'features': []}) + '\n')
+        elif self.indent:
+            self.out_file.write('\n    ]\n}\n')
+        else:
+            self.out_file.write(']}\n')
+
+
+def export_geojson(doc, out_file=None, pretty=False, seq=False, feature_table=None):
+    """
+    write the placemarks in doc that have a geometry as GeoJSON features, see geojson_feature() and GeoJSONWriter
+    """
+    resolver = StyleResolver(doc)
+    style_cache = {}
+    writer = GeoJSONWriter(sys.stdout if out_file is None else out_file, pretty=pretty, seq=seq)
+
+    for el in doc.getroottree().getroot().iter('{*}Placemark'):
+        feature = geojson_feature(el, resolver, style_cache, feature_table)
+        if feature is not None:
+            writer.write(feature)
+
+    writer.close()
+
+
+def export_gpkg(doc, path, table='placemarks', feature_table=None):
+    """
+    write the placemarks in doc that have a geometry to a new GeoPackage file, the features and their columns are
+    the same as the GeoJSON export, see geojson_feature() and gpkgwriter
+    :return: number of features written
+    """
+    resolver = StyleResolver(doc)
+    style_cache = {}
+    writer = gpkgwriter.GeoPackageWriter(path, table=table)
+
+    for el in doc.getroottree().getroot().iter('{*}Placemark'):
+        feature = geojson_feature(el, resolver, style_cache, feature_table)
+        if feature is not None:
+            writer.write(feature)
+
+    writer.close()
+    return writer.count
+
+
+def output_format(options):
+    """
+    'kml', 'geojson', 'geojson-seq' or 'gpkg', --geojson and --geojson-seq are short for the --output-format values
+    """
+    if options.geojson_seq:
+        return 'geojson-seq'
+    if options.geojson:
+        return 'geojson'
+    return options.output_format if 'output_format' in options and options.output_format else 'kml'
+
+
+def validate_styles(doc, out_file=sys.stdout, out_diag=sys.stderr):
     refs = {}
     targets = {}
 
@@ -1102,297 +948,1157 @@ def validate_styles(doc):
         id_len = max(id_len, len(style_id))
 
     for style_id in sorted(targets.keys()):
-        print(('%'+str(id_len)+'s : %s') % (style_id, str(refs[style_id]) if style_id in refs else '0 [orphan]'))
+        print(('%'+str(id_len)+'s : %s') % (style_id, str(refs[style_id]) if style_id in refs else '0 [orphan]'), file=out_file)
     for style_id in sorted(refs.keys()):
         if style_id not in targets:
-            print(('%'+str(id_len)+'s : %d %s') % (style_id, refs[style_id], 'Style or StyleMap missing'))
+            print(('%'+str(id_len)+'s : %d %s') % (style_id, refs[style_id], 'Style or StyleMap missing'), file=out_file)
 
 
-def combine_kml(doc, combine_file, filters):
-    combine_et = parse_kml(combine_file, out_diag)
+def nicify(it):
+    return re.sub(ur'^(\d+\.\d$|\d+|\d+\.\d\d)(?:\.\d|\d*)$', ur'\1', str(it)) if isinstance(it, float) else str(it)
 
-    combine_doc = combine_et.getroot()
 
-    nodes = list_nodes(combine_doc, filters if len(filters) else [all_root_features])
+def get_path_style_stats(doc, cache=None, table=None):
+    """
+    :param table: optional FeatureTable of doc, placemarks in it are not parsed again to find if they have coordinates
+    """
+    path_style_map = {}
+    resolver = StyleResolver(doc, cache=cache)
 
-    if len(nodes) == 0:
-        print("Error")
+    for idx, el in enumerate(util.xp(doc, all_placemark_paths)):
+        place = Placemark(el, doc)
+        row = table.row(el) if table is not None else None
+        if not (table.point_count(row) if row is not None else place.has_coords()):
+            continue
+        add_path_style(path_style_map, place.get_path_color_width_opacity(resolver=resolver))
 
-    if args.verbose:
-        print("%d features were found in combine kml file" % len(nodes), file=out_diag)
+    return path_style_map
 
-    doc_el = doc.Document
 
-    content = doc_el.xpath(child_features)
-    style_pos_index = doc_el.index(content[0]) if len(content) else max(0, doc_el.countchildren()-1)
+def add_path_style(path_style_map, parts, count=1):
+    sig = '-'.join([nicify(it) if isinstance(it, float) else str(it) for it in parts]) if len(parts) else 'UNSTYLED'
 
-    for node in nodes:
-        doc_el.append(node)
+    if sig not in path_style_map:
+        path_style_map[sig] = {'sig': sig, 'count': count, 'color': parts[0], 'width': parts[1], 'opacity': parts[2]}
+    else:
+        path_style_map[sig]['count'] += count
 
-        style_refs = node.xpath(".//*[local-name()='styleUrl']")
 
-        for style_ref in style_refs:
-            style_id = style_ref.text[1:]
-            els = combine_doc.xpath(ur'//*[@id="%s"]' % style_id if "'" in style_id else ur"//*[@id='%s']" % style_id)
-            if len(els) == 0:
-                print("Warning: Style/StyleMap not found with id '%s'" % style_id, file=out_diag)
+class StreamingStyleCollector(object):
+    """
+    gather just enough style data from a streaming parse to compute the same path style counts as
+    get_path_style_stats(), path placemarks are tallied by their unresolved style references so memory
+    grows with the number of distinct styles rather than the number of features
+    """
+
+    def __init__(self):
+        self.line_styles = {}   # id: (color, width) of a LineStyle child
+        self.normal_pairs = {}  # id: ((color, width) of the inline Style, styleUrl id) of the 'normal' Pair
+        self.path_refs = {}     # (inline (color, width), inline StyleMap (color, width), styleUrl id): count
+        self.multi_paths = 0    # MultiGeometry elements with a LineString child, see KMLProcessor.note_multi_paths()
+
+    @staticmethod
+    def _child(el, child_tag):
+        for child in el:
+            if isinstance(child.tag, basestring) and child.tag.split('}')[-1] == child_tag:
+                return child
+        return None
+
+    @staticmethod
+    def _line_style(el):
+        line_style = StreamingStyleCollector._child(el, 'LineStyle') if el is not None else None
+        if line_style is None:
+            return None, None
+        color = StreamingStyleCollector._child(line_style, 'color')
+        width = StreamingStyleCollector._child(line_style, 'width')
+        return color.text if color is not None else None, width.text if width is not None else None
+
+    @staticmethod
+    def _url_id(style_url):
+        """
+        the id of a local '#id' styleUrl element, None for references to other documents, like StyleResolver
+        """
+        url = (style_url.text or '').strip() if style_url is not None else ''
+        return url[1:] if url.startswith('#') else None
+
+    @staticmethod
+    def _normal_pair(el):
+        for child in el:
+            if isinstance(child.tag, basestring) and child.tag.split('}')[-1] == 'Pair':
+                key = StreamingStyleCollector._child(child, 'key')
+                if key is not None and key.text == 'normal':
+                    return child
+        return None
+
+    def _pair_info(self, el):
+        pair = self._normal_pair(el)
+        if pair is None:
+            return None
+        style_url = self._child(pair, 'styleUrl')
+        return self._line_style(self._child(pair, 'Style')), self._url_id(style_url)
+
+    def add_identified(self, el):
+        el_id = str(el.attrib['id'])
+        self.line_styles[el_id] = self._line_style(el)
+        self.normal_pairs[el_id] = self._pair_info(el)
+
+    def add_path(self, el):
+        style_map = self._child(el, 'StyleMap')
+        pair_info = self._pair_info(style_map) if style_map is not None else None
+        style_url = self._child(el, 'styleUrl')
+        key = (self._line_style(self._child(el, 'Style')),
+               pair_info if pair_info is not None else ((None, None), None),
+               self._url_id(style_url))
+        self.path_refs[key] = self.path_refs.get(key, 0) + 1
+
+    def add_multi_geometry(self, el):
+        if self._child(el, 'LineString') is not None:
+            self.multi_paths += 1
+
+    def path_style_map(self):
+        path_style_map = {}
+        for (inline, (inline_map, inline_map_url), url_id), count in self.path_refs.iteritems():
+            candidates = [inline, inline_map]
+            if inline_map_url:
+                candidates.append(self.line_styles.get(inline_map_url, (None, None)))
+            pair_info = self.normal_pairs.get(url_id) if url_id is not None else None
+            if pair_info is not None:
+                candidates.append(pair_info[0])
+                candidates.append(self.line_styles.get(pair_info[1], (None, None)) if pair_info[1] else (None, None))
+            elif url_id is not None:
+                # a styleUrl that refers to a Style rather than a StyleMap
+                candidates.append(self.line_styles.get(url_id, (None, None)))
+            color = next((c for c, w in candidates if c is not None), None)
+            width = next((w for c, w in candidates if w is not None), None)
+            add_path_style(path_style_map, path_color_width_opacity(color, width), count)
+        return path_style_map
+
+
+class StyleResolver(object):
+    """
+    effective normal and highlight style of placemarks, each Style/StyleMap id is resolved once and placemarks with
+    the same inline styles and styleUrl share one result so a lookup is a dict hit per feature
+
+    a resolved style is {'normal': fields, 'highlight': fields} where fields maps a sub-style field path like
+    'LineStyle/color' to its text, inline styles take precedence over a StyleMap's pair and the pair's inline Style
+    over the one its styleUrl refers to
+    """
+    fields = {
+        'LineStyle': ['color', 'width'],
+        'PolyStyle': ['color', 'fill', 'outline'],
+        'IconStyle': ['color', 'scale', 'heading', 'Icon/href'],
+        'LabelStyle': ['color', 'scale'],
+    }
+    states = ('normal', 'highlight')
+
+    def __init__(self, doc, cache=None):
+        """
+        :param cache: id: element dict in the form used by util.get_by_id, filled on first use if empty
+        """
+        self.root = doc.getroottree().getroot()
+        self.cache = {} if cache is None else cache
+        self.by_id = {}        # style id: resolved style
+        self.by_inline = {}    # (inline Style, inline StyleMap, styleUrl): resolved style
+        self.path_styles = {}  # same key: path_color_width_opacity() result
+
+    @staticmethod
+    def _merge(*resolved):
+        """
+        combine resolved styles, for each field the first one that sets it wins
+        """
+        result = {}
+        for state in StyleResolver.states:
+            merged = {}
+            for style in resolved:
+                if style is not None:
+                    for field, value in style[state].iteritems():
+                        merged.setdefault(field, value)
+            result[state] = merged
+        return result
+
+    @staticmethod
+    def _style_fields(el):
+        fields = {}
+        for sub_style in el.iterchildren():
+            if not isinstance(sub_style.tag, basestring):
                 continue
-            el = els[0]
-
-            i = 0
-            new_id = style_id
-            while len(doc.xpath(ur'//*[@id="%s"]' % new_id if "'" in style_id else ur"//*[@id='%s']" % new_id)):
-                i += 1
-                new_id = "%s-%03d" % (style_id, i)
-            if i > 0:
-                style_ref.getparent().styleUrl = objectify.StringElement('#' + new_id)
-                el.attrib['id'] = new_id
+            sub_tag = sub_style.tag[sub_style.tag.rfind('}') + 1:]
+            for path in StyleResolver.fields.get(sub_tag, []):
+                value = sub_style
+                for step in path.split('/'):
+                    value = next(value.iterchildren('{*}' + step), None)
+                    if value is None:
+                        break
+                if value is not None and value.text is not None:
+                    fields[sub_tag + '/' + path] = value.text.strip()
+        return {'normal': fields, 'highlight': fields}
+
+    def _resolve_url(self, url):
+        url = (url or '').strip()
+        if not url.startswith('#'):
+            return None
+        return self.resolve_id(url[1:])
+
+    def _resolve_element(self, el):
+        tag = el.tag[el.tag.rfind('}') + 1:]
+        if tag == 'Style':
+            return self._style_fields(el)
+        if tag != 'StyleMap':
+            return None
+        result = {}
+        for pair in el.iterchildren('{*}Pair'):
+            key = next(pair.iterchildren('{*}key'), None)
+            state = (key.text or '').strip() if key is not None else ''
+            if state not in self.states or state in result:
+                continue
+            style = next(pair.iterchildren('{*}Style'), None)
+            url = next(pair.iterchildren('{*}styleUrl'), None)
+            pair_style = self._merge(self._style_fields(style) if style is not None else None,
+                                     self._resolve_url(url.text) if url is not None else None)
+            result[state] = pair_style[state]
+        for state in self.states:
+            result.setdefault(state, {})
+        return result
+
+    def resolve_id(self, style_id):
+        """
+        resolved style of the Style or StyleMap with this id, None if there is no such style
+        """
+        if style_id not in self.by_id:
+            self.by_id[style_id] = None  # a StyleMap referring to itself resolves the reference to nothing
+            el = util.get_by_id(self.root, style_id, cache=self.cache)
+            self.by_id[style_id] = self._resolve_element(el) if el is not None else None
+        return self.by_id[style_id]
+
+    def _key(self, placemark_el):
+        inline_style = inline_map = url = None
+        for child in placemark_el.iterchildren():
+            if not isinstance(child.tag, basestring):
+                continue
+            tag = child.tag[child.tag.rfind('}') + 1:]
+            if tag == 'Style' and inline_style is None:
+                inline_style = child
+            elif tag == 'StyleMap' and inline_map is None:
+                inline_map = child
+            elif tag == 'styleUrl' and url is None:
+                url = (child.text or '').strip()
+        no_resolve = lambda ref: None
+        return (style_canonical(inline_style, no_resolve) if inline_style is not None else None,
+                style_canonical(inline_map, no_resolve) if inline_map is not None else None,
+                url), inline_style, inline_map
+
+    def _resolve_key(self, key, inline_style, inline_map):
+        if key not in self.by_inline:
+            self.by_inline[key] = self._merge(self._style_fields(inline_style) if inline_style is not None else None,
+                                              self._resolve_element(inline_map) if inline_map is not None else None,
+                                              self._resolve_url(key[2]))
+        return self.by_inline[key]
+
+    def resolve(self, placemark_el):
+        """
+        resolved style of a placemark
+        """
+        return self._resolve_key(*self._key(placemark_el))
+
+    def path_color_width_opacity(self, placemark_el):
+        """
+        path_color_width_opacity() of the normal LineStyle of a placemark
+        """
+        key, inline_style, inline_map = self._key(placemark_el)
+        if key not in self.path_styles:
+            fields = self._resolve_key(key, inline_style, inline_map)['normal']
+            self.path_styles[key] = path_color_width_opacity(fields.get('LineStyle/color'), fields.get('LineStyle/width'))
+        return list(self.path_styles[key])
+
+
+kml_name_tag = '{http://www.opengis.net/kml/2.2}name'
+xml_whitespace = re.compile(ur'[ \t\r\n]+')
+
+
+class DocumentIndex(object):
+    """
+    name and id lookup tables for a parsed document, only valid while the document is unchanged so it is used to
+    answer repeated read-only requests for the same document, names are matched like the normalize-space() in the
+    folder_or_placemark_by_name xpath
+    """
+
+    def __init__(self, doc):
+        self.root = doc
+        self.names = {}  # normalized name: list of (document position, Folder or Placemark element)
+        self.ids = {}    # id attribute: element, in the form used as the cache of util.get_by_id
+        for pos, el in enumerate(doc.iter()):
+            if not isinstance(el.tag, basestring):
+                continue
+            if 'id' in el.attrib:
+                self.ids.setdefault(str(el.attrib['id']), el)
+            if el.tag.endswith(('}Folder', '}Placemark')):
+                for name_el in el.iterchildren(kml_name_tag):
+                    name = xml_whitespace.sub(u' ', name_el.text or u'').strip(u' ')
+                    self.names.setdefault(name, []).append((pos, el))
+
+    @staticmethod
+    def plain_name(kml_id):
+        """
+        feature name for a KML-ID that is a simple name or a '&' escaped name, None for xpaths, types and patterns
+        """
+        if kml_id.startswith('&'):
+            return kml_id[1:]
+        if kml_id.startswith(('.', '/', '@', '%')):
+            return None
+        return kml_id
+
+    def find(self, doc, kml_ids):
+        """
+        nodes matching kml_ids in document order, None if the index can't answer for this document or these ids
+        """
+        if doc is not self.root:
+            return None
+        names = [self.plain_name(kml_id) for kml_id in kml_ids]
+        if None in names:
+            return None
+        found = {}
+        for name in names:
+            for pos, el in self.names.get(xml_whitespace.sub(u' ', name).strip(u' '), []):
+                found[pos] = el
+        return [found[pos] for pos in sorted(found)]
 
-            doc_el.insert(style_pos_index, els[0])
 
-            # StyleMaps can have styleUrl children so copy those over also
-            style_refs = el.xpath(".//*[local-name()='styleUrl']")
+class KMLProcessor(object):
+    """
+    processing engine for a single kml document, each instance owns its options, output streams, style directory
+    and caches so instances can run concurrently in separate threads, process() is a thin wrapper
+
+    a document that is already parsed may be passed as kml_et, it is modified in place unless only read-only options
+    are used, index is an optional DocumentIndex of kml_et used to find features by name
+    """
+
+    def __init__(self, options, kml_et=None, index=None):
+        self.args = options
+        self.opened_files = []
+        self.kml_et = kml_et
+        # a tree passed in may be shared, e.g. cached by the server, so its coordinates text is kept
+        self.own_tree = kml_et is None
+        self.kml_doc = None
+        self.index = index
+        self.table = None
+        self.input = None
+        # (element counts, point counts) of the result when --stats computed them, see doc_stats()
+        self.stats = None
+
+        # error messages and 'verbose' output
+        self.out_diag = self._output('out_diag', sys.stderr)
+        # statistics
+        self.out_stats = self._output('out_stats', sys.stderr)
+        # output kml
+        self.out_kml = self._output('out_kml', sys.stdout)
+        # output kml meta-data (feature names, sizes etc)
+        self.out_list = self._output('out_list', sys.stderr)
+        # output of namespace map
+        self.out_nsmap = self._output('out_nsmap', sys.stderr)
+
+        # 0 - no output other than ERROR:
+        # >=1 - PARAM:    parameter
+        # >=2 - PROGRESS: progress output ["-v -v" or "-vv"]
+        # >=3 - DETAIL:   detailed output
+        # >=4 - DEBUG:    debugging output
+        # >=5 - TRACE:    detailed debugging output
+        self.verboseness = self.args.verbose
+
+        self.style_dir = AttrDict({
+            'styles': {},   # (old) id: (hash of the canonical content, element)
+            'uniques': {},  # hash: array of [ (old) ids ... ] sharing the same hash
+            'ids': {},      # all ids in the document NOT belonging to Style and StyleMap elements
+            'old2new': {},  # map of (old) id: (new) id
+        })
+
+        self.preprint_buf = None
+        self.preprint_file = sys.stdout
+        self.preprint_count = 0
+
+        self.profiler = profiling.StageProfiler(enabled='profile' in self.args and self.args.profile)
+        progress_json = self.args.progress_json if 'progress_json' in self.args else None
+        progress_file = progress.open_progress_stream(progress_json)
+        # a file descriptor belongs to the caller, a file opened from a path is closed with the others
+        if progress_file is not None and not str(progress_json).isdigit():
+            self.opened_files.append(progress_file)
+        self.reporter = progress.ProgressReporter(progress_file,
+                                                  interval=self.args.progress_interval if 'progress_interval' in self.args else 1.0)
+
+    def xp(self, el, xpath):
+        """
+        util.xp() traced to the diagnostic output of this processor with --debug
+        """
+        return util.xp(el, xpath, trace_file=self.out_diag if 'debug' in self.args and self.args.debug else None)
+
+    def _output(self, name, default):
+        if name not in self.args:
+            return default
+        if self.args[name] is None:
+            devnull = open(os.devnull, 'w')
+            self.opened_files.append(devnull)
+            return devnull
+        return self.args[name]
+
+    def run(self):
+        """
+        process the document as specified by the options
+        :rtype : None
+        """
+        v1 = self.args.verbose >= 1
+
+        cprofile = None
+        if 'profile_dump' in self.args and self.args.profile_dump:
+            import cProfile
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+
+        self.reporter.event('start', kmlfile=str(self.args.kmlfile))
+        status = 'error'
+        try:
+            self._process()
+            status = 'ok'
+        finally:
+            self.reporter.event('end', status=status)
+            if cprofile is not None:
+                cprofile.disable()
+                cprofile.dump_stats(self.args.profile_dump)
+                if v1:
+                    print("PROGRESS: cProfile data written to '%s'" % self.args.profile_dump, file=self.out_diag)
+            if self.profiler.enabled:
+                self.profiler.report(out_file=self.out_diag, report_format=self.args.profile_format if 'profile_format' in self.args else 'text')
+            for opened_file in self.opened_files:
+                opened_file.close()
+
+    def find_boundry_folders(self, doc, folder_kmlids, find_polygon=None):
+        """
+        :param find_polygon: optional function returning the boundary Placemark of a folder, for folders that don't
+                             hold their placemarks as children, see FeatureStore.first_polygon()
+        """
+        folder_list = []
+
+        for folder in self.list_nodes(doc, folder_kmlids):
+            if find_polygon is not None:
+                polygon = find_polygon(folder)
+            else:
+                polygon_list = self.xp(folder, ur'kml:Placemark[kml:Polygon or kml:MultiGeometry/kml:Polygon]')
+                polygon = polygon_list[0] if len(polygon_list) else None
+
+            if polygon is not None:
+                folder_info = AttrDict({
+                    'name': get_kml_name(folder),
+                    'element': folder,
+                    'polygon': polygon,
+                    'outer': [],
+                    'inner': []
+                })
+
+                outer_coords_list = self.xp(polygon, ur'.//kml:Polygon/kml:outerBoundaryIs//kml:coordinates/text()')
+                inner_coords_list = self.xp(polygon, ur'.//kml:Polygon/kml:innerBoundaryIs//kml:coordinates/text()')
+
+                area = 0.0
+                for outer in outer_coords_list:
+                    coords = parse_coords(outer)
+                    area += area_of_polygon(coords)
+                    folder_info['outer'].append(coords)
+
+                for inner in inner_coords_list:
+                    coords = parse_coords(inner)
+                    area -= area_of_polygon(coords)
+                    folder_info['inner'].append(coords)
+
+                folder_info.complex = ComplexBoundry(folder_info.outer, folder_info.inner)
+
+                folder_list.append(folder_info)
+
+        if len(folder_list) == 0:
+            print('Error: folderize folder list is empty', file=self.out_diag)
 
-            for style_url_ref in style_refs:
-                style_id = style_url_ref.text[1:]
-                els = combine_doc.xpath(ur'//*[@id="%s"]' % style_id if "'" in style_id else ur"//*[@id='%s']" % style_id)
-                if len(els) == 0:
-                    print("Warning: Style/StyleMap not found with id '%s'" % style_id, file=out_diag)
+        return folder_list
+
+    def folderize(self, doc, folder_kmlids, limit):
+
+            if self.args.verbose > 3:
+                print("{name:20s} {place:20s} {inout:6s} {per:7s}   {dump:s}".format(
+                    name="Boundry",
+                    place="Placemark",
+                    inout="in/out",
+                    per="Contain",
+                    dump="Deatil (begins, ends, any, all,count,total,seg)"),
+                    file=self.out_diag)
+
+                print("{name:20s} {place:20s} {inout:6s} {per:7s}   {dump:s}".format(
+                    name="-" * 20,
+                    place="-" * 20,
+                    inout="-" * 6,
+                    per="-" * 7,
+                    dump="-" * 47),
+                    file=self.out_diag)
+
+            folders = self.find_boundry_folders(doc, folder_kmlids)
+
+            boundry_map = {}
+
+            for folder in folders:
+                boundry_map[folder.polygon] = True
+                folder.new_children = []
+
+            points = 0
+
+            els = self.xp(doc, all_placemarks)
+            for i, el in enumerate(els):
+                self.reporter.counter('placemarks_tested', i, total=len(els))
+                self.reporter.counter('points_tested', points * len(folders))
+                if el in boundry_map:
                     continue
-                el = els[0]
 
-                i = 0
-                new_id = style_id
-                while len(doc.xpath(ur'//*[@id="%s"]' % style_id if "'" in style_id else ur"//*[@id='%s']" % style_id)):
-                    i += 1
-                    new_id = "id-%3d" % i
-                if i > 0:
-                    style_url_ref.getparent().styleUrl = objectify.StringElement('#' + new_id)
-                    el.attrib['id'] = new_id
+                row = self.table.row(el) if self.table is not None else None
+                if row is not None:
+                    coords = self.table.points(row)
+                else:
+                    coords_text = " ".join(self.xp(el, ur'.//kml:coordinates/text()'))
+                    coords = parse_coords(coords_text)
 
-                doc_el.insert(style_pos_index, els[0])
+                points += len(coords)
 
+                folder = self.containing_folder(coords, folders, limit)
+                if folder is not None:
+                    folder.element.append(el)
+                    folder['new_children'].append(el)
+                    if row is not None:
+                        self.table.move(row, folder.element)
 
-def parse_kml(kml_file, diag_file=sys.stderr, exit_on_parse_error=False, exit_on_error=True):
+            self.print_folderize_summary(len(els), points, folders)
 
-    kml_etree = None
+    def containing_folder(self, coords, folders, limit):
+        """
+        the boundary folder containing the largest fraction of coords, None if no folder contains at least limit
+        """
+        in_folders = []
+        for folder in folders:
+            bounds = folder.complex
 
-    try:
-        kml_etree = kmlparser.parse(kml_file)
+            points_in = 0
+            for point in coords:
+                points_in += 1 if bounds.is_point_in(point[0],point[1]) else 0
 
-    except lxml_etree.XMLSyntaxError, e:
-        print("KMLUTIL ERROR: an xml parsing error was encountered while interpreting input kml data, unable to continue", file=diag_file)
-        print("MESSAGE: %s" % e.message, file=diag_file)
-        if args.reraise_errors:
-            raise
-        raise KMLError("Error parsing kml document")
+            if points_in:
+                in_folders.append([float(points_in) / len(coords), folder])
 
-    except IOError, e:
-        print("KMLUTIL ERROR: an I/O error was encountered while reading input, unable to continue", file=diag_file)
-        print("MESSAGE: %s" % e.message, file=diag_file)
-        if args.reraise_errors:
-            raise
-        raise KMLError("Error reading kml document")
+        if len(in_folders):
+            # ties go to the first folder given
+            ratio, folder = max(in_folders, key=lambda in_folder: in_folder[0])
+            if ratio >= limit:
+                return folder
+        return None
 
-    return kml_etree
+    def print_folderize_summary(self, placemarks, points, folders):
+        if self.args.verbose >= 1:
+            msg = "Folderization processed {placemarks:d} placemarks with {points:d} coordinates against {folders:d} folders"
+            print(msg.format(placemarks=placemarks, points=points, folders=len(folders)), file=self.out_diag)
+            for folder in folders:
+                print("Folder: '{name:s}' children appended: {appended:d}".format(name=folder.name, appended=len(folder.new_children)), file=self.out_diag)
+
+    def folderize_stored(self, store, doc, folder_kmlids, limit):
+        """
+        folderize() for a document with its placemarks in a FeatureStore, only the placemarks with an envelope that
+        overlaps one of the boundaries are read back from the store
+        """
+        folders = self.find_boundry_folders(doc, folder_kmlids, find_polygon=store.first_polygon)
+        bounds = []
+        for folder in folders:
+            folder.new_children = []
+            points = [point for ring in folder.outer for point in ring]
+            if points:
+                xs, ys = zip(*points)[:2]
+                bounds.append((min(xs), max(xs), min(ys), max(ys)))
+
+        placemarks = points = 0
+        moves = []
+        for seq, el in store.features_in(bounds, exclude=[store.fetched[folder.polygon] for folder in folders]):
+            self.reporter.counter('placemarks_tested', placemarks, total=store.count)
+            self.reporter.counter('points_tested', points * len(folders))
+            placemarks += 1
+
+            coords = parse_coords(" ".join(self.xp(el, ur'.//kml:coordinates/text()')))
+            points += len(coords)
 
+            folder = self.containing_folder(coords, folders, limit)
+            if folder is not None:
+                moves.append((seq, folder.element))
+                folder['new_children'].append(seq)
 
-def nicify(it):
-    return re.sub(ur'^(\d+\.\d$|\d+|\d+\.\d\d)(?:\.\d|\d*)$', ur'\1', str(it)) if isinstance(it, float) else str(it)
+        store.append_to(moves)
+        self.print_folderize_summary(placemarks, points, folders)
 
+    def rename_placemarks(self, doc, renames):
+        for (kml_id, new_name) in renames:
+            nodes = self.list_nodes(doc, kml_id)
+            if self.args.verbose > 1:
+                print("renaming {0:d} item(s) to '{1:s}'".format(len(nodes), new_name), file=self.out_diag)
+            for node in nodes:
+                node.name = objectify.StringElement(new_name)
 
-def get_path_style_stats(doc):
-    path_style_map = {}
-    cache = {}
+    def delete_nodes(self, doc, kml_ids):
 
-    for idx, el in enumerate(util.xp(doc, all_placemark_paths)):
-        place = Placemark(el, doc)
-        if not place.has_coords():
-            continue
-        parts = place.get_path_color_width_opacity(cache=cache)
-        sig = '-'.join([nicify(it) if isinstance(it, float) else str(it) for it in parts]) if len(parts) else 'UNSTYLED'
+        nodes = self.list_nodes(doc, kml_ids)
 
-        if sig not in path_style_map:
-            path_style_map[sig] = {'sig': sig, 'count': 1, 'color': parts[0], 'width': parts[1], 'opacity': parts[2]}
-        else:
-            path_style_map[sig]['count'] += 1
+        print("Deleteing %d item(s)" % len(nodes), file=self.out_diag)
 
-    return path_style_map
+        for node in reversed(nodes):
 
+            if self.args.verbose > 1:
+                print("Deleteing %d item(s) named '%s'" % (len(nodes), node.name), file=self.out_diag)
 
-def process(options):
-    """
+            node.getparent().remove(node)
 
-    :rtype : None
-    """
-    global args, verboseness, out_diag, out_stats, out_kml
-
-    args = options
-    if args.verbose > 0:
-        # print('Setting util verbosity to '+repr(args.verbose), file=out_diag)
-        util.set_verbosity(args.verbose)
-
-    # error messages and 'verbose' output
-    out_diag = (open(os.devnull, 'w') if options['out_diag'] is None else options['out_diag']) if "out_diag" in options else sys.stderr
-    # statistics
-    out_stats = (open(os.devnull, 'w') if options['out_stats'] is None else options['out_stats']) if "out_stats" in options else sys.stderr
-    # output kml
-    out_kml = (open(os.devnull, 'w') if options['out_kml'] is None else options['out_kml']) if "out_kml" in options else sys.stdout
-    # output kml meta-data (feature names, sizes etc)
-    out_list = (open(os.devnull, 'w') if options['out_list'] is None else options['out_list']) if "out_list" in options else sys.stderr
-    # output of namespace map
-    out_nsmap = (open(os.devnull, 'w') if options['out_nsmap'] is None else options['out_nsmap']) if "out_nsmap" in options else sys.stderr
-
-    # 0 - no output other than ERROR:
-    # >=1 - PARAM:    parameter
-    # >=2 - PROGRESS: progress output ["-v -v" or "-vv"]
-    # >=3 - DETAIL:   detailed output
-    # >=4 - DEBUG:    debugging output
-    # >=5 - TRACE:    detailed debugging output
-    verboseness = args.verbose
-    v1 = args.verbose >= 1
-    v2 = args.verbose >= 2
-    v3 = args.verbose >= 3
-    # v4 = args.verbose >= 4
-    v5 = args.verbose >= 5
-
-    kml_et = parse_kml(args.kmlfile, diag_file=out_diag, exit_on_parse_error=True)
-    kml_doc = kml_et.getroot()
-    pre_stats = None
-    pre_stats_points = {}
-
-    if args.stats:
-        if v1:
-            print("PROGRESS: recording 'before' statistics", file=out_diag)
-        pre_stats = doc_stats(kml_doc)
-        pre_stats_points = doc_stats(kml_doc, points=True)
+    def extract_nodes(self, doc, kml_ids):
 
-    if args.combine:
-        combine_kml(kml_doc, args.combine, args.combine_filter)
+        nodes = self.list_nodes(doc, kml_ids)
 
-    if args.multi_flatten:
-        multi_flatten(kml_doc)
+        if self.args.verbose > 1:
+            print("Located %d features to extract" % len(nodes), file=self.out_diag)
 
-    if args.extract:
-        extract_nodes(kml_doc, args.extract)
+        all_top_level = doc.xpath(top_level_folder_or_placemarks)
 
-    if args.paths_only:
-        paths_only(kml_doc)
+        for node in reversed(all_top_level):
+            node.getparent().remove(node)
 
-    if args.delete:
-        delete_nodes(kml_doc, args.delete)
+        document_element = self.xp(doc, ur'/*/kml:Document')[0]
 
-    if args.delete_styles:
-        remove_all_styles(kml_doc)
+        for node in nodes:
+            document_element.append(node)
 
-    if len(args.rename):
-        rename_placemarks(kml_doc, args.rename)
+    def paths_only(self, doc):
+        paths = self.xp(doc, all_placemark_paths)
+
+        if self.args.verbose > 1:
+                print("Located %d paths" % len(paths), file=self.out_diag)
+
+        all_top_level = doc.xpath(top_level_folder_or_placemarks)
+
+        for node in reversed(all_top_level):
+            node.getparent().remove(node)
+
+        document_element = doc.xpath(ur'/*/*[local-name()="Document"]')[0]
+
+        for path in paths:
+            document_element.append(path)
+
+    def remove_all_styles(self, doc):
+        nodes = doc.xpath(all_style_data)
+
+        if self.args.verbose > 1:
+                print("Deleteing %d style related item(s)" % len(nodes), file=self.out_diag)
+
+        for node in reversed(nodes):
+            node.getparent().remove(node)
+
+    def lister(self, element, filter_list, tree=False, indent=0, recursive=True, children_only=False):
+        node_list = []
+
+        for el in self.xp(element, ur'kml:Document|kml:Folder|kml:Placemark'):
+            el_tag = el.tag.split('}')[-1]
+            name = unicode(el.name if hasattr(el, 'name') else u'UNNAMED')
+            type_list = self.xp(el, ur'kml:LineString|kml:Point|kml:Polygon|kml:LinearRing|kml:MultiGeometry/kml:LineString|' +
+                                'kml:MultiGeometry/kml:Point|kml:MultiGeometry/kml:Polygon|kml:MultiGeometry/kml:LinearRing')
+            if el_tag in ['Folder', 'Document']:
+                type_tag = el_tag
+            elif len(type_list) == 0:
+                type_tag = 'UNKNOWN'
+            else:
+                type_tag = type_list[0].tag.split('}')[-1]
+            node_item = None
+            if not children_only and list_filter(type_tag, filter_list):
+                node_item = AttrDict({
+                    'name': name,
+                    'type': list_type_mapper(type_tag),
+                    'indent': indent,
+                    'el': el
+                })
+                if self.args.list_detail and (node_item.type == 'Path' or node_item.type == 'Polygon'):
+                    row = self.table.row(el) if self.table is not None else None
+                    if row is not None:
+                        parts = self.table.parts(row)
+                        els = [parts[0]] if len(parts) else None
+                    else:
+                        els = self.xp(el, ur'.//kml:coordinates/text()')
+                    if els is not None and len(els):
+                        coords = self.table.part_points(els[0]) if row is not None else parse_coords(els[0])
+                        if len(coords) > 1:
+                            node_item.count = len(coords)
+                            node_item.length = path_length(coords)
+                node_list.append(node_item)
+            if recursive and (el_tag == 'Folder' or el_tag == 'Document'):
+                nodes = self.lister(el, filter_list, tree=tree, indent=indent + (0 if children_only else 1), recursive=recursive)
+                node_list += nodes
+                if node_item and self.args.list_detail:
+                    node_item.length = sum([node.length if 'length' in node and node.type == 'Path' else 0 for node in nodes])
+                    node_item.count = sum([node.count if 'count' in node else 0 for node in nodes])
+        return node_list
+
+    def kml_id_to_xpath(self, kml_id):
+
+        if kml_id.startswith(('.', '/')):
+            return kml_id
+        elif kml_id.startswith('@'):
+            name = kml_id[1:]
+            if name == 'Path':
+                name = 'LineString'
+            elif name == 'Waypoint':
+                name = 'Point'
+            if name == 'Folder':
+                return './/kml:Folder'
+            elif name in ['Point', 'Polygon', 'LineString', 'LinearRing', 'MultiGeometry', 'Model']:
+                return ur'.//*[kml:{type:s}]'.format(type=name)
+            elif name in ['Folder']:
+                return ur'.//kml:Folder'
+            print("WARNING: unknown feature type '%s'" % name, file=self.out_diag)
+            return 'UNKNOWN_FEATURE_TYPE'
+        elif kml_id.startswith('&'):
+            return folder_or_placemark_by_name.format(name=encode4xpath(kml_id[1:]))
+        elif kml_id.startswith('%'):
+            pat = kml_id[1:].split('*')
+            if len(pat) > 2:
+                print("ERROR: only one * (wildcard) is permitted in a name pattern", file=self.out_diag)
+                sys.exit(5)
+            if len(pat) == 1 or len(pat[1]) == 0:
+                return folder_or_placemark_by_name_starts_with.format(part0=encode4xpath(pat[0]))
+            if len(pat[0]) == 0 and len(pat[1]):
+                return folder_or_placemark_by_name_ends_with.format(part0=encode4xpath(pat[1]))
+            else:
+                return folder_or_placemark_by_name_match.format(part0=encode4xpath(pat[0]), part1=encode4xpath(pat[1]))
+
+        return folder_or_placemark_by_name.format(name=encode4xpath(kml_id))
+
+    def list_nodes(self, doc, kml_ids):
+        if not isinstance(kml_ids, list) and not isinstance(kml_ids, tuple):
+            kml_ids = [kml_ids]
+
+        if self.index is not None:
+            nodes = self.index.find(doc, kml_ids)
+            if nodes is not None:
+                return nodes
+
+        xpaths = map(self.kml_id_to_xpath, kml_ids)
 
-    if args.serialize_names:
-        i = 0
-        if v1:
-            print("PROGRESS: rename paths that are named 'Path' or 'Untitled Path' to add a serial number at least", file=out_diag)
-        for element in util.xp(kml_doc, placemark_2name_and_type_xpath.format(name1="'Path'",
-                                                                              name2="'Untitled Path'",
-                                                                              type="LineString")):
-            element.name = objectify.StringElement("Path %d" % i)
-            i += 1
-
-    if args.region:
-        if args.region_file and args.verbose > 1:
-            print("PROGRESS: parsing region document ", file=out_diag)
         try:
-            regions_et = kmlparser.parse(args.region_file if args.region_file else args.kmlfile)
-        except IOError, e:
-            print("KMLUTIL ERROR: Unable to read external region kml document", file=out_diag)
-            if args.reraise_errors:
-                raise
-            raise KMLError("External region document not readable")
-        except lxml_etree.XMLSyntaxError, e:
-            info = {
-                'file': e.filename if e.filename is not None else 'n/a',
-                'line': str(e.lineno) if e.lineno is not None else 'n/a',
-                'offset': str(e.offset) if e.offset is not None else 'n/a',
-                'message': str(e.message) if e.message is not None else 'n/a',
-            }
-            print("KMLUTIL ERROR: Error parsing external region kml document: file: '{file}' line {line} offset {offset} message '{message}' ".format(**info), file=out_diag)
-            if args.reraise_errors:
+            nodes = self.xp(doc, '|'.join(xpaths))
+        except lxml_etree.XPathEvalError, e:
+            print("KMLUTIL ERROR: invalid xpath expression", file=self.out_diag)
+            if self.args.debug:
+                print("DEBUG: Expression '%s'" % xpaths, file=self.out_diag)
+                for attr in ['level_name', 'file', 'line', 'column', 'type_name']:
+                    if hasattr(e.error_log.last_error, attr):
+                        print("DEBUG:     %s: %s" % (attr, repr(getattr(e.error_log.last_error, attr))), file=self.out_diag)
+            if self.args.reraise_errors:
                 raise
-            raise KMLError("External region document not parsable")
+            raise KMLError("Error evaluating xpath expression")
+        return nodes
 
-        regions_doc = regions_et.getroot()
+    def dump(self, kml_doc, line_name, out_list=sys.stdout):
 
-        if v1:
-            print("PROGRESS: searching for cropping region named: '%s'" % args.region, file=out_diag)
+        node_list = self.list_nodes(kml_doc, line_name)
 
-        region = Placemark.find_by_name_and_type(args.region, "Polygon", regions_doc)
-        if region is not None and len(region):
-            if v1:
-                print("PROGRESS: Found region Polygon with %d coords" % len(region.coordinates), file=out_diag)
+        for node in node_list:
+            placemark = Placemark(node, kml_doc, out_diag=self.out_diag)
+            if self.args.verbose:
+                name = placemark.get_name()
+                print("# %s" % "<unnamed>" if name is None else name, file=self.out_diag)
+            for point in placemark.coordinates:
+                print(u','.join(map(unicode, point)), file=out_list)
+
+    def preprint(self, message=None, out_file=sys.stdout):
+        str_match = self.preprint_buf is not None and message is not None and self.preprint_buf == message and self.preprint_file == out_file
+        if self.preprint_count > 0 and not str_match:
+            print(self.preprint_buf + ('' if self.preprint_count == 1 else ' [%d occurances]' % self.preprint_count), file=self.preprint_file)
+            self.preprint_count = 0
+        if str_match:
+            self.preprint_count += 1
         else:
-            folder = Placemark.find_folder_by_name(args.region, regions_doc)
-            if folder is not None:
-                region = Placemark.find_by_type("Polygon", folder)
-                if region and args.verbose > 1:
-                    print("PROGRESS: Found region Folder with Polygon with %d coords" % len(region.coordinates), file=out_diag)
+            self.preprint_count = 0 if message is None else 1
+            self.preprint_file = out_file
+            self.preprint_buf = message
+
+    def print_list(self, doc, filter_list, tree=False, xpaths=False, list_format='text', out_list=sys.stdout):
+
+        # map filter alias to real kml terms
+        mapped_filter = filter_list
+        if filter_list is not None:
+            for term in filter_list.split(','):
+                term_to_add = term
+                for aliased_term, terms in alias_map.iteritems():
+                    if term in terms:
+                        term_to_add = aliased_term
+                        break
+                mapped_filter = term_to_add
+
+        if hasattr(doc, 'Document'):
+            root = doc.Document
+        elif hasattr(doc, 'Folder'):
+            root = doc.Folder
+        else:
+            raise KMLError("Unsupported document root")
+
+        node_list = self.lister(root, mapped_filter, tree=True, children_only=False)
+        etree = lxml_etree.ElementTree(doc) if xpaths else None
 
-        if region is None or len(region) == 0:
-            print("KMLUTIL ERROR: Unable to find suitable region with name '%s'" % args.region, file=out_diag)
-            raise KMLError("Region not found")
+        if list_format == 'json':
 
-        if v2:
-            print("PROGRESS: comparing all Placemark elements against region", file=out_diag)
+            serializable_list = []
+            for node in node_list:
+                serializable_node = dict(node)
+                serializable_node.pop('el', None)
+                if xpaths:
+                    serializable_node['xpath'] = etree.getpath(node.el)
+                serializable_list.append(serializable_node)
+            json.dump(serializable_list, out_list, indent=2 if self.args.pretty_print else None, default=filtering_json_default)
 
-        for el in util.xp(kml_doc, all_placemarks):
-            placemark = Placemark(el, kml_doc)
-            if v3 and not v5:
-                print("TRACE: Element '%s' with %d coordinates" % (placemark.name, len(placemark.coordinates)), file=out_diag)
+        else:
 
-            if placemark.is_path_or_multipath():
-                if args.optimize_paths:
-                    placemark.simplify_path()
-                elif args.optimize_coordinates:
-                    placemark.optimize_coordinates()
+            name_len = 0
+            type_len = 0
+            for node in node_list:
+                if len(node.name) > name_len:
+                    name_len = len(node.name) + (node.indent * 2 if tree else 0)
+                type_len = len(node.type) if len(node.type) > type_len else type_len
+
+            line = u"{name:<{name_width:d}s} {type:<{type_width:d}s}"
+
+            for node in node_list:
+                name = (u"  " * node.indent if tree else u'') + node.name
+                if self.args.list_detail and 'length' in node:
+                    detail = line + u" {count:6d} {length:7.2f}km {rate:7.2f}m/pt" + (u" {xpath:s}" if xpaths else u"")
+                    rate = node.length / node.count * 1000 if node.count > 0 else 0.0
+                    model = {
+                        "name_width": name_len,
+                        "name": name,
+                        "type": node.type,
+                        "type_width": type_len,
+                        "count": node.count,
+                        "length": node.length,
+                        "rate": rate,
+                        "xpath": etree.getpath(node.el) if xpaths else u""
+                    }
+                    self.preprint(detail.format(**model), out_file=out_list)
+                else:
+                    simple = line + (u" {xpath:s}" if xpaths else u"")
+                    model = {
+                        "name_width": name_len,
+                        "name": name,
+                        "type": node.type,
+                        "type_width": type_len,
+                        "xpath": etree.getpath(node.el) if xpaths else u""
+                    }
+                    self.preprint(simple.format(**model), out_file=out_list)
+
+            self.preprint(None)
+
+    def style_hash(self, style_id, refs=None):
+        """
+        hash of the canonical form of a shared Style/StyleMap, a StyleMap's styleUrls are replaced by the hash of the
+        style they refer to so StyleMaps referring to duplicate styles are duplicates themselves
+        """
+        styles = self.style_dir['styles']
+        sig, el = styles[style_id]
+        if sig is None:
+            import hashlib
+            styles[style_id] = ('', el)  # a StyleMap referring to itself gets the empty hash for the reference
+
+            def resolve(url):
+                if url.startswith('#') and url[1:] in styles:
+                    return u'#' + self.style_hash(url[1:]).encode('hex')
+                if url.startswith('#'):
+                    print('Error: style not found with id of "%s"' % url[1:], file=self.out_diag)
+
+            sig = hashlib.sha1(style_canonical(el, resolve, refs).encode('utf-8')).digest()
+            styles[style_id] = (sig, el)
+            self.style_dir['uniques'].setdefault(sig, []).append(style_id)
+        return sig
+
+    def optimize_styles(self, doc):
+        """
+        merge shared styles (Style and StyleMap elements with an id in a Document) with identical content, rename
+        them S1, S2, ... and remove the ones no feature uses, inline styles are left alone
+        """
+        from collections import OrderedDict
+        style_dir = self.style_dir
+        # ordered so the new ids are numbered in document order
+        style_dir['styles'] = OrderedDict()
+        style_dir['uniques'] = OrderedDict()
+        ids = style_dir['ids']
+        style_urls = []
+
+        # one walk of the document collects the shared styles and the styleUrls
+        for el in doc.iter('{*}Style', '{*}StyleMap', '{*}styleUrl'):
+            if util.tag(el) == 'styleUrl':
+                style_urls.append(el)
+            elif 'id' in el.attrib and util.tag(el.getparent()) == 'Document':
+                style_dir['styles'][el.attrib['id']] = (None, el)
+        for idattr in doc.xpath(ur'//@id', smart_strings=False):
+            if idattr not in style_dir['styles']:
+                ids[idattr] = True
+
+        # styleUrls inside shared styles, by style id
+        inner_urls = {}
+        style_detail = self.args.verbose > 4
+        for style_id in style_dir['styles'].keys():
+            refs = []
+            self.style_hash(style_id, refs)
+            inner_urls[style_id] = refs
+            if style_detail:
+                print(ur'%30s - %s' % (style_id, style_dir['styles'][style_id][0].encode('hex')), file=self.out_diag)
+        if style_detail:
+            print(ur'Styles:%d uniques:%d' % (len(style_dir['styles']), len(style_dir['uniques'])), file=self.out_diag)
+
+        # the first of each set of duplicates is kept and renamed
+        new_ids = self.unused_ids('S', ids)
+        old2new = style_dir['old2new']
+        for style_ids in style_dir['uniques'].values():
+            sid = next(new_ids)
+            style_dir['styles'][style_ids[0]][1].attrib['id'] = sid
+            for oldid in style_ids:
+                old2new[oldid] = sid
+
+        # a style is used if a feature refers to it or a used StyleMap does
+        inner = set(ref for refs in inner_urls.values() for ref in refs)
+        new2old = dict((old2new[style_ids[0]], style_ids[0]) for style_ids in style_dir['uniques'].values())
+        used = set()
+        pending = [ref for ref in style_urls if ref not in inner]
+        while pending:
+            ref = pending.pop()
+            url = (ref.text or '').strip()
+            if not url.startswith('#') or url[1:] not in old2new:
+                continue
+            sid = old2new[url[1:]]
+            if ref.text != '#' + sid:
+                ref.getparent().styleUrl = objectify.StringElement('#' + sid)
+            if sid not in used:
+                used.add(sid)
+                pending.extend(inner_urls[new2old[sid]])
+
+        # remove duplicates and unused styles
+        for style_id, (_, el) in style_dir['styles'].items():
+            if old2new[style_id] not in used or el.attrib['id'] != old2new[style_id]:
+                el.getparent().remove(el)
+
+    def optimize_styles_stored(self, store, doc):
+        """
+        optimize_styles() for a document with its placemarks in a FeatureStore, the styleUrls and ids of the stored
+        placemarks are represented by temporary stub placemarks while the styles are optimized
+        :return: dict of old styleUrl: new styleUrl for the stored placemarks
+        """
+        documents = list(doc.iter('{*}Document'))
+        holder = documents[0] if documents else doc
+        placemark_tag = holder.tag[:holder.tag.rfind('}') + 1] + 'Placemark'
+        stubs = []
+        for url in sorted(store.style_urls):
+            stub = objectify.SubElement(holder, placemark_tag)
+            stub.styleUrl = objectify.StringElement(url)
+            stubs.append((url, stub))
+        id_stubs = [objectify.SubElement(holder, placemark_tag, id=style_id) for style_id in sorted(store.style_ids)]
+
+        self.optimize_styles(doc)
+
+        style_map = dict((url, stub.styleUrl.text) for url, stub in stubs)
+        for stub in [stub for _, stub in stubs] + id_stubs:
+            holder.remove(stub)
+        return style_map
 
-            detail = placemark.in_region(region, detail=True)
-            any_in = detail[2] if isinstance(detail, tuple) else False
+    @staticmethod
+    def unused_ids(prefix, taken):
+        """
+        generate the ids prefix1, prefix2, ... skipping the ones in taken
+        """
+        c = 0
+        while True:
+            c += 1
+            if prefix + str(c) not in taken:
+                yield prefix + str(c)
+
+    def hoist_styles(self, doc):
+        """
+        move the inline Style or StyleMap of placemarks into shared Document styles, placemarks with identical
+        inline styles share one, placemarks that also have a styleUrl or whose inline style has an id are left alone
+        """
+        import hashlib
+        if not hasattr(doc, 'Document'):
+            print("Warning: no Document element, inline styles were not moved", file=self.out_diag)
+            return
+        doc_el = doc.Document
+        content = doc_el.xpath(child_features)
+        style_pos_index = doc_el.index(content[0]) if len(content) else doc_el.countchildren()
+
+        new_ids = self.unused_ids('S', set(doc.xpath(ur'//@id', smart_strings=False)))
+        no_resolve = lambda url: None
+        hoisted = {}  # hash of the inline style: shared style id
+        count = 0
+        for placemark in list(doc.iter('{*}Placemark')):
+            selectors = []
+            has_url = False
+            for child in placemark.iterchildren():
+                if isinstance(child.tag, basestring):
+                    if util.tag(child) in ('Style', 'StyleMap'):
+                        selectors.append(child)
+                    elif util.tag(child) == 'styleUrl':
+                        has_url = True
+            if has_url or len(selectors) != 1 or 'id' in selectors[0].attrib:
+                continue
 
-            if verboseness > 3:
-                print("DEBUG: Checking Placemark '%32s' against region: in: %5s %5s %5s %5s %5d %5d %5d" %
-                      (placemark.get_name(), detail[0], detail[1], detail[2], detail[3], detail[4], detail[5], detail[6]), file=out_diag)
+            style = selectors[0]
+            sig = hashlib.sha1(style_canonical(style, no_resolve).encode('utf-8')).digest()
+            first = sig not in hoisted
+            if first:
+                hoisted[sig] = next(new_ids)
+            # styleUrl goes where the inline style was, the schema puts it right before the style selector
+            placemark.styleUrl = objectify.StringElement('#' + hoisted[sig])
+            style.addprevious(placemark.styleUrl)
+            if first:
+                style.attrib['id'] = hoisted[sig]
+                doc_el.insert(style_pos_index, style)
+                style_pos_index += 1
+            else:
+                placemark.remove(style)
+            count += 1
 
-            if not any_in:
-                placemark.delete()
+        if self.args.verbose:
+            print("%d inline styles were replaced by %d shared styles" % (count, len(hoisted)), file=self.out_diag)
 
-    else:
-        if args.optimize_paths:
-            for el in util.xp(kml_doc, all_placemark_paths):
-                placemark = Placemark(el, kml_doc)
-                if placemark.is_path_or_multipath():
-                    if args.optimize_paths:
-                        placemark.simplify_path()
-                    elif args.optimize_coordinates:
-                        placemark.optimize_coordinates()
-
-    if args.optimize_styles:
-        optimize_styles(kml_doc)
-
-    if args.stats:
+    def combine_kml(self, doc, combine_file, filters):
+        combine_et = self.parse_kml(combine_file, self.out_diag)
+
+        combine_doc = combine_et.getroot()
+
+        nodes = self.list_nodes(combine_doc, filters if len(filters) else [all_root_features])
+
+        if len(nodes) == 0:
+            print("Error", file=self.out_diag)
+
+        if self.args.verbose:
+            print("%d features were found in combine kml file" % len(nodes), file=self.out_diag)
+
+        doc_el = doc.Document
+
+        content = doc_el.xpath(child_features)
+        style_pos_index = doc_el.index(content[0]) if len(content) else max(0, doc_el.countchildren()-1)
+
+        # id lookups are done in dicts built once, an xpath search of the whole document for each reference made
+        # combining quadratic in the number of features
+        combine_ids = {}
+        for el in combine_doc.iter():
+            if isinstance(el.tag, basestring) and 'id' in el.attrib:
+                combine_ids.setdefault(el.attrib['id'], el)
+        doc_ids = set(doc.xpath(ur'//@id'))
+        moved = {}  # style id in the combine document: id after it was moved into doc
+
+        def move_style(style_ref):
+            style_id = style_ref.text[1:]
+            if style_id in moved:
+                new_id = moved[style_id]
+            else:
+                el = combine_ids.get(style_id)
+                if el is None:
+                    print("Warning: Style/StyleMap not found with id '%s'" % style_id, file=self.out_diag)
+                    return
+                if el.getroottree().getroot() != combine_doc:
+                    # already in doc, it was inside one of the features appended
+                    return
+
+                i = 0
+                new_id = style_id
+                while new_id in doc_ids:
+                    i += 1
+                    new_id = "%s-%03d" % (style_id, i)
+                if i > 0:
+                    el.attrib['id'] = new_id
+                doc_ids.add(new_id)
+                moved[style_id] = new_id
+
+                doc_el.insert(style_pos_index, el)
+
+                # StyleMaps can have styleUrl children so copy those over also
+                for style_url_ref in el.xpath(".//*[local-name()='styleUrl']"):
+                    move_style(style_url_ref)
+
+            if new_id != style_id:
+                style_ref.getparent().styleUrl = objectify.StringElement('#' + new_id)
+
+        for node in nodes:
+            doc_el.append(node)
+            doc_ids.update(node.xpath(ur'.//@id|@id'))
+
+            for style_ref in node.xpath(".//*[local-name()='styleUrl']"):
+                move_style(style_ref)
+
+    def parse_kml(self, kml_file, diag_file=sys.stderr, exit_on_parse_error=False, exit_on_error=True, store=None):
+        """
+        :param store: a FeatureStore to keep the placemarks in, the skeleton of the document is returned, see --max-memory
+        """
+
+        kml_etree = None
+
+        try:
+            # the same file may be parsed again, by --combine with itself
+            input_file = self.input_file(rewind=True) if kml_file == self.args.kmlfile else None
+            if input_file is not None:
+                in_file = progress.ProgressFile(input_file, self.reporter) if self.reporter.enabled else input_file
+                if store is not None:
+                    kml_etree = store.load(in_file)
+                else:
+                    name = os.path.splitext(os.path.basename(input_file.name))[0] if kml_file != '-' else None
+                    kml_etree = parse_input(in_file, geojson=geojsonreader.is_geojson(input_file), name=name)
+            elif store is not None:
+                kml_etree = store.load(kml_file)
+            else:
+                kml_etree = parse_input(kml_file)
+
+        except lxml_etree.XMLSyntaxError, e:
+            print("KMLUTIL ERROR: an xml parsing error was encountered while interpreting input kml data, unable to continue", file=diag_file)
+            print("MESSAGE: %s" % e.message, file=diag_file)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error parsing kml document")
+
+        except ValueError, e:
+            print("KMLUTIL ERROR: a json parsing error was encountered while interpreting input GeoJSON data, unable to continue", file=diag_file)
+            print("MESSAGE: %s" % e, file=diag_file)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error parsing GeoJSON document")
+
+        except IOError, e:
+            print("KMLUTIL ERROR: an I/O error was encountered while reading input, unable to continue", file=diag_file)
+            print("MESSAGE: %s" % e.message, file=diag_file)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error reading kml document")
+
+        return kml_etree
+
+    def print_stats(self, pre_stats, pre_stats_points, after, after_points, path_style_map, points=False, stats_format='text'):
+        """
+        output the before and after element counts, optionally coordinate point counts, and path style counts
+        :param pre_stats: element counts recorded before processing, see doc_stats()
+        :param pre_stats_points: coordinate point counts recorded before processing, see doc_stats()
+        :param after: element counts after processing
+        :param after_points: coordinate point counts after processing
+        :param path_style_map: path style counts, see get_path_style_stats()
+        :param points: include coordinate point counts
+        :param stats_format: 'text' or 'json'
+        """
         element_counts = []
         point_counts = []
         path_types = []
-        after = doc_stats(kml_doc)
         max_len = 0
         for key in pre_stats.iterkeys():
             max_len = len(key) if len(key) > max_len else max_len
-        if args.stats_format == 'text':
-            print("=== Counts by Element Type ===")
-            print((" {0:>%ds} {1:>7} {2:>7}  {3}" % max_len).format("Element", "Input", "Output", "Delta"), file=out_stats)
+        if stats_format == 'text':
+            print("=== Counts by Element Type ===", file=self.out_stats)
+            print((" {0:>%ds} {1:>7} {2:>7}  {3}" % max_len).format("Element", "Input", "Output", "Delta"), file=self.out_stats)
         line_format = " {0:>%ds} {1:>7} {2:>7}{3:8.2%%}" % max_len
         for e in sorted(pre_stats.iteritems(), key=operator.itemgetter(1), reverse=True):
             f = after[e[0]] if e[0] in after else 0
             p = float(e[1] - f) / float(e[1])
-            if args.stats_format == 'json':
+            if stats_format == 'json':
                 element_counts.append({
                     'tag': e[0],
                     'pre_count': e[1],
@@ -1400,20 +2106,18 @@ def process(options):
                     'percentage': "{0:8.2%}".format(p)
                 })
             else:
-                print(line_format.format(e[0], e[1], f, p), file=out_stats)
-
-        if args.optimize_paths or args.stats_detail:
-            after_points = doc_stats(kml_doc, points=True)
-            if args.stats_format == 'text':
-                print("")
-                print("=== Coordinate Point Count by Element Type ===", file=out_stats)
-                print((" {0:>%ds} {1:>7} {2:>7}  {3}" % max_len).format("Element", "Input", "Output", "Delta"), file=out_stats)
+                print(line_format.format(e[0], e[1], f, p), file=self.out_stats)
+
+        if points:
+            if stats_format == 'text':
+                print("", file=self.out_stats)
+                print("=== Coordinate Point Count by Element Type ===", file=self.out_stats)
+                print((" {0:>%ds} {1:>7} {2:>7}  {3}" % max_len).format("Element", "Input", "Output", "Delta"), file=self.out_stats)
             for e in sorted(pre_stats_points.iteritems(), key=operator.itemgetter(1), reverse=True):
                 if e[0] and int(e[1]):
                     f = after_points[e[0]] if e[0] in after_points else 0
                     p = float(e[1] - f) / float(e[1])
-                    if args.stats_format == 'json':
-                        pass
+                    if stats_format == 'json':
                         point_counts.append({
                             'tag': e[0],
                             'pre_count': e[1],
@@ -1421,56 +2125,739 @@ def process(options):
                             'percentage': "".format(p)
                         })
                     else:
-                        print(line_format.format(e[0], e[1], f, p), file=out_stats)
+                        print(line_format.format(e[0], e[1], f, p), file=self.out_stats)
 
-        if args.stats_format == 'text':
-            print("")
-            print("=== Path Style Counts === <color>-<width>-<opacity>", file=out_stats)
+        if stats_format == 'text':
+            print("", file=self.out_stats)
+            print("=== Path Style Counts === <color>-<width>-<opacity>", file=self.out_stats)
 
-        path_style_map = get_path_style_stats(kml_doc)
-        for sig in sorted(path_style_map.keys(), key=lambda x: -path_style_map[x]['count']):
+        for sig in sorted(path_style_map.keys(), key=lambda x: (-path_style_map[x]['count'], x)):
             data = path_style_map[sig]
-            if args.stats_format == 'json':
+            if stats_format == 'json':
                 path_types.append(data)
             else:
-                print("{0:>24s} {1:>6d}".format(sig, data['count']), file=out_stats)
+                print("{0:>24s} {1:>6d}".format(sig, data['count']), file=self.out_stats)
 
-        if args.stats_format == 'json':
+        if stats_format == 'json':
             print(json.dumps({
                 'element_counts': element_counts,
                 'point_counts': point_counts,
                 'path_style_counts': path_types
-            }, indent=4), file=out_stats)
+            }, indent=4), file=self.out_stats)
+
+    def stream_stats(self, kml_file, diag_file=sys.stderr):
+        """
+        calculate the same statistics as doc_stats() and get_path_style_stats() from parser events without building
+        the document tree, elements are discarded as soon as they have been tallied
+        :param kml_file: file path, url or file object
+        :return: tuple of (element counts, coordinate point counts, path style map, number of MultiGeometry paths)
+        """
+        collector = StatsCollector()
+        styles = StreamingStyleCollector()
+        placemark_depth = 0
+        path_has_coords = False
+
+        try:
+            for event, el in lxml_etree.iterparse(kml_file, events=('start', 'end'), huge_tree=True):
+                el_tag = el.tag.split('}')[-1]
+                if event == 'start':
+                    collector.start(el_tag)
+                    if el_tag == 'Placemark':
+                        placemark_depth += 1
+                        path_has_coords = False
+                    continue
 
-    if len(args.folderize):
-        folderize(kml_doc, args.folderize, args.folderize_limit)
+                collector.end(el_tag, el.text)
+
+                if el_tag == 'coordinates':
+                    if placemark_depth and el.text is not None and el.text.strip() != '':
+                        path_has_coords = True
+                    el.text = None
+                elif el_tag == 'Placemark':
+                    placemark_depth -= 1
+                    if path_has_coords and (StreamingStyleCollector._child(el, 'LineString') is not None or (
+                            StreamingStyleCollector._child(el, 'MultiGeometry') is not None and
+                            StreamingStyleCollector._child(StreamingStyleCollector._child(el, 'MultiGeometry'), 'LineString') is not None)):
+                        styles.add_path(el)
+                elif el_tag == 'MultiGeometry':
+                    styles.add_multi_geometry(el)
+                elif 'id' in el.attrib:
+                    styles.add_identified(el)
+
+                if not placemark_depth and el_tag in ('Placemark', 'Style', 'StyleMap', 'Folder'):
+                    parent = el.getparent()
+                    if parent is not None and util.tag(parent) != 'Pair':
+                        el.clear()
+                        while el.getprevious() is not None:
+                            del parent[0]
 
-    if args.optimize_styles:
-        objectify.deannotate(kml_doc, xsi_nil=True)
+        except lxml_etree.XMLSyntaxError, e:
+            print("KMLUTIL ERROR: an xml parsing error was encountered while interpreting input kml data, unable to continue", file=diag_file)
+            print("MESSAGE: %s" % e.message, file=diag_file)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error parsing kml document")
 
-    if args.validate_styles:
-        validate_styles(kml_doc)
+        except IOError, e:
+            print("KMLUTIL ERROR: an I/O error was encountered while reading input, unable to continue", file=diag_file)
+            print("MESSAGE: %s" % e.message, file=diag_file)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error reading kml document")
+
+        return collector.element_counts, collector.point_counts, styles.path_style_map(), styles.multi_paths
+
+    def input_file(self, rewind=False):
+        """
+        the input document opened once for the parser and the namespace table, memory mapped for local files, None for
+        urls, see kmlinput
+        :param rewind: start again at the beginning if the file was read, compressed files are opened again
+        """
+        if self.input is not None and rewind and self.input.tell():
+            if hasattr(self.input, 'seek'):
+                self.input.seek(0)
+            elif self.args.kmlfile != '-':
+                self.input = None
+        if self.input is None and kmlinput.is_local(self.args.kmlfile):
+            self.input = kmlinput.open_input(self.args.kmlfile)
+            self.opened_files.append(self.input)
+        return self.input
+
+    def list_namespaces(self):
+        nsmap = read_namespaces(self.input_file() or self.args.kmlfile)
+        if nsmap:
+            dump_namespace_table(nsmap, outfile=self.out_nsmap, table_format=self.args.list_format if 'list_format' in self.args else 'text')
+
+    def check_stdin(self):
+        """
+        stdin can only be read once, reject the options that would parse it again: --combine or --region-file '-' with
+        another document from stdin and --region without --region-file, which reads the regions from the input again
+        """
+        readers = [('the input', self.args.kmlfile)]
+        if self.args.combine:
+            readers.append(('--combine', self.args.combine))
+        if self.args.region:
+            readers.append(('--region-file', self.args.region_file) if self.args.region_file else
+                           ('--region without --region-file', self.args.kmlfile))
+        # --combine is opened by argparse, '-' is sys.stdin itself
+        from_stdin = [name for name, path in readers if path == '-' or path is sys.stdin]
+        if len(from_stdin) > 1:
+            print("KMLUTIL ERROR: stdin can only be read once, it is read by %s, save the document to a file to use it "
+                  "more than once" % ' and '.join(from_stdin), file=self.out_diag)
+            raise KMLError("stdin read more than once")
+
+    def namespaces_only(self):
+        """
+        True if the namespace table is the only output requested, it is read from the start of the file so the
+        document doesn't need to be parsed
+        """
+        return (self.args.namespaces and 'out_kml' in self.args and self.args.out_kml is None and self.kml_et is None and
+                not (self.args.stats or self.args.list or self.args.tree or len(self.args.dump_path) or self.args.validate_styles))
+
+    def indexed(self):
+        """
+        'extract', 'dump_path' or 'list', the option the features are selected for when the document is parsed using
+        the --index, None if the whole document is parsed, only local uncompressed kml files are indexed and features
+        are only selected by name, see DocumentIndex.plain_name()
+        """
+        if not ('index' in self.args and self.args.index) or self.kml_et is not None:
+            return None
+        kml_file = self.args.kmlfile
+        if not isinstance(kml_file, basestring) or not os.path.isfile(kml_file) or geojsonreader.is_geojson(kml_file):
+            return None
+        with open(kml_file, 'rb') as in_file:
+            if compression.detect(in_file.read(compression.magic_length)) is not None:
+                return None
+        if any(name in self.args and self.args[name] for name in indexed_unsupported):
+            return None
+        if self.args.extract:
+            mode = 'extract'
+        elif (any(name in self.args and self.args[name] for name in indexed_whole_document) or
+              not ('out_kml' in self.args and self.args.out_kml is None)):
+            return None
+        elif self.args.dump_path:
+            mode = 'dump_path'
+        elif self.args.list or self.args.tree:
+            return 'list'
+        else:
+            return None
+        kml_ids = self.args[mode] if isinstance(self.args[mode], (list, tuple)) else [self.args[mode]]
+        return mode if None not in map(DocumentIndex.plain_name, kml_ids) else None
+
+    def parallel_decoder(self):
+        """
+        a ParallelDecoder started on the input when --parse-jobs is used and the feature table is needed, None
+        otherwise, only local uncompressed kml files are decoded in parallel, see parallelparse
+        """
+        if not ('parse_jobs' in self.args and self.args.parse_jobs > 1) or self.kml_et is not None:
+            return None
+        if 'load_snapshot' in self.args and self.args.load_snapshot:
+            return None
+        if not (self.args.region or self.args.optimize_paths or self.args.stats or len(self.args.folderize) or
+                self.args.list_detail or
+                ('out_kml' in self.args and self.args.out_kml is not None and output_format(self.args) != 'kml')):
+            return None
+        kml_file = self.args.kmlfile
+        if not isinstance(kml_file, basestring) or not os.path.isfile(kml_file) or geojsonreader.is_geojson(kml_file):
+            return None
+        with open(kml_file, 'rb') as in_file:
+            if compression.detect(in_file.read(compression.magic_length)) is not None:
+                return None
+        return parallelparse.ParallelDecoder(kml_file, self.args.parse_jobs)
 
-    multies = kml_doc.xpath('//*[local-name()="MultiGeometry" and *[local-name()="LineString"]]')
-    if len(multies):
+    def note_multi_paths(self, count):
         print(('Note: your input file appears to contain %d MultiGeometry path%s which are poorly supported in many ' +
                'applications which accept KML files. You can use the use the --demulti-paths option to convert ' +
                'MultiGeometry paths to simple paths. This usually has little to no visual affect on typical file but it is ' +
                'possible that some data or meta-data will be lost or changed unexpectantly. Making a backup is' +
-               'strongly reccomended.') % (len(multies), '' if len(multies) == 1 else 's'))
+               'strongly reccomended.') % (count, '' if count == 1 else 's'), file=self.out_diag)
+
+    def pipelined(self):
+        """
+        True if the document is to be copied to the output by a Pipeline that applies --serialize-names and
+        --optimize-paths to one placemark at a time, see --pipeline, only local kml files and stdin are pipelined
+        """
+        if not ('pipeline' in self.args and self.args.pipeline) or self.kml_et is not None:
+            return False
+        unsupported = ['--' + name.replace('_', '-') for name in pipeline_unsupported if name in self.args and self.args[name]]
+        if output_format(self.args) != 'kml':
+            unsupported.append('--output-format ' + output_format(self.args))
+        if unsupported:
+            print("Note: the --pipeline was not used, these options need the whole document: %s" % ', '.join(unsupported), file=self.out_diag)
+            return False
+        if not ('out_kml' in self.args and self.args.out_kml is not None) or not kmlinput.is_local(self.args.kmlfile):
+            return False
+        if geojsonreader.is_geojson(self.input_file()):
+            print("Note: the --pipeline was not used, it only reads kml", file=self.out_diag)
+            return False
+        return True
+
+    def _process_pipelined(self):
+        """
+        _process() for a document copied to the output by a Pipeline, see pipelined()
+        """
+        v1 = self.args.verbose >= 1
+        parser = objectify.makeparser(strip_cdata=False, huge_tree=True)
+        counts = {'serial': 0, 'multies': 0}
+
+        def transform(xml):
+            # the paths of the part in the order _process() changes them, the parts are transformed in document order
+            if 'LineString' not in xml:
+                return None
+            el = objectify.fromstring(xml, parser)
+            counts['multies'] += len(el.xpath(part_multi_paths))
+            changed = False
+            if self.args.serialize_names:
+                for element in self.xp(el, part_serial_paths):
+                    element.name = objectify.StringElement("Path %d" % counts['serial'])
+                    counts['serial'] += 1
+                    changed = True
+            if self.args.optimize_paths:
+                for path_el in self.xp(el, part_placemark_paths):
+                    placemark = Placemark(path_el, out_diag=self.out_diag)
+                    if placemark.is_path_or_multipath():
+                        placemark.simplify_path(self.args.path_error_limit, self.args.optimize_coordinates)
+                        changed = True
+            return el if changed else None
+
+        if self.args.namespaces:
+            self.list_namespaces()
+
+        input_file = self.input_file(rewind=True)
+        in_file = progress.ProgressFile(input_file, self.reporter) if self.reporter.enabled else input_file
+        pipe = pipeline.Pipeline(in_file, self.out_kml, transform)
+        try:
+            with self.stage('pipeline'):
+                pipe.run()
+        except lxml_etree.XMLSyntaxError, e:
+            print("KMLUTIL ERROR: an xml parsing error was encountered while interpreting input kml data, unable to continue", file=self.out_diag)
+            print("MESSAGE: %s" % e.message, file=self.out_diag)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error parsing kml document")
+        except IOError, e:
+            print("KMLUTIL ERROR: an I/O error was encountered while reading input, unable to continue", file=self.out_diag)
+            print("MESSAGE: %s" % e, file=self.out_diag)
+            if self.args.reraise_errors:
+                raise
+            raise KMLError("Error reading kml document")
 
-    if args.dump_path:
-        dump(kml_doc, args.dump_path, out_list=out_list)
-    elif args.tree or args.list:
-        print_list(kml_doc, args.filter, tree=args.tree, out_list=out_list, xpaths=args.list_with_xpaths, list_format=args.list_format if 'list_format' in args else 'text')
+        if v1:
+            print("PROGRESS: %d features and other parts in %d chunks copied by the pipeline, %d changed" %
+                  (pipe.items, pipe.chunks, pipe.changed), file=self.out_diag)
+        if counts['multies']:
+            self.note_multi_paths(counts['multies'])
+
+    def parse_indexed(self, mode):
+        """
+        parse the parts of the input the mode needs, see indexed(), the index is loaded from the sidecar file or built
+        and saved, None if the document can't be indexed
+        """
+        v1 = self.args.verbose >= 1
+        kml_file = self.args.kmlfile
+        index_path = kmlindex.index_path(kml_file)
+        input_file = self.input_file()
+
+        with self.stage('load_index'):
+            index, reason = kmlindex.KMLIndex.load(index_path, kml_file)
+        if index is None:
+            if v1:
+                print("PROGRESS: building the index '%s', %s" % (index_path, reason), file=self.out_diag)
+            try:
+                with self.stage('build_index'):
+                    index = kmlindex.KMLIndex.build(input_file.buffer, kml_file)
+            except ValueError, e:
+                print("Note: the document is parsed without an index, %s" % e, file=self.out_diag)
+                return None
+            try:
+                index.save(index_path)
+            except IOError, e:
+                print("Note: the index could not be saved to '%s', %s" % (index_path, e.strerror), file=self.out_diag)
+        if mode == 'extract' and index.nested_documents():
+            # extracting keeps the Documents in the Document, with all they hold
+            print("Note: the document is parsed without an index, --extract needs all of its nested Documents", file=self.out_diag)
+            return None
 
-    if args.namespaces:
-        nsmap = read_namespaces(args.kmlfile)
-        if nsmap:
-            dump_namespace_table(nsmap, outfile=out_nsmap, table_format=args.list_format if 'list_format' in args else 'text')
+        selected = None
+        if mode != 'list':
+            kml_ids = self.args[mode] if isinstance(self.args[mode], (list, tuple)) else [self.args[mode]]
+            selected = index.select(map(DocumentIndex.plain_name, kml_ids))
+        with self.stage('parse_kml') as record:
+            fragments = StringIO(index.document(input_file.buffer, selected))
+            kml_et = self.parse_kml(fragments, diag_file=self.out_diag, exit_on_parse_error=True)
+            record.doc = kml_et.getroot()
+        if v1 and selected is None:
+            print("PROGRESS: the names and types of %d features parsed using the index '%s'" % (len(index), index_path), file=self.out_diag)
+        elif v1:
+            print("PROGRESS: %d of %d features parsed using the index '%s'" % (len(selected), len(index), index_path), file=self.out_diag)
+        return kml_et
+
+    def stored(self):
+        """
+        True if the placemarks are to be kept in a FeatureStore because the parsed document would need more than
+        --max-memory, only local kml files are stored
+        """
+        if not ('max_memory' in self.args and self.args.max_memory) or self.kml_et is not None:
+            return False
+        kml_file = self.args.kmlfile
+        if not isinstance(kml_file, basestring) or not os.path.isfile(kml_file) or geojsonreader.is_geojson(kml_file):
+            return False
+        return os.path.getsize(kml_file) * tree_bytes_per_file_byte > self.args.max_memory * 1024 * 1024
+
+    def _process_stored(self):
+        """
+        _process() for a document with its placemarks in a FeatureStore, see stored()
+        """
+        v1 = self.args.verbose >= 1
+
+        unsupported = ['--' + name.replace('_', '-') for name in stored_unsupported if name in self.args and self.args[name]]
+        if output_format(self.args) != 'kml':
+            unsupported.append('--output-format ' + output_format(self.args))
+        if unsupported:
+            print("KMLUTIL ERROR: the document is larger than --max-memory allows and these options need all of it in "
+                  "memory: %s" % ', '.join(unsupported), file=self.out_diag)
+            raise KMLError("Options not supported for documents larger than --max-memory")
 
-    if out_kml is not None:
-        if args.geojson:
-            export_geojson(kml_doc, pretty=args.pretty_print, out_file=out_kml)
-        else:
-            kml_et.write(out_kml, pretty_print=args.pretty_print)
+        if v1:
+            print("PROGRESS: the document is larger than --max-memory allows, placemarks are kept in a temporary database", file=self.out_diag)
+
+        store = featurestore.FeatureStore(max_memory_mb=self.args.max_memory)
+        try:
+            with self.stage('store_features') as record:
+                kml_et = self.parse_kml(self.args.kmlfile, diag_file=self.out_diag, exit_on_parse_error=True, store=store)
+                record.doc = kml_et.getroot()
+            kml_doc = self.kml_doc = kml_et.getroot()
+            if v1:
+                print("PROGRESS: %d placemarks stored in '%s'" % (store.count, store.path), file=self.out_diag)
+
+            style_map = None
+            if self.args.optimize_styles:
+                with self.stage('optimize_styles', kml_doc):
+                    style_map = self.optimize_styles_stored(store, kml_doc)
+                objectify.deannotate(kml_doc, xsi_nil=True)
+
+            if len(self.args.folderize):
+                with self.stage('folderize', kml_doc):
+                    self.folderize_stored(store, kml_doc, self.args.folderize, self.args.folderize_limit)
+
+            if self.args.namespaces:
+                self.list_namespaces()
+
+            if self.out_kml is not None:
+                with self.stage('write_kml', kml_doc):
+                    store.write(kml_doc, self.out_kml, style_map=style_map, pretty_print=self.args.pretty_print)
+        finally:
+            store.close()
+
+    def use_snapshot(self, doc):
+        """
+        load the FeatureTable of doc from the --load-snapshot file when it was made from the same input, and write it
+        to the --save-snapshot file, see snapshot
+        """
+        v1 = self.args.verbose >= 1
+        load_path = self.args.load_snapshot if 'load_snapshot' in self.args else None
+        save_path = self.args.save_snapshot if 'save_snapshot' in self.args else None
+        kml_file = self.args.kmlfile
+        if not isinstance(kml_file, basestring) or not os.path.isfile(kml_file):
+            print("KMLUTIL ERROR: snapshots can only be made for input files", file=self.out_diag)
+            raise KMLError("Snapshot input is not a file")
+
+        if load_path:
+            with self.stage('load_snapshot', doc):
+                reason = snapshot.check(load_path, kml_file,
+                                        verify_content='verify_snapshot' in self.args and self.args.verify_snapshot)
+                if reason is None:
+                    try:
+                        self.table = snapshot.load(load_path, doc)
+                    except (ValueError, IOError), e:
+                        reason = str(e)
+            if reason is None:
+                if v1:
+                    print("PROGRESS: coordinates of %d placemarks loaded from snapshot '%s'" % (len(self.table.rows), load_path), file=self.out_diag)
+                if save_path and os.path.abspath(save_path) == os.path.abspath(load_path):
+                    return
+            else:
+                print("Note: the snapshot '%s' was not used, %s" % (load_path, reason), file=self.out_diag)
+
+        if save_path:
+            with self.stage('save_snapshot', doc):
+                if self.table is None:
+                    self.table = featuretable.FeatureTable.from_document(doc)
+                try:
+                    snapshot.save(save_path, self.table, doc, kml_file)
+                except IOError, e:
+                    print("KMLUTIL ERROR: an I/O error was encountered while writing the snapshot, unable to continue", file=self.out_diag)
+                    print("MESSAGE: %s" % e, file=self.out_diag)
+                    if self.args.reraise_errors:
+                        raise
+                    raise KMLError("Error writing snapshot")
+            if v1:
+                print("PROGRESS: snapshot of %d placemarks written to '%s'" % (len(self.table.rows), save_path), file=self.out_diag)
+
+    def table_only_coordinates(self):
+        """
+        True if the coordinates text can be dropped from the document once it is in the FeatureTable, that is when the
+        kml isn't written and no later stage reads the text instead of the table: --stats counts the points of the
+        text, --folderize the polygons of the folders, --dump-path and --optimize-coordinates parse it, the text of a
+        tree passed to the constructor is never dropped
+        """
+        if not self.own_tree:
+            return False
+        if not ('out_kml' in self.args and self.args.out_kml is None) and output_format(self.args) == 'kml':
+            return False
+        return not (self.args.stats or len(self.args.folderize) or self.args.dump_path or self.args.optimize_coordinates)
+
+    @contextmanager
+    def stage(self, name, doc=None):
+        """
+        run a processing stage under the self.profiler with progress events before and after, the stage_end event has
+        the status 'error' when the stage raised
+        """
+        self.reporter.stage_started(name)
+        status = 'error'
+        try:
+            with self.profiler.stage(name, doc) as record:
+                yield record
+            status = 'ok'
+        finally:
+            self.reporter.stage_finished(name, status=status)
+
+    def _process(self):
+        """
+        run each requested stage of processing in order, see process()
+        """
+        v1 = self.args.verbose >= 1
+        v2 = self.args.verbose >= 2
+        v3 = self.args.verbose >= 3
+        # v4 = self.args.verbose >= 4
+        v5 = self.args.verbose >= 5
+
+        if 'stream_stats' in self.args and self.args.stream_stats:
+            if v1:
+                print("PROGRESS: recording statistics from streaming parser", file=self.out_diag)
+            with self.stage('stream_stats'):
+                pre_stats, pre_stats_points, path_style_map, multi_paths = self.stream_stats(self.args.kmlfile, diag_file=self.out_diag)
+            self.stats = (pre_stats, pre_stats_points)
+            self.print_stats(pre_stats, pre_stats_points, pre_stats, pre_stats_points, path_style_map,
+                             points=self.args.optimize_paths or self.args.stats_detail, stats_format=self.args.stats_format)
+            if multi_paths:
+                self.note_multi_paths(multi_paths)
+            return
+
+        if self.namespaces_only():
+            self.list_namespaces()
+            return
+
+        self.check_stdin()
+
+        if self.pipelined():
+            self._process_pipelined()
+            return
+
+        mode = self.indexed()
+        if mode is not None:
+            self.kml_et = self.parse_indexed(mode)
+
+        if self.stored():
+            self._process_stored()
+            return
+
+        decoder = None
+        if self.kml_et is None:
+            decoder = self.parallel_decoder()
+            try:
+                with self.stage('parse_kml') as record:
+                    self.kml_et = self.parse_kml(self.args.kmlfile, diag_file=self.out_diag, exit_on_parse_error=True)
+                    record.doc = self.kml_et.getroot()
+            finally:
+                # the workers are stopped when the document could not be parsed
+                if decoder is not None and self.kml_et is None:
+                    decoder.close()
+        kml_et = self.kml_et
+        kml_doc = self.kml_doc = kml_et.getroot()
+        pre_stats = None
+
+        if decoder is not None:
+            with self.stage('parallel_decode', kml_doc):
+                try:
+                    self.table = decoder.table(kml_doc)
+                except ValueError, e:
+                    print("Note: the coordinates decoded by the --parse-jobs workers were not used, %s" % e, file=self.out_diag)
+                finally:
+                    decoder.close()
+            if v1 and self.table is not None:
+                print("PROGRESS: %d placemarks with %d coordinates decoded in %d worker processes" %
+                      (len(self.table), sum(self.table.part_counts), self.args.parse_jobs), file=self.out_diag)
+
+        if ('load_snapshot' in self.args and self.args.load_snapshot) or ('save_snapshot' in self.args and self.args.save_snapshot):
+            self.use_snapshot(kml_doc)
+        pre_stats_points = {}
+
+        if self.args.stats:
+            if v1:
+                print("PROGRESS: recording 'before' statistics", file=self.out_diag)
+            with self.stage('doc_stats', kml_doc):
+                pre_stats, pre_stats_points = doc_stats(kml_doc)
+
+        if self.args.combine:
+            with self.stage('combine_kml', kml_doc):
+                self.combine_kml(kml_doc, self.args.combine, self.args.combine_filter)
+
+        if self.args.multi_flatten:
+            with self.stage('multi_flatten', kml_doc):
+                multi_flatten(kml_doc)
+            # the placemarks now have other geometry
+            self.table = None
+
+        if self.args.extract:
+            with self.stage('extract_nodes', kml_doc):
+                self.extract_nodes(kml_doc, self.args.extract)
+
+        if self.args.paths_only:
+            with self.stage('paths_only', kml_doc):
+                self.paths_only(kml_doc)
+
+        if self.args.delete:
+            with self.stage('delete_nodes', kml_doc):
+                self.delete_nodes(kml_doc, self.args.delete)
+
+        if self.args.delete_styles:
+            with self.stage('remove_all_styles', kml_doc):
+                self.remove_all_styles(kml_doc)
+
+        if len(self.args.rename):
+            with self.stage('rename_placemarks', kml_doc):
+                self.rename_placemarks(kml_doc, self.args.rename)
+
+        if self.args.serialize_names:
+            with self.stage('serialize_names', kml_doc):
+                i = 0
+                if v1:
+                    print("PROGRESS: rename paths that are named 'Path' or 'Untitled Path' to add a serial number at least", file=self.out_diag)
+                for element in self.xp(kml_doc, placemark_2name_and_type_xpath.format(name1="'Path'",
+                                                                                      name2="'Untitled Path'",
+                                                                                      type="LineString")):
+                    element.name = objectify.StringElement("Path %d" % i)
+                    i += 1
+
+        if self.table is None and 'feature_table' in self.args and self.args.feature_table and (
+                self.args.region or self.args.optimize_paths or self.args.stats or len(self.args.folderize) or
+                self.args.list_detail):
+            with self.stage('feature_table', kml_doc):
+                self.table = featuretable.FeatureTable.from_document(kml_doc, strip=self.table_only_coordinates())
+            if v1:
+                print("PROGRESS: %d placemarks with %d coordinates in the feature table" % (len(self.table), sum(self.table.part_counts)), file=self.out_diag)
+        elif self.table is not None and self.table_only_coordinates():
+            self.table.strip()
+
+        if self.args.region:
+            with self.stage('region', kml_doc):
+                if self.args.region_file and self.args.verbose > 1:
+                    print("PROGRESS: parsing region document ", file=self.out_diag)
+                try:
+                    regions_et = parse_input(self.args.region_file if self.args.region_file else self.args.kmlfile)
+                except IOError, e:
+                    print("KMLUTIL ERROR: Unable to read external region kml document", file=self.out_diag)
+                    if self.args.reraise_errors:
+                        raise
+                    raise KMLError("External region document not readable")
+                except lxml_etree.XMLSyntaxError, e:
+                    info = {
+                        'file': e.filename if e.filename is not None else 'n/a',
+                        'line': str(e.lineno) if e.lineno is not None else 'n/a',
+                        'offset': str(e.offset) if e.offset is not None else 'n/a',
+                        'message': str(e.message) if e.message is not None else 'n/a',
+                    }
+                    print("KMLUTIL ERROR: Error parsing external region kml document: file: '{file}' line {line} offset {offset} message '{message}' ".format(**info), file=self.out_diag)
+                    if self.args.reraise_errors:
+                        raise
+                    raise KMLError("External region document not parsable")
+                except ValueError, e:
+                    print("KMLUTIL ERROR: Error parsing external region GeoJSON document: %s" % e, file=self.out_diag)
+                    if self.args.reraise_errors:
+                        raise
+                    raise KMLError("External region document not parsable")
+
+                regions_doc = regions_et.getroot()
+                trace_file = self.out_diag if self.args.verbose > 2 else None
+
+                if v1:
+                    print("PROGRESS: searching for cropping region named: '%s'" % self.args.region, file=self.out_diag)
+
+                region = Placemark.find_by_name_and_type(self.args.region, "Polygon", regions_doc, trace_file=trace_file)
+                if region is not None and len(region):
+                    if v1:
+                        print("PROGRESS: Found region Polygon with %d coords" % len(region.coordinates), file=self.out_diag)
+                else:
+                    folder = Placemark.find_folder_by_name(self.args.region, regions_doc, trace_file=trace_file)
+                    if folder is not None:
+                        region = Placemark.find_by_type("Polygon", folder, trace_file=trace_file)
+                        if region and self.args.verbose > 1:
+                            print("PROGRESS: Found region Folder with Polygon with %d coords" % len(region.coordinates), file=self.out_diag)
+
+                if region is None or len(region) == 0:
+                    print("KMLUTIL ERROR: Unable to find suitable region with name '%s'" % self.args.region, file=self.out_diag)
+                    raise KMLError("Region not found")
+
+                if v2:
+                    print("PROGRESS: comparing all Placemark elements against region", file=self.out_diag)
+
+                placemark_els = self.xp(kml_doc, all_placemarks)
+                for i, el in enumerate(placemark_els):
+                    self.reporter.counter('placemarks_tested', i, total=len(placemark_els))
+                    placemark = Placemark(el, kml_doc, out_diag=self.out_diag)
+                    row = self.table.row(el) if self.table is not None else None
+                    if row is not None:
+                        placemark.set_coords(self.table.points(row))
+                    if v3 and not v5:
+                        print("TRACE: Element '%s' with %d coordinates" % (placemark.name, len(placemark.coordinates)), file=self.out_diag)
+
+                    if placemark.is_path_or_multipath():
+                        if self.args.optimize_paths and row is not None:
+                            self.table.simplify(row, self.args.path_error_limit)
+                            placemark.set_coords(self.table.points(row))
+                        elif self.args.optimize_paths:
+                            placemark.simplify_path(self.args.path_error_limit, self.args.optimize_coordinates)
+                        elif self.args.optimize_coordinates:
+                            placemark.optimize_coordinates()
+                            if row is not None:
+                                self.table.discard(el)
+                                placemark.__dict__.pop('coordinates', None)
+
+                    detail = placemark.in_region(region, detail=True)
+                    any_in = detail[2] if isinstance(detail, tuple) else False
+
+                    if self.verboseness > 3:
+                        print("DEBUG: Checking Placemark '%32s' against region: in: %5s %5s %5s %5s %5d %5d %5d" %
+                              (placemark.get_name(), detail[0], detail[1], detail[2], detail[3], detail[4], detail[5], detail[6]), file=self.out_diag)
+
+                    if not any_in:
+                        placemark.delete()
+
+                if self.table is not None:
+                    self.table.write_back(lambda coords: format_coords(coords, self.args.optimize_coordinates))
+
+        elif self.args.optimize_paths:
+            with self.stage('optimize_paths', kml_doc):
+                path_els = self.xp(kml_doc, all_placemark_paths)
+                for i, el in enumerate(path_els):
+                    self.reporter.counter('placemarks_simplified', i, total=len(path_els))
+                    placemark = Placemark(el, kml_doc, out_diag=self.out_diag)
+                    row = self.table.row(el) if self.table is not None else None
+                    if placemark.is_path_or_multipath():
+                        if row is not None:
+                            self.table.simplify(row, self.args.path_error_limit)
+                        elif self.args.optimize_paths:
+                            placemark.simplify_path(self.args.path_error_limit, self.args.optimize_coordinates)
+                        elif self.args.optimize_coordinates:
+                            placemark.optimize_coordinates()
+                if self.table is not None:
+                    self.table.write_back(lambda coords: format_coords(coords, self.args.optimize_coordinates))
+
+        if self.args.hoist_styles:
+            with self.stage('hoist_styles', kml_doc):
+                self.hoist_styles(kml_doc)
+
+        if self.args.optimize_styles:
+            with self.stage('optimize_styles', kml_doc):
+                self.optimize_styles(kml_doc)
+
+        if self.args.stats:
+            with self.stage('doc_stats', kml_doc):
+                after, after_points = self.stats = doc_stats(kml_doc)
+                path_style_map = get_path_style_stats(kml_doc, cache=dict(self.index.ids) if self.index is not None else None,
+                                                      table=self.table)
+            self.print_stats(pre_stats, pre_stats_points, after, after_points, path_style_map,
+                             points=self.args.optimize_paths or self.args.stats_detail, stats_format=self.args.stats_format)
+
+        if len(self.args.folderize):
+            with self.stage('folderize', kml_doc):
+                self.folderize(kml_doc, self.args.folderize, self.args.folderize_limit)
+
+        if self.args.optimize_styles or self.args.hoist_styles:
+            objectify.deannotate(kml_doc, xsi_nil=True)
+
+        if self.args.validate_styles:
+            with self.stage('validate_styles', kml_doc):
+                validate_styles(kml_doc, out_file=self.out_list, out_diag=self.out_diag)
+
+        multies = kml_doc.xpath('//*[local-name()="MultiGeometry" and *[local-name()="LineString"]]')
+        if len(multies):
+            self.note_multi_paths(len(multies))
+
+        if self.args.dump_path:
+            with self.stage('dump', kml_doc):
+                self.dump(kml_doc, self.args.dump_path, out_list=self.out_list)
+        elif self.args.tree or self.args.list:
+            with self.stage('print_list', kml_doc):
+                self.print_list(kml_doc, self.args.filter, tree=self.args.tree, out_list=self.out_list, xpaths=self.args.list_with_xpaths, list_format=self.args.list_format if 'list_format' in self.args else 'text')
+
+        if self.args.namespaces:
+            self.list_namespaces()
+
+        if self.out_kml is not None:
+            out_format = output_format(self.args)
+            if out_format in ('geojson', 'geojson-seq'):
+                with self.stage('export_geojson', kml_doc):
+                    export_geojson(kml_doc, pretty=self.args.pretty_print, out_file=self.out_kml, seq=out_format == 'geojson-seq',
+                                   feature_table=self.table)
+            elif out_format == 'gpkg':
+                path = getattr(self.out_kml, 'name', None)
+                if not isinstance(path, basestring) or path.startswith('<'):
+                    print("KMLUTIL ERROR: GeoPackage output is a database file, use --output-file to name it", file=self.out_diag)
+                    raise KMLError("GeoPackage output requires an output file")
+                with self.stage('export_gpkg', kml_doc):
+                    count = export_gpkg(kml_doc, path, feature_table=self.table)
+                if v1:
+                    print("PROGRESS: %d features written to GeoPackage '%s'" % (count, path), file=self.out_diag)
+            else:
+                with self.stage('write_kml', kml_doc):
+                    kml_et.write(self.out_kml, pretty_print=self.args.pretty_print)
+
+
+def process(options):
+    """
+    process a kml document, see KMLProcessor
+    :rtype : None
+    """
+    KMLProcessor(options).run()
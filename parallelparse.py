@@ -0,0 +1,167 @@
+"""
+decode the coordinates of a large kml file in worker processes while the main process parses it, see --parse-jobs
+
+the file is cut into byte ranges at even offsets, each range holds the placemarks whose start tag begins in it, a
+worker maps the file, finds the placemarks of its range and the coordinates elements in them by their tags and
+decodes the coordinates into the columns of a FeatureTable, the columns of the ranges are joined in document order
+and matched to the placemarks of the tree parsed by the main process like a snapshot, see snapshot.load(), the tree
+itself has to be built by one process because lxml elements can't be passed between processes
+
+placemarks whose coordinates can't be found by their tags alone (CDATA, comments or entities in the text) are left to
+their elements, a file whose placemarks don't match the tree raises ValueError when the table is put together
+"""
+import os
+import re
+import mmap
+from array import array
+
+import util
+
+multiprocessing = util.LazyModule('multiprocessing')
+featuretable = util.LazyModule('featuretable')
+
+# byte ranges per worker, more ranges than workers evens out ranges with more coordinates than others
+ranges_per_job = 4
+
+placemark_start = re.compile(r'<(?:([\w.-]+):)?Placemark(?=[\s/>])((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>')
+coordinates_start = re.compile(r'<(?:[\w.-]+:)?coordinates(?=[\s/>])(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>')
+coordinates_end = re.compile(r'</(?:[\w.-]+:)?coordinates\s*>')
+placemark_ends = {}  # prefix: end tag pattern
+
+
+def _placemark_end(prefix):
+    if prefix not in placemark_ends:
+        placemark_ends[prefix] = re.compile(r'</%sPlacemark\s*>' % (re.escape(prefix + ':') if prefix else ''))
+    return placemark_ends[prefix]
+
+
+def decode_range(job):
+    """
+    the columns of the placemarks that start in a byte range of a file, run in a worker process
+    :param job: (path, start, end)
+    :return: byte strings of the coords, part_offsets, part_counts and part_widths arrays and the number of parts of
+             each placemark, -1 for a placemark left to its element
+    """
+    path, start, end = job
+    coords = array('d')
+    part_offsets = array('l')
+    part_counts = array('l')
+    part_widths = array('b')
+    row_parts = array('l')
+    with open(path, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        buf = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+    try:
+        pos = start
+        while True:
+            tag = placemark_start.search(buf, pos)
+            if tag is None or tag.start() >= end:
+                break
+            if tag.group(3):
+                row_parts.append(0)
+                pos = tag.end()
+                continue
+            close = _placemark_end(tag.group(1)).search(buf, tag.end())
+            if close is None:
+                break
+            pos = close.end()
+            placemark = buf[tag.end():close.start()]
+
+            parts = []
+            try:
+                at = 0
+                while True:
+                    coordinates = coordinates_start.search(placemark, at)
+                    if coordinates is None:
+                        break
+                    if coordinates.group(1):
+                        text = ''
+                        at = coordinates.end()
+                    else:
+                        text_end = coordinates_end.search(placemark, coordinates.end())
+                        if text_end is None:
+                            raise ValueError('unterminated coordinates')
+                        text = placemark[coordinates.end():text_end.start()]
+                        at = text_end.end()
+                    if '<' in text or '&' in text:
+                        raise ValueError('markup in coordinates')
+                    parts.append(featuretable._parse_part(text))
+            except ValueError:
+                row_parts.append(-1)
+                continue
+
+            row_parts.append(len(parts))
+            for values, width, ragged in parts:
+                part_offsets.append(len(coords))
+                part_counts.append(len(values) // width)
+                part_widths.append(-width if ragged else width)
+                coords.extend(values)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return coords.tostring(), part_offsets.tostring(), part_counts.tostring(), part_widths.tostring(), row_parts.tostring()
+
+
+def build_table(results, doc):
+    """
+    the FeatureTable of doc from the decode_range() results of its file in document order
+    """
+    table = featuretable.FeatureTable()
+    row_parts = array('l')
+    for coords, part_offsets, part_counts, part_widths, parts in results:
+        base = len(table.coords)
+        offsets = array('l')
+        offsets.fromstring(part_offsets)
+        table.part_offsets.extend(offset + base for offset in offsets)
+        table.coords.fromstring(coords)
+        table.part_counts.fromstring(part_counts)
+        table.part_widths.fromstring(part_widths)
+        row_parts.fromstring(parts)
+
+    placemarks = util.xp(doc, featuretable.placemark_xpath)
+    if len(placemarks) != len(row_parts):
+        raise ValueError('the document has %d placemarks, the workers found %d' % (len(placemarks), len(row_parts)))
+    first_part = 0
+    for row, el in enumerate(placemarks):
+        table.add_row(el, first_part, row_parts[row] >= 0)
+        if row_parts[row] < 0:
+            continue
+        coordinates = list(el.iter('{*}coordinates'))
+        if len(coordinates) != row_parts[row]:
+            raise ValueError('placemark %d has %d coordinates, the workers found %d' % (row, len(coordinates), row_parts[row]))
+        table.part_elements.extend(coordinates)
+        first_part += row_parts[row]
+    if first_part != len(table.part_offsets):
+        raise ValueError('the workers found %d coordinates that are not in placemarks' % (len(table.part_offsets) - first_part))
+    table.first_parts.append(first_part)
+    return table
+
+
+class ParallelDecoder(object):
+    """
+    decode the coordinates of a kml file in a pool of worker processes, started on creation so the main process can
+    parse the file at the same time, table() waits for the workers
+    """
+
+    def __init__(self, path, jobs):
+        size = os.path.getsize(path)
+        count = max(1, jobs * ranges_per_job)
+        bounds = [size * i // count for i in range(count + 1)]
+        self.pool = multiprocessing.Pool(processes=jobs)
+        self.result = self.pool.map_async(decode_range, [(path, bounds[i], bounds[i + 1]) for i in range(count)], chunksize=1)
+        self.pool.close()
+
+    def table(self, doc):
+        """
+        the FeatureTable of doc, the tree parsed from the file
+        """
+        results = self.result.get()
+        self.pool.join()
+        return build_table(results, doc)
+
+    def close(self):
+        """
+        stop the workers if they are still running
+        """
+        self.pool.terminate()
+        self.pool.join()
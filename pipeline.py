@@ -0,0 +1,217 @@
+"""
+parse, transform and write a kml document in three threads connected by bounded queues, see --pipeline
+
+the reader parses the document with iterparse() and cuts it into chunks of entries, an entry is either markup that
+is copied to the output as it is (the tags and text of the containers, kml, Document and Folder) or the serialized
+xml of a child of a container (a placemark, a style, a name ...), each child is removed from the tree once it is
+serialized so only the open containers are held, the transform stage hands each child to a function that may change
+it and the writer serializes the changed children and writes the chunks in order
+
+the queues hold at most queue_size chunks each, a stage that gets ahead of the next one waits, so the memory used
+does not depend on the size of the document and the time taken is close to that of the slowest stage, the parser
+and the serializer run in lxml without holding the interpreter lock, the transforms are python and run in the
+thread that calls run()
+
+the output is the one ElementTree.write() gives for the whole document, except that the namespace declarations of
+the containers that repeat ones already in scope are left out
+"""
+import re
+import sys
+import Queue
+import threading
+from xml.sax.saxutils import escape
+
+import util
+
+lxml_etree = util.LazyModule('lxml.etree')
+featurestore = util.LazyModule('featurestore')
+
+container_names = frozenset(['kml', 'Document', 'Folder'])
+# bytes of xml per chunk and chunks waiting between two stages, about queue_size * chunk_size * 2 bytes are held
+chunk_size = 256 * 1024
+queue_size = 4
+# seconds a stage waits on a queue before it checks if another stage failed
+poll_interval = 0.1
+
+tag_name = re.compile(r'<([^\s/>]+)')
+text_entities = {'\r': '&#13;'}
+
+
+class Stopped(Exception):
+    """
+    raised in a stage when another stage failed
+    """
+
+
+def _text(text):
+    return escape(text, text_entities).encode('ascii', 'xmlcharrefreplace')
+
+
+def _local_name(el):
+    tag = el.tag
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, basestring) else None
+
+
+class Pipeline(object):
+    """
+    copy the kml document in_file to out_file, see the module description
+    :param transform: function of the xml of a child of a container that returns the changed child as an element or
+                      None to keep it as it is
+    """
+
+    def __init__(self, in_file, out_file, transform=None, chunk_size=chunk_size, queue_size=queue_size):
+        self.in_file = in_file
+        self.out_file = out_file
+        self.transform = transform
+        self.chunk_size = chunk_size
+        self.parsed = Queue.Queue(maxsize=queue_size)
+        self.transformed = Queue.Queue(maxsize=queue_size)
+        self.failed = threading.Event()
+        self.error = None
+        self.items = 0      # children of containers read
+        self.changed = 0    # children the transform changed
+        self.chunks = 0
+
+    def run(self):
+        """
+        run the reader and the writer in threads and the transform in this one, the first error of a stage is raised
+        again here once the other stages stopped
+        """
+        reader = threading.Thread(target=self._run, args=(self._read,), name='kmlutil-pipeline-reader')
+        writer = threading.Thread(target=self._run, args=(self._write,), name='kmlutil-pipeline-writer')
+        for thread in (reader, writer):
+            thread.daemon = True
+            thread.start()
+        self._run(self._transform)
+        writer.join()
+        # a reader blocked reading a pipe is left behind when another stage failed
+        if not self.failed.is_set():
+            reader.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _run(self, stage):
+        try:
+            stage()
+        except Stopped:
+            pass
+        except BaseException:
+            if self.error is None:
+                self.error = sys.exc_info()
+            self.failed.set()
+
+    def _put(self, queue, chunk):
+        while not self.failed.is_set():
+            try:
+                queue.put(chunk, timeout=poll_interval)
+                return
+            except Queue.Full:
+                pass
+        raise Stopped()
+
+    def _get(self, queue):
+        while not self.failed.is_set():
+            try:
+                return queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                pass
+        raise Stopped()
+
+    def _read(self):
+        chunk = []
+        size = 0
+        # [element, start tag, True once the start tag and text are in a chunk, finished child waiting for its tail]
+        containers = []
+
+        def flush(container):
+            # the start tag and text of the container and the tail of its last child, which is then removed
+            el, start, opened, child = container
+            if not opened:
+                chunk.append(start)
+                if el.text:
+                    chunk.append(_text(el.text))
+                container[2] = True
+            if child is not None:
+                if child.tail:
+                    chunk.append(_text(child.tail))
+                el.remove(child)
+                container[3] = None
+
+        context = lxml_etree.iterparse(self.in_file, events=('start', 'end', 'comment', 'pi'),
+                                       remove_blank_text=True, strip_cdata=False, huge_tree=True)
+        for event, el in context:
+            if event == 'start':
+                parent = el.getparent()
+                if parent is None:
+                    # comments and processing instructions before the root element
+                    for sibling in reversed(list(el.itersiblings(preceding=True))):
+                        chunk.append(lxml_etree.tostring(sibling, with_tail=False))
+                elif not containers or parent is not containers[-1][0] or _local_name(el) not in container_names:
+                    continue
+                else:
+                    flush(containers[-1])
+                # the children parsed so far are cut off, the start tag is written when its content is known
+                start = featurestore.first_tag.match(lxml_etree.tostring(el)).group(0)
+                start = featurestore.strip_declarations(start, parent.nsmap if parent is not None else {})
+                if start.endswith('/>'):
+                    start = start[:-2] + '>'
+                containers.append([el, start, False, None])
+                continue
+
+            if containers and el is containers[-1][0]:
+                container = containers.pop()
+                if not container[2] and not el.text and container[3] is None:
+                    chunk.append(container[1][:-1] + '/>')
+                else:
+                    flush(container)
+                    chunk.append('</%s>' % tag_name.match(container[1]).group(1))
+                if containers:
+                    containers[-1][3] = el
+            elif containers and el.getparent() is containers[-1][0]:
+                container = containers[-1]
+                flush(container)
+                xml = lxml_etree.tostring(el, with_tail=False)
+                chunk.append([xml, container[0].nsmap])
+                container[3] = el
+                self.items += 1
+                size += len(xml)
+                if size >= self.chunk_size:
+                    self._put(self.parsed, chunk)
+                    self.chunks += 1
+                    chunk = []
+                    size = 0
+
+        for sibling in context.root.itersiblings():
+            chunk.append(lxml_etree.tostring(sibling, with_tail=False))
+        self._put(self.parsed, chunk)
+        self.chunks += 1
+        self._put(self.parsed, None)
+
+    def _transform(self):
+        while True:
+            chunk = self._get(self.parsed)
+            if chunk is not None and self.transform is not None:
+                for entry in chunk:
+                    if isinstance(entry, list):
+                        el = self.transform(entry[0])
+                        if el is not None:
+                            entry[0] = el
+                            self.changed += 1
+            self._put(self.transformed, chunk)
+            if chunk is None:
+                break
+
+    def _write(self):
+        while True:
+            chunk = self._get(self.transformed)
+            if chunk is None:
+                break
+            parts = []
+            for entry in chunk:
+                if isinstance(entry, list):
+                    xml, nsmap = entry
+                    if not isinstance(xml, str):
+                        xml = lxml_etree.tostring(xml, with_tail=False)
+                    entry = featurestore.strip_declarations(xml, nsmap)
+                parts.append(entry)
+            self.out_file.write(''.join(parts))
@@ -0,0 +1,147 @@
+from __future__ import print_function
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import util
+
+json = util.LazyModule('json')
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # python 2.x
+    tracemalloc = None
+
+
+def peak_rss_kb():
+    """
+    peak resident set size of this process in KiB or None if it can't be determined
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KiB, mac os x reports bytes
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def count_elements(doc):
+    return sum(1 for _ in doc.iter()) if doc is not None else None
+
+
+class StageRecord(object):
+    """
+    measurements for one stage, 'doc' may be replaced inside the stage when the stage produces a new document
+    """
+
+    def __init__(self, name, doc=None):
+        self.name = name
+        self.doc = doc
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss_kb = None
+        self.rss_delta_kb = None
+        self.py_alloc_delta_kb = None
+        self.py_alloc_peak_kb = None
+        self.elements_in = None
+        self.elements_out = None
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'wall': round(self.wall, 6),
+            'cpu': round(self.cpu, 6),
+            'peak_rss_kb': self.peak_rss_kb,
+            'rss_delta_kb': self.rss_delta_kb,
+            'py_alloc_delta_kb': self.py_alloc_delta_kb,
+            'py_alloc_peak_kb': self.py_alloc_peak_kb,
+            'elements_in': self.elements_in,
+            'elements_out': self.elements_out,
+        }
+
+
+class StageProfiler(object):
+    """
+    time each stage of processing, when disabled stage() does nothing but yield a record so it can be left in place
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.started = time.time()
+        self.started_cpu = cpu_seconds()
+        if enabled and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, doc=None):
+        record = StageRecord(name, doc)
+        if not self.enabled:
+            yield record
+            return
+
+        record.elements_in = count_elements(doc)
+        rss_before = peak_rss_kb()
+        if tracemalloc is not None:
+            alloc_before = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        wall = time.time()
+        cpu = cpu_seconds()
+        try:
+            yield record
+        finally:
+            record.wall = time.time() - wall
+            record.cpu = cpu_seconds() - cpu
+            record.peak_rss_kb = peak_rss_kb()
+            if rss_before is not None:
+                record.rss_delta_kb = record.peak_rss_kb - rss_before
+            if tracemalloc is not None:
+                current, peak = tracemalloc.get_traced_memory()
+                record.py_alloc_delta_kb = (current - alloc_before) // 1024
+                record.py_alloc_peak_kb = peak // 1024
+            record.elements_out = count_elements(record.doc)
+            record.doc = None
+            self.stages.append(record)
+
+    def report(self, out_file=sys.stderr, report_format='text'):
+        total_wall = time.time() - self.started
+        total_cpu = cpu_seconds() - self.started_cpu
+
+        if report_format == 'json':
+            print(json.dumps({
+                'stages': [record.as_dict() for record in self.stages],
+                'total': {'wall': round(total_wall, 6), 'cpu': round(total_cpu, 6), 'peak_rss_kb': peak_rss_kb()}
+            }, indent=4), file=out_file)
+            return
+
+        def num(value, fmt):
+            return 'n/a' if value is None else fmt.format(value)
+
+        name_len = max([len(record.name) for record in self.stages] + [len('Stage'), len('total')])
+        line = u"{0:<{w}s} {1:>9s} {2:>9s} {3:>11s} {4:>9s} {5:>11s} {6:>9s} {7:>9s}"
+        print("=== Profile by Stage ===", file=out_file)
+        print(line.format('Stage', 'Wall s', 'CPU s', 'PeakRSS MB', 'RSS +MB', 'PyAlloc +KB', 'Elem In', 'Elem Out', w=name_len), file=out_file)
+        for record in self.stages:
+            print(line.format(record.name,
+                              num(record.wall, '{0:.3f}'),
+                              num(record.cpu, '{0:.3f}'),
+                              num(record.peak_rss_kb and record.peak_rss_kb / 1024.0, '{0:.1f}'),
+                              num(record.rss_delta_kb and record.rss_delta_kb / 1024.0, '{0:.1f}'),
+                              num(record.py_alloc_delta_kb, '{0:d}'),
+                              num(record.elements_in, '{0:d}'),
+                              num(record.elements_out, '{0:d}'),
+                              w=name_len), file=out_file)
+        rss = peak_rss_kb()
+        print(line.format('total', '{0:.3f}'.format(total_wall), '{0:.3f}'.format(total_cpu),
+                          num(rss and rss / 1024.0, '{0:.1f}'), '', '', '', '', w=name_len), file=out_file)
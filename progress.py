@@ -0,0 +1,103 @@
+from __future__ import print_function
+import os
+import time
+
+import util
+
+json = util.LazyModule('json')
+
+
+def open_progress_stream(fd_or_path):
+    """
+    open the destination of --progress-json, an integer is taken as an already open file descriptor
+    """
+    if fd_or_path is None:
+        return None
+    if str(fd_or_path).isdigit():
+        return os.fdopen(int(fd_or_path), 'w')
+    return open(fd_or_path, 'w')
+
+
+class ProgressReporter(object):
+    """
+    write machine readable progress events as JSON lines, one object per line, flushed as they are written
+    {"event": "stage_start", "stage": "folderize", "elapsed": 1.25}
+    counters are rate limited to one event per interval seconds so they are cheap to call inside loops
+    """
+
+    def __init__(self, out_file=None, interval=1.0):
+        self.out_file = out_file
+        self.enabled = out_file is not None
+        self.interval = interval
+        self.started = time.time()
+        self.stage = None
+        self.stage_started_at = None
+        self.counters = {}  # name: (time first seen, time last emitted)
+
+    def event(self, event, **fields):
+        if not self.enabled:
+            return
+        fields['event'] = event
+        fields['elapsed'] = round(time.time() - self.started, 3)
+        if self.stage is not None and 'stage' not in fields:
+            fields['stage'] = self.stage
+        self.out_file.write(json.dumps(fields, sort_keys=True) + '\n')
+        self.out_file.flush()
+
+    def stage_started(self, name):
+        self.stage = name
+        self.stage_started_at = time.time()
+        self.counters = {}
+        self.event('stage_start', stage=name)
+
+    def stage_finished(self, name, status='ok'):
+        self.event('stage_end', stage=name, status=status, wall=round(time.time() - self.stage_started_at, 3))
+        self.stage = None
+
+    def counter(self, name, count, total=None, force=False):
+        """
+        report a running count, with a total the rate and an estimate of the remaining time are included
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        if name not in self.counters:
+            self.counters[name] = (now, now)
+        first, last = self.counters[name]
+        if not force and now - last < self.interval:
+            return
+        self.counters[name] = (first, now)
+        fields = {'counter': name, 'count': count}
+        if total is not None:
+            fields['total'] = total
+            elapsed = now - first
+            if count and elapsed > 0:
+                rate = count / elapsed
+                fields['rate'] = round(rate, 1)
+                fields['eta'] = round(max(total - count, 0) / rate, 1)
+        self.event('progress', **fields)
+
+
+class ProgressFile(object):
+    """
+    file-like wrapper that reports the number of bytes read through it, used to follow the parser through the input
+    """
+
+    def __init__(self, raw_file, reporter, name='bytes_parsed'):
+        self.raw_file = raw_file
+        self.reporter = reporter
+        self.name = name
+        self.count = 0
+        try:
+            self.total = os.fstat(raw_file.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            self.total = None
+
+    def read(self, size=-1):
+        data = self.raw_file.read(size)
+        self.count += len(data)
+        self.reporter.counter(self.name, self.count, total=self.total, force=not data)
+        return data
+
+    def close(self):
+        self.raw_file.close()
@@ -0,0 +1,368 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from copy import deepcopy
+
+from attrdict import AttrDict
+
+import kmlutil
+from util import nice_num
+
+# options a request may set, the ones that read input and transform or report on the document, options that write
+# files, start processes or control other modes are left out
+request_allowed_options = ['kmlfile', 'verbose', 'region', 'region_file', 'optimize_paths', 'optimize_styles',
+                           'hoist_styles', 'optimize_coordinates', 'path_error_limit', 'stats', 'stats_format',
+                           'stats_detail', 'stream_stats', 'pretty_print', 'list_format', 'tree', 'list', 'namespaces',
+                           'filter', 'no_kml_out', 'list_detail', 'list_with_xpaths', 'list_only', 'folderize',
+                           'folderize_limit', 'serialize_names', 'delete_styles', 'paths_only', 'multi_flatten',
+                           'dump_path', 'geojson', 'geojson_seq', 'feature_table', 'extract', 'delete', 'rename',
+                           'combine', 'combine_filter', 'validate_styles', 'profile', 'profile_format']
+
+# options that change the document, requests using them are run on a private copy of the cached document
+mutating_options = ['combine', 'multi_flatten', 'extract', 'paths_only', 'delete', 'delete_styles', 'rename',
+                    'serialize_names', 'region', 'optimize_paths', 'optimize_styles', 'hoist_styles', 'optimize_coordinates',
+                    'folderize', 'feature_table']
+
+# rough size of a parsed document in memory, used to enforce the cache memory limit
+tree_bytes_per_file_byte = 2
+tree_bytes_per_element = 300
+
+default_threads = 4
+default_cache_memory_mb = 512
+
+
+class RequestError(kmlutil.KMLError):
+    pass
+
+
+class OutputBuffer(object):
+    """
+    in-memory output stream that accepts byte and unicode strings, unicode is stored as utf-8
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data.encode('utf-8') if isinstance(data, unicode) else data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts).decode('utf-8', 'replace')
+
+
+class CacheEntry(object):
+    """
+    a parsed document and its index, the lock serializes the requests that read the shared tree
+    """
+
+    def __init__(self, path, signature, kml_et):
+        self.path = path
+        self.signature = signature
+        self.kml_et = kml_et
+        self.index = kmlutil.DocumentIndex(kml_et.getroot())
+        self.cost = signature[1] * tree_bytes_per_file_byte + sum(1 for _ in kml_et.iter()) * tree_bytes_per_element
+        self.lock = threading.Lock()
+
+
+class DocumentCache(object):
+    """
+    least recently used cache of parsed documents keyed by path, an entry is replaced when the file's modification
+    time or size changes, the least recently used entries are dropped when the estimated memory use of all entries
+    exceeds max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # path: CacheEntry, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def get(self, path, parse):
+        """
+        cached entry for path, parse(path) is called to load the document on a miss
+        :return: tuple of (CacheEntry, True if it was found in the cache)
+        """
+        path = os.path.abspath(path)
+        signature = self.signature(path)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None and entry.signature == signature:
+                self.entries[path] = entry
+                self.hits += 1
+                return entry, True
+            if entry is not None:
+                self.total_bytes -= entry.cost
+            self.misses += 1
+
+        # parse outside of the lock so other documents can be served meanwhile
+        entry = CacheEntry(path, signature, parse(path))
+
+        with self.lock:
+            current = self.entries.pop(path, None)
+            if current is not None:
+                self.total_bytes -= current.cost
+            if entry.cost <= self.max_bytes:
+                self.entries[path] = entry
+                self.total_bytes += entry.cost
+            while self.total_bytes > self.max_bytes and len(self.entries):
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.cost
+        return entry, False
+
+    def status(self):
+        with self.lock:
+            return {
+                'documents': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'paths': list(self.entries.keys()),
+            }
+
+
+def request_options(request):
+    """
+    build processing options from the 'options' of a request, these are the option names used by main() and
+    kmlutil.defaults, e.g. {"kmlfile": "my_big.kml", "list": true, "extract": ["%* Trail"]}
+    """
+    requested = request.get('options')
+    if not isinstance(requested, dict):
+        raise RequestError("request must contain an 'options' object")
+
+    options = AttrDict(dict(kmlutil.defaults))
+    for name, value in requested.items():
+        name = name.replace('-', '_')
+        if name not in request_allowed_options:
+            raise RequestError("unsupported option '%s'" % name)
+        options[name] = value
+
+    if not options.kmlfile:
+        raise RequestError("option 'kmlfile' is required")
+    if isinstance(options.filter, basestring):
+        options.filter = options.filter.split(',')
+    if options.stream_stats:
+        options.stats = True
+        options.no_kml_out = True
+    return options
+
+
+def wants_kml_output(options, request):
+    """
+    same rule as main() when no --output-file is given, a request may override it with "output": true or false
+    """
+    if 'output' in request:
+        return bool(request['output'])
+    return not (options.no_kml_out or len(options.dump_path) or len(options.rename) or options.stats or options.list or
+                options.tree or options.namespaces)
+
+
+class KMLService(object):
+    """
+    run processing requests against cached documents, independent of the transport so it can be called directly
+    """
+
+    def __init__(self, cache_bytes=default_cache_memory_mb * 1024 * 1024):
+        self.cache = DocumentCache(cache_bytes)
+        self.started = time.time()
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+
+    def handle(self, request):
+        """
+        process one request
+        :return: tuple of (http status, response dict)
+        """
+        wall = time.time()
+        with self.requests_lock:
+            self.requests += 1
+        try:
+            options = request_options(request)
+        except RequestError, e:
+            return 400, {'status': 'error', 'message': e.message}
+
+        buffers = dict((name, OutputBuffer()) for name in ['output', 'list', 'stats', 'diag'])
+        options.out_kml = buffers['output'] if wants_kml_output(options, request) else None
+        options.out_list = options.out_nsmap = buffers['list']
+        options.out_stats = buffers['stats']
+        options.out_diag = buffers['diag']
+
+        response = {'status': 'error', 'cache': 'bypass'}
+        status = 500
+        try:
+            if options.stream_stats or not os.path.isfile(options.kmlfile):
+                kmlutil.KMLProcessor(options).run()
+            else:
+                entry, hit = self.cache.get(options.kmlfile, kmlutil.parse_input)
+                response['cache'] = 'hit' if hit else 'miss'
+                if any(options[name] for name in mutating_options):
+                    with entry.lock:
+                        kml_et = deepcopy(entry.kml_et)
+                    kmlutil.KMLProcessor(options, kml_et=kml_et).run()
+                else:
+                    with entry.lock:
+                        kmlutil.KMLProcessor(options, kml_et=entry.kml_et, index=entry.index).run()
+            response['status'] = 'ok'
+            status = 200
+        except (Exception, SystemExit), e:
+            diag = buffers['diag'].getvalue().strip().splitlines()
+            response['message'] = diag[-1] if len(diag) else '%s: %s' % (type(e).__name__, e)
+
+        for name, buf in buffers.items():
+            response[name] = buf.getvalue()
+        response['wall'] = round(time.time() - wall, 4)
+        return status, response
+
+    def status(self):
+        return 200, {'status': 'ok', 'uptime': round(time.time() - self.started, 1), 'requests': self.requests,
+                     'cache': self.cache.status()}
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST / with a JSON request body runs a request, GET /status reports the cache
+    """
+    server_version = 'kmlutil'
+
+    def send_json(self, status, response):
+        body = json.dumps(response, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self.send_json(*self.server.service.status())
+        else:
+            self.send_json(404, {'status': 'error', 'message': 'not found'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError, e:
+            self.send_json(400, {'status': 'error', 'message': 'invalid request: %s' % e})
+            return
+        self.send_json(*self.server.service.handle(request))
+
+    def address_string(self):
+        # unix sockets have no client host
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class ThreadPoolMixIn:
+    """
+    handle requests on a fixed pool of threads instead of a thread per request
+    """
+    threads = default_threads
+
+    def start_pool(self):
+        self.request_queue = Queue.Queue(self.threads * 4)
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self.pool_worker)
+            worker.daemon = True
+            worker.start()
+
+    def pool_worker(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+
+class KMLHTTPServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+
+class KMLUnixServer(ThreadPoolMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def make_server(service, host='127.0.0.1', port=0, socket_path=None, threads=default_threads, verbose=False):
+    """
+    create a server for service listening on socket_path if given or on host:port, port 0 picks a free port
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = KMLUnixServer(socket_path, RequestHandler)
+    else:
+        server = KMLHTTPServer((host, port), RequestHandler)
+    server.service = service
+    server.threads = threads
+    server.verbose = verbose
+    server.start_pool()
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='kmlutil serve', description="""Serve kmlutil requests over HTTP on localhost
+    or a unix socket, keeping parsed documents in memory between requests. POST a JSON object like
+    {"options": {"kmlfile": "my_big.kml", "list": true}} where options are the kmlutil options by their long names,
+    the response contains the output, list, stats and diag text. GET /status reports the document cache.""")
+    parser.add_argument("--host", action="store", default='127.0.0.1',
+                        help="address to listen on, default 127.0.0.1")
+    parser.add_argument("--port", action="store", type=int, default=8642,
+                        help="port to listen on, default 8642")
+    parser.add_argument("--socket", action="store", default=None, metavar='PATH',
+                        help="listen on a unix socket at PATH instead of a tcp port")
+    parser.add_argument("--threads", action="store", type=int, default=default_threads,
+                        help="number of requests processed concurrently, default %d" % default_threads)
+    parser.add_argument("--cache-memory", action="store", type=float, default=default_cache_memory_mb, metavar='MB',
+                        help="approximate memory limit for cached documents, default %s MB" % nice_num(default_cache_memory_mb))
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log each request to stderr")
+    args = parser.parse_args(argv)
+
+    service = KMLService(cache_bytes=int(args.cache_memory * 1024 * 1024))
+    try:
+        server = make_server(service, host=args.host, port=args.port, socket_path=args.socket, threads=args.threads,
+                             verbose=args.verbose)
+    except socket.error, e:
+        print("KMLUTIL ERROR: unable to listen: %s" % e, file=sys.stderr)
+        sys.exit(1)
+
+    where = args.socket if args.socket is not None else 'http://%s:%d/' % server.server_address[:2]
+    print("kmlutil serving on %s" % where, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
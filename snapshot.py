@@ -0,0 +1,236 @@
+"""
+snapshots of the decoded coordinates of a kml document for fast reloading, see --save-snapshot and --load-snapshot
+
+a snapshot holds the columns of a FeatureTable built from the document, with the ordinal of each placemark, folder
+and coordinates element so they can be matched to the elements of the document when it is parsed again, and the
+size, modification time and SHA-1 of the source file it was made from, a snapshot of a source with another size or
+modification time is not used, like the --index the source is only read again to compare its SHA-1 when asked to
+
+the coordinate section is memory mapped when the snapshot is loaded, pages are read as the coordinates are used and
+changed coordinates are kept in memory, the snapshot file is not changed
+
+file layout: the magic line, one line of JSON header, then the sections at the offsets given in the header, the
+coordinate values are raw doubles in native byte order starting on a page boundary so the section can be memory
+mapped
+"""
+import os
+import sys
+import mmap
+import struct
+import hashlib
+from array import array
+
+import util
+
+json = util.LazyModule('json')
+featuretable = util.LazyModule('featuretable')
+
+magic = 'KMLUTIL-SNAPSHOT\n'
+version = 1
+page_size = 4096
+# FeatureTable columns saved as sections, coords is written last so its alignment doesn't move the others
+columns = ['first_parts', 'names', 'style_urls', 'folders', 'part_offsets', 'part_counts', 'part_widths', 'coords']
+
+
+def source_signature(path):
+    """
+    size, modification time and SHA-1 of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), ''):
+            sha1.update(block)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class MappedDoubles(object):
+    """
+    the array('d') of a FeatureTable column in a memory mapped section of a file, values set in the section stay in
+    memory and values added with extend() are kept in an array after it, only the operations FeatureTable uses
+    """
+    typecode = 'd'
+    itemsize = 8
+
+    def __init__(self, in_file, offset, count):
+        self.count = count
+        self.extra = array('d')
+        # the mapping starts at the section, which is aligned to a page for this, or on the allocation granularity
+        # before it where that is larger than a page, copy on write leaves the file as it is
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self.offset = offset - start
+        self.buffer = mmap.mmap(in_file.fileno(), self.offset + count * self.itemsize, access=mmap.ACCESS_COPY,
+                                offset=start) if count else ''
+
+    def __len__(self):
+        return self.count + len(self.extra)
+
+    def _values(self, start, stop):
+        # the values from start to stop as an array, stop no more than len(self)
+        values = array('d')
+        if start < self.count:
+            values.fromstring(self.buffer[self.offset + start * self.itemsize:self.offset + min(stop, self.count) * self.itemsize])
+        if stop > self.count:
+            values.extend(self.extra[max(start, self.count) - self.count:stop - self.count])
+        return values
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0 or stop <= start:
+                return array('d', list(self)[index]) if step < 0 else array('d')
+            values = self._values(start, stop)
+            return values if step == 1 else values[::step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('array index out of range')
+        if index >= self.count:
+            return self.extra[index - self.count]
+        return struct.unpack_from('d', self.buffer, self.offset + index * self.itemsize)[0]
+
+    def __setitem__(self, index, values):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError('only contiguous slices of a mapped column can be set')
+        start, stop, _ = index.indices(len(self))
+        values = array('d', values)
+        if len(values) != stop - start:
+            raise ValueError('a mapped column can only be set to as many values as it replaces')
+        split = max(start, min(stop, self.count))
+        if start < split:
+            self.buffer[self.offset + start * self.itemsize:self.offset + split * self.itemsize] = values[:split - start].tostring()
+        if split < stop:
+            self.extra[split - self.count:stop - self.count] = values[split - start:]
+
+    def __iter__(self):
+        return iter(self._values(0, len(self)))
+
+    def extend(self, values):
+        self.extra.extend(values)
+
+    def tostring(self):
+        return self._values(0, len(self)).tostring()
+
+    def tofile(self, out_file):
+        if self.count:
+            out_file.write(self.buffer[self.offset:self.offset + self.count * self.itemsize])
+        self.extra.tofile(out_file)
+
+
+def save(path, table, doc, source_path):
+    """
+    write a snapshot of table, a FeatureTable built from doc as parsed from source_path
+    """
+    folders = dict((el, i) for i, el in enumerate(doc.getroottree().getroot().iter('{*}Folder')))
+    # the rows of placemarks with coordinates the table couldn't decode are left to the elements
+    rows = array('b', [0] * len(table))
+    for row in table.rows.values():
+        rows[row] = 1
+
+    sections = [('rows', rows), ('folder_ordinals', array('l', [folders[el] for el in table.folder_elements]))]
+    sections += [(name, getattr(table, name)) for name in columns]
+    header = {
+        'version': version,
+        'byteorder': sys.byteorder,
+        'source': dict(source_signature(source_path), path=os.path.abspath(source_path)),
+        'strings': table.strings,
+        'sections': [],
+    }
+    offset = 0
+    for name, values in sections:
+        offset = _align(offset, page_size if name == 'coords' else values.itemsize)
+        header['sections'].append([name, values.typecode, values.itemsize, offset, len(values)])
+        offset += values.itemsize * len(values)
+
+    header_text = json.dumps(header, separators=(',', ':')) + '\n'
+    data_start = _align(len(magic) + len(header_text), page_size)
+    with open(path, 'wb') as out_file:
+        out_file.write(magic)
+        out_file.write(header_text)
+        for (name, values), section in zip(sections, header['sections']):
+            out_file.seek(data_start + section[3])
+            values.tofile(out_file)
+
+
+def read_header(path):
+    """
+    the header of a snapshot and the offset of its data, None if path isn't a snapshot
+    """
+    with open(path, 'rb') as in_file:
+        if in_file.read(len(magic)) != magic:
+            return None, None
+        header_text = in_file.readline()
+    return json.loads(header_text), _align(len(magic) + len(header_text), page_size)
+
+
+def check(path, source_path, verify_content=False):
+    """
+    the reason the snapshot at path can't be used for source_path, None if it can
+    :param verify_content: also compare the SHA-1 of source_path, which reads all of it
+    """
+    if not os.path.isfile(path):
+        return 'there is no snapshot file'
+    header, _ = read_header(path)
+    if header is None:
+        return 'the file is not a snapshot'
+    if header['version'] != version or header['byteorder'] != sys.byteorder:
+        return 'the snapshot was written by another version or platform'
+    source = header['source']
+    stat = os.stat(source_path)
+    if source['size'] != stat.st_size:
+        return 'the size of the input changed'
+    if source['mtime'] != stat.st_mtime:
+        return 'the modification time of the input changed'
+    if verify_content and source['sha1'] != source_signature(source_path)['sha1']:
+        return 'the content of the input changed'
+    return None
+
+
+def load(path, doc):
+    """
+    the FeatureTable saved at path for doc, the document parsed from the source of the snapshot, see check()
+    """
+    header, data_start = read_header(path)
+    sections = {}
+    with open(path, 'rb') as in_file:
+        for name, typecode, itemsize, offset, count in header['sections']:
+            values = array(typecode)
+            if values.itemsize != itemsize:
+                raise ValueError("the '%s' section of the snapshot has %d byte items" % (name, itemsize))
+            if name == 'coords':
+                sections[name] = MappedDoubles(in_file, data_start + offset, count)
+                continue
+            in_file.seek(data_start + offset)
+            values.fromfile(in_file, count)
+            sections[name] = values
+
+    table = featuretable.FeatureTable()
+    for name in columns:
+        setattr(table, name, sections[name])
+    table.strings = header['strings']
+    table.string_index = dict((text, i) for i, text in enumerate(table.strings))
+
+    folders = list(doc.getroottree().getroot().iter('{*}Folder'))
+    table.folder_elements = [folders[ordinal] for ordinal in sections['folder_ordinals']]
+    table.folder_index = dict((el, i) for i, el in enumerate(table.folder_elements))
+
+    placemarks = util.xp(doc, featuretable.placemark_xpath)
+    if len(placemarks) != len(table):
+        raise ValueError('the document has %d placemarks, the snapshot %d' % (len(placemarks), len(table)))
+    table.part_elements = [None] * len(table.part_offsets)
+    rows = sections['rows']
+    for row, el in enumerate(placemarks):
+        if not rows[row]:
+            continue
+        table.rows[el] = row
+        parts = table.parts(row)
+        coordinates = list(el.iter('{*}coordinates'))
+        if len(coordinates) != len(parts):
+            raise ValueError('placemark %d has %d coordinates, the snapshot %d' % (row, len(coordinates), len(parts)))
+        for part, coords in zip(parts, coordinates):
+            table.part_elements[part] = coords
+    return table
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+generate synthetic kml documents of a configurable size for benchmarks and performance tests
+
+the document has a 'Boundaries' folder with one folder per boundary, each holding a polygon that covers a vertical
+strip of the area (for --folderize '%Boundary ') and a 'Region' polygon covering the middle of the area (for
+--region Region), followed by folders of tracks, multi-segment tracks and points using shared, duplicated and inline
+styles
+"""
+from __future__ import print_function
+import sys
+import random
+import argparse
+
+kml_header = u'<?xml version="1.0" encoding="UTF-8"?>\n' \
+             u'<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n' \
+             u'<Document>\n<name>{name}</name>\n'
+kml_footer = u'</Document>\n</kml>\n'
+
+# area covered by the generated features
+west, east, south, north = -112.0, -111.0, 40.0, 41.0
+
+colors = ['ff0000ff', 'ff00ff00', 'ffff0000', 'ff00ffff', 'ffff00ff', 'ffffff00', 'ff0080ff', 'ff8000ff']
+
+
+def _coords(points):
+    return u' '.join(u'%.6f,%.6f,0' % point for point in points)
+
+
+def _track(rng, count):
+    x = rng.uniform(west + 0.05, east - 0.05)
+    y = rng.uniform(south + 0.05, north - 0.05)
+    points = []
+    for _ in range(count):
+        x = min(max(x + rng.uniform(-0.002, 0.002), west), east)
+        y = min(max(y + rng.uniform(-0.002, 0.002), south), north)
+        points.append((x, y))
+    return points
+
+
+def _polygon(ring):
+    return u'<Polygon><outerBoundaryIs><LinearRing><coordinates>%s</coordinates></LinearRing></outerBoundaryIs></Polygon>' % \
+        _coords(ring + [ring[0]])
+
+
+def _rect(x1, y1, x2, y2):
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+
+
+def generate(out_file, folders=10, placemarks=50, points=100, styles=10, multi_ratio=0.1, boundaries=4, seed=1,
+             name='synthetic'):
+    """
+    write a synthetic kml document to out_file
+    :param folders: number of folders of features
+    :param placemarks: number of placemarks in each folder, every fourth one is a Point, the rest are tracks
+    :param points: number of points in each track
+    :param styles: number of shared Style/StyleMap pairs, half of the styles duplicate another style's content
+    :param multi_ratio: fraction of tracks that are MultiGeometry with two LineStrings
+    :param boundaries: number of boundary folders with polygons
+    :return: dict with counts of the generated placemarks, tracks, points and coordinates
+    """
+    rng = random.Random(seed)
+    summary = {'folders': folders, 'placemarks': 0, 'tracks': 0, 'multi_tracks': 0, 'points': 0, 'coordinates': 0,
+               'styles': styles, 'boundaries': boundaries}
+
+    def write(text):
+        out_file.write(text.encode('utf-8'))
+
+    write(kml_header.format(name=name))
+
+    for i in range(styles):
+        color = colors[(i // 2) % len(colors)]
+        write(u'<Style id="style-%d"><LineStyle><color>%s</color><width>%d</width></LineStyle></Style>\n' % (i, color, 2 + i // 2 % 3))
+        write(u'<Style id="style-%d-hl"><LineStyle><color>%s</color><width>6</width></LineStyle></Style>\n' % (i, color))
+        write(u'<StyleMap id="map-%d"><Pair><key>normal</key><styleUrl>#style-%d</styleUrl></Pair>'
+              u'<Pair><key>highlight</key><styleUrl>#style-%d-hl</styleUrl></Pair></StyleMap>\n' % (i, i, i))
+
+    write(u'<Folder><name>Boundaries</name>\n')
+    width = (east - west) / max(boundaries, 1)
+    for i in range(boundaries):
+        ring = _rect(west + i * width, south, west + (i + 1) * width, north)
+        write(u'<Folder><name>Boundary %d</name><Placemark><name>Boundary %d Area</name>%s</Placemark></Folder>\n' %
+              (i, i, _polygon(ring)))
+        summary['coordinates'] += 5
+    ring = _rect(west + 0.25, south + 0.25, east - 0.25, north - 0.25)
+    write(u'<Placemark><name>Region</name>%s</Placemark>\n' % _polygon(ring))
+    summary['coordinates'] += 5
+    write(u'</Folder>\n')
+
+    for f in range(folders):
+        write(u'<Folder><name>Folder %d</name>\n' % f)
+        for p in range(placemarks):
+            n = f * placemarks + p
+            if styles and n % 5 == 4:
+                style = u'<Style><LineStyle><color>%s</color><width>3</width></LineStyle></Style>' % colors[n % len(colors)]
+            elif styles:
+                style = u'<styleUrl>#%s-%d</styleUrl>' % ('map' if n % 2 else 'style', n % styles)
+            else:
+                style = u''
+            if p % 4 == 3:
+                x, y = _track(rng, 1)[0]
+                write(u'<Placemark><name>Point %d</name><Point><coordinates>%.6f,%.6f,0</coordinates></Point></Placemark>\n' % (n, x, y))
+                summary['points'] += 1
+                summary['coordinates'] += 1
+            elif rng.random() < multi_ratio:
+                half = max(points // 2, 2)
+                segments = u''.join(u'<LineString><coordinates>%s</coordinates></LineString>' % _coords(_track(rng, half))
+                                    for _ in range(2))
+                write(u'<Placemark><name>Track %d</name>%s<MultiGeometry>%s</MultiGeometry></Placemark>\n' % (n, style, segments))
+                summary['multi_tracks'] += 1
+                summary['coordinates'] += half * 2
+            else:
+                write(u'<Placemark><name>Track %d</name>%s<LineString><coordinates>%s</coordinates></LineString></Placemark>\n' %
+                      (n, style, _coords(_track(rng, points))))
+                summary['tracks'] += 1
+                summary['coordinates'] += points
+            summary['placemarks'] += 1
+        write(u'</Folder>\n')
+
+    write(kml_footer)
+    return summary
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="generate a synthetic kml document")
+    parser.add_argument("--folders", type=int, default=10, help="number of folders of features, default 10")
+    parser.add_argument("--placemarks", type=int, default=50, help="placemarks in each folder, default 50")
+    parser.add_argument("--points", type=int, default=100, help="points in each track, default 100")
+    parser.add_argument("--styles", type=int, default=10, help="number of shared styles, default 10")
+    parser.add_argument("--multi-ratio", type=float, default=0.1, help="fraction of MultiGeometry tracks, default 0.1")
+    parser.add_argument("--boundaries", type=int, default=4, help="number of boundary polygons, default 4")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, default 1")
+    parser.add_argument("-O", "--output-file", type=argparse.FileType('wb'), default=sys.stdout,
+                        help="destination, default stdout")
+    args = parser.parse_args(argv)
+
+    summary = generate(args.output_file, folders=args.folders, placemarks=args.placemarks, points=args.points,
+                       styles=args.styles, multi_ratio=args.multi_ratio, boundaries=args.boundaries, seed=args.seed)
+    print("generated %(placemarks)d placemarks with %(coordinates)d coordinates" % summary, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+__author__ = 'mscalora'
+
+import os
+import bz2
+import gzip
+import unittest
+import json
+from utils4test import *
+from scripttest import TestFileEnvironment
+
+import batch
+
+env = TestFileEnvironment('scratch', cwd='.')
+
+
+class TestFromCommandLine(unittest.TestCase):
+
+    def test_batch_glob_with_jobs(self):
+        env.clear()
+        result = env.run('kmlutil --batch "test-data/[0-9]-*.kml" --jobs 3 --batch-output-dir scratch/out --paths-only')
+
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        files = [record for record in records if record['type'] == 'file']
+        total = records[-1]
+
+        self.assertEqual('total', total['type'])
+        self.assertEqual(8, total['files'])
+        self.assertEqual(0, total['failed'])
+        self.assertEqual(8, len(files))
+        for record in files:
+            self.assertEqual('ok', record['status'])
+            self.assertEqual(0, record['folders'])
+            self.assertIn(record['output'][len('scratch/'):], result.files_created)
+
+    def test_batch_manifest(self):
+        env.clear()
+        with open('scratch/manifest.txt', 'w') as manifest:
+            manifest.write('# input, output\n')
+            manifest.write('../test-data/0-test-misc.kml\tmisc.geojson\n')
+            manifest.write('../test-data/does-not-exist.kml\tmissing.geojson\n')
+        result = env.run('kmlutil --batch scratch/manifest.txt --geojson', expect_error=True)
+
+        records = {record.get('input'): record for record in [json.loads(line) for line in result.stdout.splitlines()]}
+
+        self.assertEqual(1, result.returncode)
+        self.assertEqual('ok', records['scratch/../test-data/0-test-misc.kml']['status'])
+        self.assertEqual('error', records['scratch/../test-data/does-not-exist.kml']['status'])
+        self.assertIn('misc.geojson', result.files_created)
+        self.assertEqual('FeatureCollection', json.loads(result.files_created['misc.geojson'].bytes)['type'])
+
+    def test_batch_counts(self):
+        env.clear()
+        for options in ['', '--stats', '--feature-table --list --list-details']:
+            result = env.run('kmlutil --batch test-data/0-test-misc.kml --no-kml %s' % options)
+            record = json.loads(result.stdout.splitlines()[0])
+
+            self.assertEqual('ok', record['status'])
+            self.assertEqual((7, 3, 45), (record['placemarks'], record['folders'], record['points']))
+
+    def test_batch_compressed_inputs(self):
+        env.clear()
+        os.mkdir('scratch/in')
+        with open('test-data/0-test-misc.kml', 'rb') as kml_file:
+            kml = kml_file.read()
+        for name, open_file in [('misc.kml.gz', gzip.open), ('other.kml.bz2', bz2.BZ2File), ('plain.kml', open)]:
+            out_file = open_file('scratch/in/' + name, 'wb')
+            out_file.write(kml)
+            out_file.close()
+
+        for spec, outputs in [('scratch/in', ['misc.kml', 'other.kml', 'plain.kml']), ('scratch/in/misc.kml.gz', ['misc.kml'])]:
+            result = env.run('kmlutil --batch %s --batch-output-dir scratch/out --paths-only' % spec)
+
+            records = [json.loads(line) for line in result.stdout.splitlines()]
+            self.assertEqual(['ok'] * len(outputs), [record['status'] for record in records[:-1]])
+            self.assertEqual(['scratch/out/' + output for output in outputs], sorted(record['output'] for record in records[:-1]))
+
+    def test_batch_ignored_options_and_compressed_output(self):
+        env.clear()
+        result = env.run('kmlutil --batch test-data/0-test-misc.kml --batch-output-dir scratch/out --profile '
+                         '--progress-json scratch/progress.jsonl --compress-level 1', expect_stderr=True)
+
+        self.assertIn("Note: --progress-json, --profile can't be used with --batch and are ignored", result.stderr)
+        self.assertNotIn('progress.jsonl', result.files_created)
+
+        with open('scratch/manifest.txt', 'w') as manifest_file:
+            manifest_file.write('../test-data/0-test-misc.kml\tmisc.kml.gz\n')
+        result = env.run('kmlutil --batch scratch/manifest.txt --compress-level 1')
+
+        self.assertEqual('ok', json.loads(result.stdout.splitlines()[0])['status'])
+        self.assertEqual(env.run('kmlutil test-data/0-test-misc.kml').stdout, gzip.open('scratch/misc.kml.gz').read())
+
+    def test_manifest_tab_separated(self):
+        env.clear()
+        with open('scratch/manifest.txt', 'w') as manifest:
+            manifest.write('in, with comma.kml\tout, with comma.kml\n')
+            manifest.write('only input, no output.kml\n')
+
+        self.assertEqual([('scratch/in, with comma.kml', 'scratch/out, with comma.kml'),
+                          ('scratch/only input, no output.kml', None)], batch.read_manifest('scratch/manifest.txt'))
+
+    def test_batch_requires_output(self):
+        env.clear()
+        result = env.run('kmlutil --batch "test-data/*.kml"', expect_error=True)
+
+        self.assertRegexpMatches(result.stderr, ur'^KMLUTIL ERROR.*--batch-output-dir')
+
+
+if __name__ == '__main__':
+    unittest.main()
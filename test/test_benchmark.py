@@ -0,0 +1,48 @@
+__author__ = 'mscalora'
+
+import json
+import unittest
+from cStringIO import StringIO
+from pykml import parser as kmlparser
+from scripttest import TestFileEnvironment
+
+import kmlutil
+import synthkml
+
+env = TestFileEnvironment('scratch', cwd='.')
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_document(self):
+        out_file = StringIO()
+        summary = synthkml.generate(out_file, folders=3, placemarks=8, points=20, styles=4, multi_ratio=0.5, boundaries=2)
+
+        out_file.seek(0)
+        element_counts, point_counts = kmlutil.doc_stats(kmlparser.parse(out_file).getroot())
+
+        self.assertEqual(summary['placemarks'] + summary['boundaries'] + 1, element_counts['Placemark'])
+        self.assertEqual(summary['multi_tracks'], element_counts.get('MultiGeometry', 0))
+        self.assertEqual(summary['boundaries'] + 1, element_counts['Polygon'])
+        self.assertEqual(summary['coordinates'], point_counts['Document'])
+        self.assertEqual(summary['styles'], element_counts['StyleMap'])
+
+    def test_benchmark_results(self):
+        env.clear()
+        env.run('python tools/benchmark.py --folders 2 --placemarks 8 --points 20 --operations parse_kml,stats,geojson '
+                '--output scratch/bench.json', expect_stderr=True)
+        result = env.run('python tools/benchmark.py --folders 2 --placemarks 8 --points 20 --operations stats '
+                         '--compare scratch/bench.json', expect_stderr=True)
+
+        report = json.loads(open('scratch/bench.json').read())
+        self.assertEqual(['parse_kml', 'stats', 'geojson'], [item['operation'] for item in report['results']])
+        for item in report['results']:
+            self.assertEqual('ok', item['status'])
+            self.assertGreater(item['points_per_s'], 0)
+            self.assertGreater(item['peak_rss_kb'], 0)
+        self.assertEqual(16, report['document']['placemarks'])
+        self.assertIn('=== Compared to scratch/bench.json ===', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
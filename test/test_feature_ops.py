@@ -89,6 +89,73 @@ class TestFromCommandLine(unittest.TestCase):
         self.assertRegexpMatches(result.stderr, ur"Folder:\s*'Crop Circles'\D*\d*?[1-9]", 'Some children should have been moved')
         self.assertRegexpMatches(result.stderr, ur"Folder:\s*'Rect'\D*\d*?[1-9]", 'Some children should have been moved')
 
+    def test_folderize_max_memory(self):
+        env.clear()
+        options = 'test-data/A-folderize-acid-test.kml --folderize "Crop Circles" --folderize Rect --optimize-styles'
+        in_memory = env.run('kmlutil %s' % options, expect_stderr=True)
+        stored = env.run('kmlutil %s --max-memory 0.01 -v' % options, expect_stderr=True)
+
+        self.assertIn('temporary database', stored.stderr)
+        canonical = lambda kml: lxml_et.tostring(lxml_et.fromstring(kml), method='c14n')
+        self.assertEqual(canonical(in_memory.stdout), canonical(stored.stdout))
+
+    def test_max_memory_short_tuples(self):
+        env.clear()
+        with open('scratch/short.kml', 'w') as kml_file:
+            kml_file.write('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                           '<Placemark><name>odd</name><LineString><coordinates>1,2 3,4,5 6</coordinates></LineString></Placemark>'
+                           '</Document></kml>')
+        in_memory = env.run('kmlutil scratch/short.kml --optimize-styles', expect_stderr=True)
+        stored = env.run('kmlutil scratch/short.kml --optimize-styles --max-memory 0.000001', expect_stderr=True)
+
+        canonical = lambda kml: lxml_et.tostring(lxml_et.fromstring(kml), method='c14n')
+        self.assertEqual(canonical(in_memory.stdout), canonical(stored.stdout))
+
+    def test_max_memory_unsupported(self):
+        env.clear()
+        result = env.run('kmlutil test-data/A-folderize-acid-test.kml --paths-only --max-memory 0.01', expect_error=True)
+
+        self.assertIn('--paths-only', result.stderr)
+
+    def test_feature_table(self):
+        env.clear()
+        for options in ['test-data/A-folderize-acid-test.kml --region Rect --optimize-paths --folderize "Crop Circles" --list --list-details',
+                        'test-data/0-test-misc.kml --optimize-paths --optimize-coordinates --path-error-limit 0.001 --stats',
+                        # the coordinates text is dropped from the tree as no kml is written
+                        'test-data/A-folderize-acid-test.kml --region Rect --optimize-paths --geojson',
+                        'test-data/2-test-us-states.kml --list --list-details --no-kml-out']:
+            elements = env.run('kmlutil %s' % options, expect_stderr=True)
+            table = env.run('kmlutil %s --feature-table' % options, expect_stderr=True)
+
+            self.assertEqual(elements.stdout, table.stdout)
+            self.assertEqual(elements.stderr, table.stderr)
+
+    def test_parse_jobs(self):
+        env.clear()
+        for options in ['test-data/A-folderize-acid-test.kml --region Rect --optimize-paths --folderize "Crop Circles" --list --list-details',
+                        'test-data/0-test-misc.kml --optimize-paths --path-error-limit 0.001 --stats',
+                        'test-data/8-google-samples.kml --geojson']:
+            elements = env.run('kmlutil %s' % options, expect_stderr=True)
+            workers = env.run('kmlutil %s --parse-jobs 2 -v' % options, expect_stderr=True)
+
+            self.assertEqual(elements.stdout, workers.stdout)
+            self.assertIn('decoded in 2 worker processes', workers.stderr)
+
+    def test_pipeline(self):
+        env.clear()
+        for options in ['test-data/0-test-misc.kml --optimize-paths --optimize-coordinates --path-error-limit 0.001',
+                        'test-data/0-test-misc.kml --serialize-names',
+                        'test-data/7-multigeometry.kml --optimize-paths']:
+            whole = env.run('kmlutil %s' % options, expect_stderr=True)
+            piped = env.run('kmlutil %s --pipeline -v' % options, expect_stderr=True)
+
+            self.assertEqual(whole.stdout, piped.stdout)
+            self.assertIn('copied by the pipeline', piped.stderr)
+
+        result = env.run('kmlutil test-data/0-test-misc.kml --pipeline --paths-only', expect_stderr=True)
+        self.assertIn('--pipeline was not used', result.stderr)
+        self.assertIn('--paths-only', result.stderr)
+
     def NOT_test_next(self):
         result = env.run('')
         raw = json.loads(result.stdout)
@@ -34,3 +34,43 @@ class TestFromCommandLine(unittest.TestCase):
         result = env.run('kmlutil test-data/5-poly-geojson.kml --region Test --region-file README.md', expect_error=True)
 
         self.assertRegexpMatches(result.stderr, ur'^KMLUTIL ERROR.*(Error parsing|parsing error)')
+
+    def test_geojson_input(self):
+        env.clear()
+        exported = env.run('kmlutil test-data/8-google-samples.kml --geojson', expect_stderr=True)
+        env.writefile('samples.geojson', content=exported.stdout)
+
+        result = env.run('kmlutil scratch/samples.geojson --geojson', expect_stderr=True)
+
+        self.assertEqual(json.loads(exported.stdout), json.loads(result.stdout))
+
+        result = env.run('kmlutil scratch/samples.geojson', expect_stderr=True)
+
+        doc = objectify.fromstring(result.stdout)
+        styles = doc.xpath('//*[local-name()="Document"]/*[local-name()="Style"]/@id')
+        self.assertEqual(len(styles), len(set(styles)))
+        for ref in doc.xpath('//*[local-name()="styleUrl"]/text()'):
+            self.assertIn(ref[1:], styles)
+        self.assertEqual(['Polygons', 'Google Campus'], doc.xpath('//*[local-name()="Placemark"][*[local-name()="name"]="Building 40"]/ancestor::*[local-name()="Folder"]/*[local-name()="name"]/text()'))
+
+    def test_geojson_seq_input(self):
+        env.clear()
+        env.writefile('features.geojsonl', content='{"type": "Feature", "properties": {"name": "One", "stroke": "#ff0000", "id": 7}, '
+                                                   '"geometry": {"type": "LineString", "coordinates": [[1, 2], [3, 4]]}}\n'
+                                                   '\x1e{"type": "Point", "coordinates": [5.5, 6.25, 10]}\n')
+
+        result = env.run('kmlutil scratch/features.geojsonl', expect_stderr=True)
+
+        doc = objectify.fromstring(result.stdout)
+        placemarks = doc.xpath('//*[local-name()="Placemark"]')
+        self.assertEqual(2, len(placemarks))
+        self.assertEqual('ff0000ff', doc.Document.Style.LineStyle.color.text)
+        self.assertEqual('7', placemarks[0].ExtendedData.Data.value.text)
+        self.assertEqual('5.5,6.25,10', placemarks[1].Point.coordinates.text)
+
+    def test_geojson_parse_error(self):
+        env.clear()
+        env.writefile('broken.geojson', content='{"type": "FeatureCollection", "features": [{"type": "Feature",')
+        result = env.run('kmlutil scratch/broken.geojson', expect_error=True)
+
+        self.assertRegexpMatches(result.stderr, ur'^KMLUTIL ERROR.*json parsing error')
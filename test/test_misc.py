@@ -1,6 +1,12 @@
 __author__ = 'mscalora'
 
+import os
 import unittest
+import json
+import bz2
+import gzip
+import struct
+import sqlite3
 from utils4test import *
 from scripttest import TestFileEnvironment
 from lxml import objectify, etree as lxml_et
@@ -9,6 +15,37 @@ import utils4test
 env = TestFileEnvironment('scratch', cwd='.')
 
 
+def read_wkb(data, pos=0):
+    """
+    GeoJSON style (type, coordinates) of little endian ISO WKB, and the position after it
+    """
+    code, = struct.unpack_from('<I', data, pos + 1)
+    pos += 5
+    dims = 3 if code > 1000 else 2
+    kind = ['Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon'][code % 1000 - 1]
+
+    def positions(pos):
+        count, = struct.unpack_from('<I', data, pos)
+        values = struct.unpack_from('<%dd' % (count * dims), data, pos + 4)
+        return [list(values[i:i + dims]) for i in range(0, len(values), dims)], pos + 4 + 8 * len(values)
+
+    if kind == 'Point':
+        return (kind, list(struct.unpack_from('<%dd' % dims, data, pos))), pos + 8 * dims
+    if kind == 'LineString':
+        coords, pos = positions(pos)
+        return (kind, coords), pos
+    count, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    coords = []
+    for _ in range(count):
+        if kind == 'Polygon':
+            ring, pos = positions(pos)
+        else:
+            (_, ring), pos = read_wkb(data, pos)
+        coords.append(ring)
+    return (kind, coords), pos
+
+
 class TestFromCommandLine(unittest.TestCase):
 
     def test_paths_only(self):
@@ -70,6 +107,51 @@ class TestFromCommandLine(unittest.TestCase):
 
         self.assertRegexpMatches(result.stdout, ur'kml\s.*www\.opengis\.net/kml/2\.2')
 
+    def test_stdin_namespaces(self):
+        env.clear()
+        with open('test-data/A-folderize-acid-test.kml', 'rb') as kml_file:
+            kml = kml_file.read()
+
+        result = env.run('kmlutil - --namespaces --list', stdin=kml)
+
+        self.assertRegexpMatches(result.stdout, ur'kml\s.*www\.opengis\.net/kml/2\.2')
+        self.assertIn('Crop Circles', result.stdout)
+
+    def test_stdin_read_once(self):
+        env.clear()
+        with open('test-data/A-folderize-acid-test.kml', 'rb') as kml_file:
+            kml = kml_file.read()
+
+        for options in ['--combine -', '--region Rect', '--region Rect --region-file -']:
+            result = env.run('kmlutil - --no-kml %s' % options, stdin=kml, expect_error=True)
+
+            self.assertIn('stdin can only be read once', result.stderr)
+
+        result = env.run('kmlutil - --tree --region Rect --region-file test-data/A-folderize-acid-test.kml', stdin=kml,
+                         expect_stderr=True)
+
+        self.assertIn('Crop Circles', result.stdout)
+
+    def test_compressed(self):
+        env.clear()
+        plain = env.run('kmlutil test-data/8-google-samples.kml', expect_stderr=True)
+        with open('test-data/8-google-samples.kml', 'rb') as kml_file:
+            kml = kml_file.read()
+        gz_file = gzip.open('scratch/samples.kml.gz', 'wb')
+        gz_file.write(kml)
+        gz_file.close()
+
+        result = env.run('kmlutil scratch/samples.kml.gz --namespaces -O scratch/out.kml.bz2 --compress-level 1', expect_stderr=True)
+
+        self.assertIn('out.kml.bz2', result.files_created)
+        self.assertEqual(plain.stdout, bz2.BZ2File('scratch/out.kml.bz2').read())
+        self.assertRegexpMatches(result.stderr, ur'www\.opengis\.net/kml/2\.2')
+
+        result = env.run('kmlutil - --namespaces --list', stdin=open('scratch/samples.kml.gz', 'rb').read())
+
+        self.assertRegexpMatches(result.stdout, ur'www\.opengis\.net/kml/2\.2')
+        self.assertIn('The Pentagon', result.stdout)
+
     def test_combine(self):
         env.clear()
 
@@ -79,5 +161,187 @@ class TestFromCommandLine(unittest.TestCase):
 
         self.assertLess(counts.Placemark.pre_count, counts.Placemark.post_count)
 
+    def test_geojson_pretty_matches_compact(self):
+        env.clear()
+
+        compact = env.run('kmlutil test-data/0-test-misc.kml --geojson', expect_stderr=True)
+        pretty = env.run('kmlutil test-data/0-test-misc.kml --geojson --pretty-print', expect_stderr=True)
+
+        collection = json.loads(compact.stdout)
+        self.assertEqual('FeatureCollection', collection['type'])
+        self.assertEqual(collection, json.loads(pretty.stdout))
+
+    def test_geojson_geometries(self):
+        env.clear()
+
+        result = env.run('kmlutil test-data/8-google-samples.kml --geojson', expect_stderr=True)
+
+        features = dict((feature['properties']['name'], feature) for feature in json.loads(result.stdout)['features'])
+        pentagon = features['The Pentagon']
+        self.assertEqual('Polygon', pentagon['geometry']['type'])
+        self.assertEqual(2, len(pentagon['geometry']['coordinates']))
+        self.assertEqual('Polygons/Extruded Polygon', pentagon['properties']['folder'])
+        self.assertIn('fill', pentagon['properties'])
+        self.assertEqual('Point', features['Floating placemark']['geometry']['type'])
+        self.assertEqual('Floats a defined distance above the ground.', features['Floating placemark']['properties']['description'])
+
+        result = env.run('kmlutil test-data/7-multigeometry.kml --geojson', expect_stderr=True)
+
+        types = set(feature['geometry']['type'] for feature in json.loads(result.stdout)['features'])
+        self.assertEqual(set(['MultiLineString', 'Point']), types)
+
+    def test_output_gpkg(self):
+        env.clear()
+
+        exported = json.loads(env.run('kmlutil test-data/8-google-samples.kml --geojson', expect_stderr=True).stdout)
+        result = env.run('kmlutil test-data/8-google-samples.kml --output-format gpkg -O scratch/samples.gpkg', expect_stderr=True)
+
+        self.assertIn('samples.gpkg', result.files_created)
+        db = sqlite3.connect('scratch/samples.gpkg')
+        self.assertEqual(0x47504B47, db.execute('PRAGMA application_id').fetchone()[0])
+        self.assertEqual([('placemarks', 'features')], db.execute('SELECT table_name, data_type FROM gpkg_contents').fetchall())
+        rows = db.execute('SELECT geom, name, folder, stroke, fill_opacity FROM placemarks ORDER BY fid').fetchall()
+        self.assertEqual(len(exported['features']), len(rows))
+        for feature, (geom, name, folder, stroke, fill_opacity) in zip(exported['features'], rows):
+            properties = feature['properties']
+            self.assertEqual('GP', str(geom[:2]))
+            (kind, coords), _ = read_wkb(str(geom[40:]))
+            self.assertEqual((feature['geometry']['type'], feature['geometry']['coordinates']), (kind, coords))
+            self.assertEqual((properties.get('name'), properties.get('folder'), properties.get('stroke'), properties.get('fill-opacity')),
+                             (name, folder, stroke, fill_opacity))
+
+        # the pentagon, by bounding box
+        found = db.execute('SELECT name FROM placemarks JOIN rtree_placemarks_geom ON id = fid '
+                           'WHERE maxx >= -77.06 AND minx <= -77.05 AND maxy >= 38.87 AND miny <= 38.875').fetchall()
+        self.assertEqual([('The Pentagon',)], found)
+        db.close()
+
+    def test_output_gpkg_needs_file(self):
+        env.clear()
+
+        result = env.run('kmlutil test-data/0-test-misc.kml --output-format gpkg', expect_error=True)
+
+        self.assertIn('--output-file', result.stderr)
+
+    def test_geojson_seq(self):
+        env.clear()
+
+        collection = json.loads(env.run('kmlutil test-data/0-test-misc.kml --geojson', expect_stderr=True).stdout)
+        result = env.run('kmlutil test-data/0-test-misc.kml --geojson-seq', expect_stderr=True)
+
+        features = [json.loads(line) for line in result.stdout.splitlines() if line.strip()]
+        self.assertEqual(len(collection['features']), len(features))
+        self.assertEqual(collection['features'], features)
+
+    def test_snapshot(self):
+        env.clear()
+        env.run('cp test-data/8-google-samples.kml scratch/samples.kml')
+
+        parsed = env.run('kmlutil scratch/samples.kml --geojson --save-snapshot scratch/samples.snapshot', expect_stderr=True)
+        loaded = env.run('kmlutil scratch/samples.kml --geojson --load-snapshot scratch/samples.snapshot -v', expect_stderr=True)
+
+        self.assertIn('samples.snapshot', parsed.files_created)
+        self.assertIn('loaded from snapshot', loaded.stderr)
+        self.assertEqual(parsed.stdout, loaded.stdout)
+
+        with open('scratch/samples.kml', 'a') as kml_file:
+            kml_file.write('\n')
+        stale = env.run('kmlutil scratch/samples.kml --geojson --load-snapshot scratch/samples.snapshot', expect_stderr=True)
+
+        self.assertIn('was not used, the size of the input changed', stale.stderr)
+        self.assertEqual(parsed.stdout, stale.stdout)
+
+        # same size and modification time, other content, only found when the content is verified
+        # whole seconds, utime() can't set the nanoseconds stat() reports
+        mtime = int(os.stat('scratch/samples.kml').st_mtime) - 10
+        os.utime('scratch/samples.kml', (mtime, mtime))
+        env.run('kmlutil scratch/samples.kml --geojson --save-snapshot scratch/samples.snapshot', expect_stderr=True)
+        with open('scratch/samples.kml', 'r+') as kml_file:
+            kml_file.seek(-1, os.SEEK_END)
+            kml_file.write(' ')
+        os.utime('scratch/samples.kml', (mtime, mtime))
+        trusted = env.run('kmlutil scratch/samples.kml --geojson --load-snapshot scratch/samples.snapshot', expect_stderr=True)
+        verified = env.run('kmlutil scratch/samples.kml --geojson --load-snapshot scratch/samples.snapshot --verify-snapshot',
+                           expect_stderr=True)
+
+        self.assertNotIn('was not used', trusted.stderr)
+        self.assertIn('was not used, the content of the input changed', verified.stderr)
+
+    def test_index(self):
+        env.clear()
+        env.run('cp test-data/A-folderize-acid-test.kml scratch/acid.kml')
+        extracted = env.run('kmlutil scratch/acid.kml --extract Rect --extract Wow', expect_stderr=True)
+        listed = env.run('kmlutil scratch/acid.kml --tree --list-with-xpaths', expect_stderr=True)
+
+        built = env.run('kmlutil scratch/acid.kml --index -v --extract Rect --extract Wow', expect_stderr=True)
+        indexed = env.run('kmlutil scratch/acid.kml --index -v --extract Rect --extract Wow', expect_stderr=True)
+
+        self.assertIn('acid.kml.kmlidx', built.files_created)
+        self.assertIn('building the index', built.stderr)
+        self.assertNotIn('building the index', indexed.stderr)
+        self.assertIn('2 of 29 features parsed using the index', indexed.stderr)
+        self.assertEqual(extracted.stdout, indexed.stdout)
+        self.assertEqual(listed.stdout, env.run('kmlutil scratch/acid.kml --index --tree --list-with-xpaths', expect_stderr=True).stdout)
+
+        with open('scratch/acid.kml', 'a') as kml_file:
+            kml_file.write('\n')
+        stale = env.run('kmlutil scratch/acid.kml --index -v --dump-path "In Hole"', expect_stderr=True)
+
+        self.assertIn('building the index', stale.stderr)
+        self.assertEqual(env.run('kmlutil scratch/acid.kml --dump-path "In Hole"', expect_stderr=True).stdout, stale.stdout)
+
+    def test_index_short_tuples(self):
+        env.clear()
+        with open('scratch/short.kml', 'w') as kml_file:
+            kml_file.write('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                           '<Placemark><name>odd</name><LineString><coordinates>1,2 3,4,5 6</coordinates></LineString></Placemark>'
+                           '<Placemark><name>one</name><Point><coordinates>7</coordinates></Point></Placemark>'
+                           '</Document></kml>')
+
+        indexed = env.run('kmlutil scratch/short.kml --index --list', expect_stderr=True)
+
+        self.assertIn('short.kml.kmlidx', indexed.files_created)
+        self.assertEqual(env.run('kmlutil scratch/short.kml --list', expect_stderr=True).stdout, indexed.stdout)
+
+    def test_profile(self):
+        env.clear()
+
+        result = env.run('kmlutil test-data/0-test-misc.kml --list --paths-only --profile --profile-format json --profile-dump scratch/run.prof', expect_stderr=True)
+
+        report = json.loads(result.stderr)
+        stages = [stage['stage'] for stage in report['stages']]
+
+        self.assertEqual(['parse_kml', 'paths_only', 'print_list', 'write_kml'], stages)
+        self.assertGreater(report['stages'][1]['elements_in'], report['stages'][1]['elements_out'])
+        self.assertIn('run.prof', result.files_created)
+
+    def test_progress_json(self):
+        env.clear()
+
+        env.run('kmlutil test-data/0-test-misc.kml --no-kml --optimize-paths --progress-json scratch/progress.jsonl --progress-interval 0')
+
+        with open('scratch/progress.jsonl') as progress_file:
+            events = [json.loads(line) for line in progress_file]
+
+        self.assertEqual('start', events[0]['event'])
+        self.assertEqual({'event': 'end', 'status': 'ok'}, {k: events[-1][k] for k in ['event', 'status']})
+        self.assertIn('optimize_paths', [event['stage'] for event in events if event['event'] == 'stage_end'])
+        counters = set(event['counter'] for event in events if event['event'] == 'progress')
+        self.assertIn('bytes_parsed', counters)
+        self.assertIn('placemarks_simplified', counters)
+
+    def test_progress_json_stage_error(self):
+        env.clear()
+
+        result = env.run('kmlutil test-data/0-test-misc.kml --no-kml --region "No Such Region" --progress-json scratch/progress.jsonl',
+                         expect_error=True, expect_stderr=True)
+
+        with open('scratch/progress.jsonl') as progress_file:
+            events = [json.loads(line) for line in progress_file]
+
+        self.assertEqual({'event': 'stage_end', 'stage': 'region', 'status': 'error'},
+                         {k: events[-2][k] for k in ['event', 'stage', 'status']})
+        self.assertEqual({'event': 'end', 'status': 'error'}, {k: events[-1][k] for k in ['event', 'status']})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,185 @@
+__author__ = 'mscalora'
+
+import os
+import gc
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from attrdict import AttrDict
+
+import kmlutil
+import synthkml
+
+# doubling the input may not cost more than this factor in run time, allows for noise over linear growth
+max_growth = 2.2
+base_scale = 16
+runs = 5
+# a quadratic stage fails every attempt, noise from other work on the machine rarely does
+attempts = 3
+# the call counts are exact, doubling the input may not cost more than this factor in calls in the normal suite
+max_call_growth = 2.5
+call_scale = 4
+# the timing tests take a while and depend on the load of the machine, they only run when this is set, e.g.
+# KMLUTIL_PERFORMANCE_TESTS=1 python -m pytest test/test_performance.py
+enable_variable = 'KMLUTIL_PERFORMANCE_TESTS'
+
+
+def generate(path, scale, seed):
+    with open(path, 'wb') as out_file:
+        synthkml.generate(out_file, folders=4 * scale, placemarks=50, points=4, styles=10 * scale, boundaries=4, seed=seed)
+    return path
+
+
+def make_options(kml_file, **overrides):
+    options = AttrDict(dict(kmlutil.defaults))
+    options.kmlfile = kml_file
+    for name in ['out_kml', 'out_list', 'out_stats', 'out_nsmap']:
+        options[name] = None
+    options.out_diag = StringIO()
+    for name, value in overrides.items():
+        options[name] = value
+    return options
+
+
+def call_count(kml_file, **overrides):
+    """
+    python and builtin function calls made by a run of kmlutil.process(), the same on every run of the same input
+    """
+    calls = [0]
+
+    def count(frame, event, arg):
+        if event == 'call' or event == 'c_call':
+            calls[0] += 1
+
+    options = make_options(kml_file, **overrides)
+    sys.setprofile(count)
+    try:
+        kmlutil.process(options)
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+
+def stage_time(kml_file, stage, **overrides):
+    """
+    time spent in one stage by a run of kmlutil.process()
+    """
+    options = make_options(kml_file, profile=True, profile_format='json', **overrides)
+
+    gc.collect()
+    kmlutil.process(options)
+
+    report = options.out_diag.getvalue()
+    records = json.loads(report[report.index('{'):])['stages']
+    return sum(record['wall'] for record in records if record['stage'] == stage)
+
+
+class TestCallCounts(unittest.TestCase):
+    """
+    the calls a stage adds to a run grow linearly with the input, a quadratic loop in python fails this on every run,
+    work done inside lxml, like an xpath over the whole document per feature, is only seen by the timing tests
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.files = {}
+        for scale in [call_scale, call_scale * 2]:
+            cls.files[scale] = (generate(os.path.join(cls.temp_dir, 'doc-%d.kml' % scale), scale, 1),
+                                generate(os.path.join(cls.temp_dir, 'combine-%d.kml' % scale), scale, 2))
+        # modules imported on first use are not counted
+        call_count(cls.files[call_scale][0])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def assertCallsScaleLinearly(self, **overrides):
+        calls = []
+        for scale in [call_scale, call_scale * 2]:
+            kml_file, combine_file = self.files[scale]
+            options = dict((name, combine_file if value == '{combine}' else value) for name, value in overrides.items())
+            calls.append(call_count(kml_file, **options) - call_count(kml_file))
+
+        self.assertLessEqual(float(calls[1]) / calls[0], max_call_growth,
+                             "%s: %d calls for %dx input, %d calls for 2x input" % (overrides.keys(), calls[0], call_scale, calls[1]))
+
+    def test_optimize_styles(self):
+        self.assertCallsScaleLinearly(optimize_styles=True)
+
+    def test_combine_kml(self):
+        self.assertCallsScaleLinearly(combine='{combine}')
+
+    def test_folderize(self):
+        self.assertCallsScaleLinearly(folderize=['%Boundary '])
+
+
+@unittest.skipUnless(os.environ.get(enable_variable), 'set %s to run the timing tests' % enable_variable)
+class TestPerformance(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.files = {}
+        for scale in [base_scale, base_scale * 2]:
+            cls.files[scale] = (generate(os.path.join(cls.temp_dir, 'doc-%d.kml' % scale), scale, 1),
+                                generate(os.path.join(cls.temp_dir, 'combine-%d.kml' % scale), scale, 2))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def assertScalesLinearly(self, stage, **overrides):
+        for _ in range(attempts):
+            # best of several runs, alternating between the sizes so a busy moment on the machine affects both
+            times = [None, None]
+            for _ in range(runs):
+                for i, scale in enumerate([base_scale, base_scale * 2]):
+                    kml_file, combine_file = self.files[scale]
+                    options = dict((name, combine_file if value == '{combine}' else value) for name, value in overrides.items())
+                    wall = stage_time(kml_file, stage, **options)
+                    times[i] = wall if times[i] is None else min(times[i], wall)
+            if times[1] / times[0] <= max_growth:
+                break
+
+        self.assertLessEqual(times[1] / times[0], max_growth,
+                             "%s: %.3fs for %dx input, %.3fs for 2x input" % (stage, times[0], base_scale, times[1]))
+
+    def test_optimize_styles(self):
+        self.assertScalesLinearly('optimize_styles', optimize_styles=True)
+
+    def test_combine_kml(self):
+        # the combine documents use the same style ids as the main documents so every style is renamed
+        self.assertScalesLinearly('combine_kml', combine='{combine}')
+
+    def test_folderize(self):
+        self.assertScalesLinearly('folderize', folderize=['%Boundary '])
+
+
+class TestCombine(unittest.TestCase):
+
+    def test_combine_with_itself(self):
+        # every id collides, the copies must get new ids and their own references
+        options = AttrDict(dict(kmlutil.defaults))
+        options.kmlfile = 'test-data/Styles.kml'
+        options.combine = 'test-data/Styles.kml'
+        options.out_kml = StringIO()
+        for name in ['out_list', 'out_stats', 'out_nsmap']:
+            options[name] = None
+        options.out_diag = StringIO()
+
+        kmlutil.process(options)
+
+        result = kmlutil.objectify.fromstring(options.out_kml.getvalue())
+        ids = result.xpath('//@id')
+        self.assertEqual(len(ids), len(set(ids)))
+        for ref in result.xpath("//*[local-name()='styleUrl']/text()"):
+            self.assertIn(ref[1:], ids)
+        self.assertNotIn('Warning', options.out_diag.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+__author__ = 'mscalora'
+
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+from cStringIO import StringIO
+from attrdict import AttrDict
+from lxml import etree as lxml_et
+
+import kmlutil
+
+
+def make_options(**overrides):
+    options = AttrDict(dict(kmlutil.defaults))
+    options.out_kml = StringIO()
+    options.out_stats = StringIO()
+    options.out_list = StringIO()
+    options.out_diag = StringIO()
+    options.out_nsmap = None
+    for name, value in overrides.items():
+        options[name] = value
+    return options
+
+
+class TestKMLProcessor(unittest.TestCase):
+
+    def test_process_wrapper(self):
+        options = make_options(kmlfile='test-data/0-test-misc.kml', list=True)
+
+        kmlutil.process(options)
+
+        self.assertIn('Path with Inline Style', options.out_list.getvalue())
+        self.assertEqual('{http://www.opengis.net/kml/2.2}kml', lxml_et.fromstring(options.out_kml.getvalue()).tag)
+
+    def test_concurrent_processors(self):
+        jobs = [
+            ('test-data/0-test-misc.kml', dict(paths_only=True, stats=True, stats_format='json')),
+            ('test-data/1-test-hand-edit.kml', dict(list=True, tree=True)),
+            ('test-data/2-test-us-states.kml', dict(extract=['Utah'], stats=True)),
+            ('test-data/A-folderize-acid-test.kml', dict(optimize_paths=True, list=True, list_detail=True)),
+        ] * 3
+
+        def run(kml_file, overrides):
+            options = make_options(kmlfile=kml_file, **overrides)
+            kmlutil.KMLProcessor(options).run()
+            return options
+
+        expected = [run(kml_file, overrides) for kml_file, overrides in jobs]
+
+        results = [None] * len(jobs)
+
+        def worker(index):
+            results[index] = run(*jobs[index])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(jobs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for want, got in zip(expected, results):
+            for stream in ['out_kml', 'out_stats', 'out_list']:
+                self.assertEqual(want[stream].getvalue(), got[stream].getvalue())
+
+    def test_verbosity_is_per_processor(self):
+        traced = make_options(kmlfile='test-data/0-test-misc.kml', list=True, debug=True)
+        quiet = make_options(kmlfile='test-data/0-test-misc.kml', list=True, verbose=5)
+
+        kmlutil.KMLProcessor(traced)
+        kmlutil.KMLProcessor(quiet).run()
+
+        self.assertNotIn('TRACE: xpath', quiet.out_diag.getvalue())
+
+        kmlutil.KMLProcessor(traced).run()
+        self.assertIn('TRACE: xpath', traced.out_diag.getvalue())
+
+    def test_progress_file_closed(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'progress.jsonl')
+        processor = kmlutil.KMLProcessor(make_options(kmlfile='test-data/0-test-misc.kml', progress_json=path))
+
+        processor.run()
+
+        self.assertTrue(processor.reporter.out_file.closed)
+        with open(path) as progress_file:
+            self.assertIn('"event": "end"', progress_file.read().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+__author__ = 'mscalora'
+
+import os
+import json
+import shutil
+import socket
+import httplib
+import tempfile
+import unittest
+import threading
+import urllib2
+from cStringIO import StringIO
+from attrdict import AttrDict
+from scripttest import TestFileEnvironment
+
+import kmlutil
+import server
+
+env = TestFileEnvironment('scratch', cwd='.')
+
+
+def run_direct(**options):
+    args = AttrDict(dict(kmlutil.defaults))
+    args.out_kml = StringIO()
+    args.out_stats = StringIO()
+    args.out_list = StringIO()
+    args.out_diag = StringIO()
+    args.out_nsmap = args.out_list
+    for name, value in options.items():
+        args[name] = value
+    kmlutil.KMLProcessor(args).run()
+    return args
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class TestKMLService(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.service = server.KMLService()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cache_hits_and_same_results(self):
+        requests = [
+            dict(list=True, list_detail=True),
+            dict(stats=True, stats_format='json'),
+            dict(list=True, extract=['Test Data']),
+            dict(paths_only=True),
+            dict(dump_path=['Path with Inline Style']),
+            dict(tree=True, pretty_print=True),
+        ]
+        for options in requests:
+            direct = run_direct(kmlfile='test-data/0-test-misc.kml', **options)
+            status, response = self.service.handle({'options': dict(kmlfile='test-data/0-test-misc.kml', **options)})
+
+            self.assertEqual(200, status)
+            self.assertEqual('ok', response['status'])
+            self.assertEqual(direct.out_list.getvalue(), response['list'])
+            self.assertEqual(direct.out_stats.getvalue(), response['stats'])
+            if server.wants_kml_output(direct, {}):
+                self.assertEqual(direct.out_kml.getvalue(), response['output'])
+
+        status = self.service.cache.status()
+        self.assertEqual(1, status['misses'])
+        self.assertEqual(len(requests) - 1, status['hits'])
+
+    def test_feature_table_keeps_cached_document(self):
+        kml_file = 'test-data/A-folderize-acid-test.kml'
+        before = self.service.handle({'options': {'kmlfile': kml_file}})[1]['output']
+
+        status, response = self.service.handle({'options': {'kmlfile': kml_file, 'list': True, 'list_detail': True,
+                                                            'feature_table': True}})
+        self.assertEqual(200, status)
+        self.assertEqual(run_direct(kmlfile=kml_file, list=True, list_detail=True).out_list.getvalue(), response['list'])
+
+        status, response = self.service.handle({'options': {'kmlfile': kml_file}})
+        self.assertEqual('hit', response['cache'])
+        self.assertEqual(before, response['output'])
+
+    def test_modified_file_is_reparsed(self):
+        kml_file = os.path.join(self.temp_dir, 'doc.kml')
+        shutil.copy('test-data/0-test-misc.kml', kml_file)
+
+        self.assertEqual('miss', self.service.handle({'options': {'kmlfile': kml_file, 'list': True}})[1]['cache'])
+        self.assertEqual('hit', self.service.handle({'options': {'kmlfile': kml_file, 'list': True}})[1]['cache'])
+
+        with open(kml_file) as original:
+            content = original.read().replace('Path with Inline Style', 'Renamed Path')
+        with open(kml_file, 'w') as changed:
+            changed.write(content)
+        os.utime(kml_file, (1, 1))
+
+        status, response = self.service.handle({'options': {'kmlfile': kml_file, 'list': True}})
+        self.assertEqual('miss', response['cache'])
+        self.assertIn('Renamed Path', response['list'])
+
+    def test_memory_limit_evicts_least_recently_used(self):
+        self.service.cache.max_bytes = 250 * 1024
+        for kml_file in ['test-data/0-test-misc.kml', 'test-data/1-test-hand-edit.kml', 'test-data/0-test-misc.kml',
+                         'test-data/Styles.kml']:
+            self.service.handle({'options': {'kmlfile': kml_file, 'list': True}})
+
+        status = self.service.cache.status()
+        self.assertLessEqual(status['bytes'], status['max_bytes'])
+        self.assertEqual([os.path.abspath('test-data/0-test-misc.kml'), os.path.abspath('test-data/Styles.kml')],
+                         status['paths'])
+
+    def test_invalid_requests(self):
+        self.assertEqual(400, self.service.handle({})[0])
+        self.assertEqual(400, self.service.handle({'options': {'list': True}})[0])
+        self.assertEqual(400, self.service.handle({'options': {'kmlfile': 'a.kml', 'output_file': 'b.kml'}})[0])
+        for name, value in [('save_snapshot', 'b.snap'), ('profile_dump', 'b.prof'), ('parse_jobs', 2), ('index', True),
+                            ('output_format', 'gpkg'), ('max_memory', 1)]:
+            status, response = self.service.handle({'options': {'kmlfile': 'test-data/0-test-misc.kml', name: value}})
+            self.assertEqual(400, status)
+            self.assertIn(name, response['message'])
+
+        status, response = self.service.handle({'options': {'kmlfile': 'test-data/does-not-exist.kml'}})
+        self.assertEqual(500, status)
+        self.assertEqual('error', response['status'])
+
+
+class TestServer(unittest.TestCase):
+
+    def serve(self, **kwargs):
+        httpd = server.make_server(server.KMLService(), **kwargs)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        return httpd
+
+    def test_concurrent_http_requests(self):
+        httpd = self.serve(port=0, threads=3)
+        url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+        jobs = [
+            ('test-data/0-test-misc.kml', dict(list=True)),
+            ('test-data/1-test-hand-edit.kml', dict(list=True, tree=True)),
+            ('test-data/A-folderize-acid-test.kml', dict(optimize_paths=True, list=True, list_detail=True)),
+            ('test-data/1-test-hand-edit.kml', dict(paths_only=True)),
+        ] * 3
+        results = [None] * len(jobs)
+
+        def worker(index):
+            kml_file, options = jobs[index]
+            body = json.dumps({'options': dict(kmlfile=kml_file, **options)})
+            results[index] = json.loads(urllib2.urlopen(url, body).read())
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(jobs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for (kml_file, options), response in zip(jobs, results):
+            direct = run_direct(kmlfile=kml_file, **options)
+            self.assertEqual('ok', response['status'])
+            self.assertEqual(direct.out_list.getvalue(), response['list'])
+
+        status = json.loads(urllib2.urlopen(url + 'status').read())
+        self.assertEqual(3, status['cache']['documents'])
+
+    def test_unix_socket(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), 'kmlutil.sock')
+        self.addCleanup(shutil.rmtree, os.path.dirname(socket_path))
+        self.serve(socket_path=socket_path)
+
+        connection = UnixHTTPConnection(socket_path)
+        connection.request('POST', '/', json.dumps({'options': {'kmlfile': 'test-data/Styles.kml', 'list': True}}))
+        response = json.loads(connection.getresponse().read())
+
+        self.assertEqual('ok', response['status'])
+        self.assertEqual(run_direct(kmlfile='test-data/Styles.kml', list=True).out_list.getvalue(), response['list'])
+
+    def test_serve_command_help(self):
+        result = env.run('kmlutil serve --help')
+
+        self.assertIn('--cache-memory', result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
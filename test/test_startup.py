@@ -0,0 +1,45 @@
+__author__ = 'mscalora'
+
+import sys
+import json
+import unittest
+import subprocess
+
+heavy_modules = ['lxml', 'pykml', 'json', 'simplify', 'ordered_set', 'copy']
+
+
+def importtime(*args):
+    output = subprocess.check_output([sys.executable, 'tools/importtime.py', '--json'] + list(args), stderr=open('/dev/null', 'w'))
+    return json.loads(output)
+
+
+def heavy(loaded):
+    return [name for name in loaded if name.split('.')[0] in heavy_modules]
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_help_does_not_load_heavy_modules(self):
+        self.assertEqual([], heavy(importtime('kmlutil')['loaded']))
+        self.assertEqual([], heavy(importtime('--cli=--help')['loaded']))
+
+    def test_namespaces_does_not_parse(self):
+        report = importtime('--cli=test-data/0-test-misc.kml --namespaces')
+
+        self.assertEqual([], heavy(report['loaded']))
+
+    def test_list_loads_parser(self):
+        report = importtime('--cli=test-data/0-test-misc.kml --list')
+
+        self.assertIn('pykml.parser', report['loaded'])
+
+    def test_compression_loaded_on_use(self):
+        for args in [('kmlutil',), ('--cli=--help',)]:
+            self.assertNotIn('compression', importtime(*args)['loaded'])
+        # reading input checks for compression, the decompressors are only loaded for compressed input
+        loaded = importtime('--cli=test-data/0-test-misc.kml --namespaces')['loaded']
+        self.assertEqual([], [name for name in loaded if name in ('gzip', 'bz2', 'zlib')])
+
+
+if __name__ == '__main__':
+    unittest.main()
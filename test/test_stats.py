@@ -117,3 +117,31 @@ class TestFromCommandLine(unittest.TestCase):
             else:
                 msg = "Counts not equal for %s, were %s and %s" % (tag, stats[tag].pre_count, stats[tag].post_count)
                 self.assertEqual(stats[tag].pre_count, stats[tag].post_count, msg=msg)
+
+    def test_stream_stats_matches_stats(self):
+        env.clear()
+        for test_file in ['0-test-misc.kml', '1-test-hand-edit.kml', 'Styles.kml', '7-multigeometry.kml']:
+            for stats_format in ['json', 'text']:
+                expected = env.run('kmlutil test-data/%s --stats --stats-detail --no-kml --stats-format %s' % (test_file, stats_format), expect_stderr=True)
+                result = env.run('kmlutil test-data/%s --stream-stats --stats-detail --stats-format %s' % (test_file, stats_format), expect_stderr=True)
+
+                self.assertEqual(expected.stdout, result.stdout, msg='Streaming stats differ for %s in %s format' % (test_file, stats_format))
+                self.assertEqual(expected.stderr, result.stderr, msg='Streaming notes differ for %s in %s format' % (test_file, stats_format))
+
+    def test_stream_stats_external_style_url(self):
+        env.clear()
+        # the external references must not be taken for the local style with the same id
+        with open('scratch/external.kml', 'w') as kml_file:
+            kml_file.write('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                           '<Style id="red"><LineStyle><color>ff0000ff</color><width>4</width></LineStyle></Style>'
+                           '<Placemark><styleUrl>other.kml#red</styleUrl><LineString><coordinates>0,0 1,1</coordinates></LineString></Placemark>'
+                           '<Placemark><styleUrl>red</styleUrl><LineString><coordinates>0,0 1,1</coordinates></LineString></Placemark>'
+                           '<Placemark><styleUrl>#red</styleUrl><LineString><coordinates>0,0 1,1</coordinates></LineString></Placemark>'
+                           '</Document></kml>')
+
+        expected = env.run('kmlutil scratch/external.kml --stats --stats-detail --no-kml --stats-format json')
+        result = env.run('kmlutil scratch/external.kml --stream-stats --stats-detail --stats-format json')
+
+        self.assertEqual(expected.stdout, result.stdout)
+        self.assertEqual({'000000-3.0-1.0': 2, 'ff0000-4.0-1.0': 1},
+                         dict((style['sig'], style['count']) for style in json.loads(result.stdout)['path_style_counts']))
@@ -6,6 +6,8 @@ from utils4test import *
 from scripttest import TestFileEnvironment
 from lxml import objectify, etree as lxml_et
 
+import kmlutil
+
 env = TestFileEnvironment('scratch', cwd='.')
 
 
@@ -34,3 +36,91 @@ class TestFromCommandLine(unittest.TestCase):
 
         self.assertGreater(counts.Style.pre_count, counts.Style.post_count)
         self.assertGreater(counts.StyleMap.pre_count, counts.StyleMap.post_count)
+
+    def test_optimize_styles_compares_whole_style(self):
+        env.clear()
+        result = env.run('kmlutil test-data/8-google-samples.kml --optimize-styles')
+
+        etree = lxml_et.fromstring(result.stdout)
+        # the four polygon styles only differ in their PolyStyle color
+        colors = xpath(etree, '//k:Style[k:LineStyle/k:width="1.5"]/k:PolyStyle/k:color/text()')
+        self.assertEqual(4, len(set(colors)))
+
+    def test_optimize_styles_without_namespace(self):
+        env.clear()
+        style = '<Style id="%s"><LineStyle><color>ff0000ff</color><width>3</width></LineStyle></Style>'
+        with open('scratch/plain.kml', 'w') as kml_file:
+            kml_file.write('<kml><Document>' + style % 'a' + style % 'b' +
+                           '<Placemark><styleUrl>#a</styleUrl></Placemark><Placemark><styleUrl>#b</styleUrl></Placemark>'
+                           '</Document></kml>')
+        result = env.run('kmlutil scratch/plain.kml --optimize-styles')
+
+        etree = lxml_et.fromstring(result.stdout)
+        self.assertEqual(1, len(etree.xpath('//Style')))
+        self.assertEqual(1, len(set(etree.xpath('//styleUrl/text()'))))
+
+    def test_optimize_styles_references(self):
+        env.clear()
+        result = env.run('kmlutil test-data/0-test-misc.kml --optimize-styles')
+
+        etree = lxml_et.fromstring(result.stdout)
+        ids = xpath(etree, '//k:Document/k:Style/@id|//k:Document/k:StyleMap/@id')
+        refs = set(url[1:] for url in xpath(etree, '//k:styleUrl/text()'))
+        self.assertEqual(len(ids), len(set(ids)))
+        # every reference resolves and every shared style is used
+        self.assertEqual(set(ids), refs)
+
+    def test_hoist_styles(self):
+        env.clear()
+        result = env.run('kmlutil test-data/0-test-misc.kml --hoist-styles')
+
+        etree = lxml_et.fromstring(result.stdout)
+        self.assertEqual(0, xpath_count(etree, '//k:Placemark/k:Style|//k:Placemark/k:StyleMap'))
+        ids = xpath(etree, '//k:Document/k:Style/@id|//k:Document/k:StyleMap/@id')
+        self.assertEqual(len(ids), len(set(ids)))
+        # the hoisted styles are referenced in place of the inline ones
+        for name in ['Path with Inline Style', 'Path with Inline StyleMap']:
+            url = xpath(etree, '//k:Placemark[k:name="%s"]/k:styleUrl/text()' % name)
+            self.assertEqual(1, len(url))
+            self.assertIn(url[0][1:], ids)
+
+
+class TestStyleResolver(unittest.TestCase):
+
+    def test_resolve_style_map(self):
+        doc = objectify.parse('test-data/Styles.kml').getroot()
+        resolver = kmlutil.StyleResolver(doc)
+        placemark = xpath(doc, '//k:Placemark[k:name="Pole Canyon Trail"]')[0]
+
+        style = resolver.resolve(placemark)
+
+        self.assertEqual('1.1', style['normal']['IconStyle/scale'])
+        self.assertEqual('1.3', style['highlight']['IconStyle/scale'])
+        self.assertEqual('ff0080ff', style['normal']['LineStyle/color'])
+        self.assertIs(style, resolver.resolve(placemark))
+
+    def test_inline_style_wins(self):
+        doc = objectify.fromstring('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                                   '<Style id="shared"><LineStyle><color>ff0000ff</color><width>5</width></LineStyle></Style>'
+                                   '<Placemark><styleUrl>#shared</styleUrl><Style><LineStyle><color>ff00ff00</color>'
+                                   '</LineStyle></Style></Placemark>'
+                                   '<Placemark><styleUrl>#shared</styleUrl></Placemark>'
+                                   '</Document></kml>')
+        resolver = kmlutil.StyleResolver(doc)
+        inline, shared = xpath(doc, '//k:Placemark')
+
+        self.assertEqual(['00ff00', 5.0, 1.0], resolver.path_color_width_opacity(inline))
+        self.assertEqual(['ff0000', 5.0, 1.0], resolver.path_color_width_opacity(shared))
+
+    def test_canonical_keeps_order_of_repeated_children(self):
+        line = '<LineStyle><width>2</width></LineStyle>'
+        icons = ['<ItemIcon><state>open</state><href>a.png</href></ItemIcon>',
+                 '<ItemIcon><state>closed</state><href>b.png</href></ItemIcon>']
+        canonical = lambda *children: kmlutil.style_canonical(lxml_et.fromstring(
+            '<Style xmlns="http://www.opengis.net/kml/2.2" id="s">%s</Style>' % ''.join(children)), lambda url: None)
+
+        # the sub styles of a Style may come in any order, the ItemIcons of a ListStyle may not
+        list_style = '<ListStyle>%s</ListStyle>' % ''.join(icons)
+        self.assertEqual(canonical(line, list_style), canonical(list_style, line))
+        reversed_list_style = '<ListStyle>%s</ListStyle>' % ''.join(reversed(icons))
+        self.assertNotEqual(canonical(line, list_style), canonical(line, reversed_list_style))
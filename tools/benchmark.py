@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+"""
+time the major kmlutil operations on a synthetic document, see synthkml.py
+
+    tools/benchmark.py --folders 20 --placemarks 100 --points 500 --output before.json
+    tools/benchmark.py --folders 20 --placemarks 100 --points 500 --output after.json --compare before.json
+
+each operation runs in a fresh process so peak memory is measured per operation, the time reported for an operation
+is the time of its processing stage (see --profile), points/s is the number of coordinates in the document divided
+by that time
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+from cStringIO import StringIO
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+from attrdict import AttrDict
+import kmlutil
+import profiling
+import synthkml
+from util import nice_num
+
+# operation: (options, stages timed), {combine} is replaced by the path of the combine document
+operations = [
+    ('parse_kml', {}, ['parse_kml']),
+    ('stats', {'stats': True}, ['doc_stats']),
+    ('list_details', {'list': True, 'list_detail': True}, ['print_list']),
+    ('optimize_paths', {'optimize_paths': True}, ['optimize_paths']),
+    ('optimize_styles', {'optimize_styles': True}, ['optimize_styles']),
+    ('folderize', {'folderize': ['%Boundary ']}, ['folderize']),
+    ('region', {'region': 'Region'}, ['region']),
+    ('combine', {'combine': '{combine}'}, ['combine_kml']),
+    ('geojson', {'geojson': True}, ['export_geojson']),
+]
+operation_names = [name for name, _, _ in operations]
+
+
+def run_operation(name, kml_file, combine_file):
+    """
+    run one operation in this process and return its measurements, called in the worker process
+    """
+    _, overrides, stages = dict((op[0], op) for op in operations)[name]
+    devnull = open(os.devnull, 'w')
+    profile = StringIO()
+
+    options = AttrDict(dict(kmlutil.defaults))
+    options.kmlfile = kml_file
+    options.profile = True
+    options.profile_format = 'json'
+    options.out_kml = devnull
+    options.out_list = devnull
+    options.out_stats = devnull
+    options.out_nsmap = devnull
+    options.out_diag = profile
+    for option, value in overrides.items():
+        options[option] = combine_file if value == '{combine}' else value
+
+    result = {'operation': name, 'status': 'ok'}
+    wall = time.time()
+    try:
+        kmlutil.KMLProcessor(options).run()
+    except (Exception, SystemExit), e:
+        result['status'] = 'error'
+        result['message'] = '%s: %s' % (type(e).__name__, e)
+    result['total_wall'] = round(time.time() - wall, 6)
+    result['peak_rss_kb'] = profiling.peak_rss_kb()
+
+    report = profile.getvalue()
+    if result['status'] == 'ok':
+        records = json.loads(report[report.index('{'):])['stages']
+        timed = [record for record in records if record['stage'] in stages]
+        result['wall'] = round(sum(record['wall'] for record in timed), 6)
+        result['cpu'] = round(sum(record['cpu'] for record in timed), 6)
+    return result
+
+
+def run_worker(name, kml_file, combine_file, timeout):
+    """
+    run one operation in a new process, an operation that runs longer than timeout seconds is killed and reported
+    """
+    worker = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', name, kml_file, combine_file],
+                              stdout=subprocess.PIPE)
+    started = time.time()
+    while worker.poll() is None:
+        if time.time() - started > timeout:
+            worker.kill()
+            worker.wait()
+            return {'operation': name, 'status': 'timeout', 'message': 'killed after %s seconds' % nice_num(timeout)}
+        time.sleep(0.05)
+    output = worker.stdout.read()
+    if worker.returncode != 0:
+        return {'operation': name, 'status': 'error', 'message': 'worker exit status %d' % worker.returncode}
+    return json.loads(output)
+
+
+def benchmark(args, kml_file, combine_file, coordinates):
+    results = []
+    for name in args.operations:
+        best = None
+        for _ in range(args.repeat):
+            result = run_worker(name, kml_file, combine_file, args.timeout)
+            if best is None or (result['status'] == 'ok' and result.get('wall') < best.get('wall')):
+                best = result
+        if best['status'] == 'ok':
+            best['points_per_s'] = round(coordinates / best['wall'], 1) if best['wall'] > 0 else None
+        results.append(best)
+        print(format_result(best), file=sys.stderr)
+    return results
+
+
+def format_result(result, previous=None):
+    if result['status'] != 'ok':
+        return "{0:<16s} {1:s} {2:s}".format(result['operation'], result['status'].upper(), result.get('message', ''))
+    line = "{0:<16s} {1:>9.3f}s {2:>14s} pts/s {3:>8.1f}MB".format(
+        result['operation'], result['wall'], nice_num(result['points_per_s']),
+        (result['peak_rss_kb'] or 0) / 1024.0)
+    if previous is not None and previous.get('status') == 'ok' and previous.get('wall'):
+        line += "  {0:>6.2f}x".format(result['wall'] / previous['wall'])
+    return line
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    if len(argv) == 4 and argv[0] == '--worker':
+        print(json.dumps(run_operation(*argv[1:])))
+        return
+
+    parser = argparse.ArgumentParser(description="benchmark kmlutil operations on a synthetic kml document")
+    parser.add_argument("--folders", type=int, default=10, help="number of folders of features, default 10")
+    parser.add_argument("--placemarks", type=int, default=100, help="placemarks in each folder, default 100")
+    parser.add_argument("--points", type=int, default=200, help="points in each track, default 200")
+    parser.add_argument("--styles", type=int, default=20, help="number of shared styles, default 20")
+    parser.add_argument("--multi-ratio", type=float, default=0.1, help="fraction of MultiGeometry tracks, default 0.1")
+    parser.add_argument("--boundaries", type=int, default=4, help="number of boundary polygons, default 4")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, default 1")
+    parser.add_argument("--operations", default=','.join(operation_names),
+                        help="comma separated operations to run, default all: %s" % ','.join(operation_names))
+    parser.add_argument("--repeat", type=int, default=1, help="run each operation N times and keep the fastest")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before an operation is abandoned, default 600")
+    parser.add_argument("--output", default=None, metavar='FILE', help="save the results as JSON to FILE")
+    parser.add_argument("--compare", default=None, metavar='FILE', help="show the time relative to earlier results")
+    parser.add_argument("--keep", default=None, metavar='DIR', help="keep the generated documents in DIR")
+    args = parser.parse_args(argv)
+
+    args.operations = args.operations.split(',')
+    unknown = [name for name in args.operations if name not in operation_names]
+    if unknown:
+        parser.error("unknown operation(s): %s" % ', '.join(unknown))
+
+    work_dir = args.keep if args.keep else tempfile.mkdtemp(prefix='kmlbench')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        kml_file = os.path.join(work_dir, 'benchmark.kml')
+        combine_file = os.path.join(work_dir, 'combine.kml')
+        params = dict(folders=args.folders, placemarks=args.placemarks, points=args.points, styles=args.styles,
+                      multi_ratio=args.multi_ratio, boundaries=args.boundaries, seed=args.seed)
+        with open(kml_file, 'wb') as out_file:
+            document = synthkml.generate(out_file, **params)
+        with open(combine_file, 'wb') as out_file:
+            synthkml.generate(out_file, folders=max(args.folders // 4, 1), placemarks=args.placemarks,
+                              points=args.points, styles=args.styles, multi_ratio=args.multi_ratio,
+                              boundaries=args.boundaries, seed=args.seed + 1, name='combine')
+        document['bytes'] = os.path.getsize(kml_file)
+
+        print("document: {placemarks:d} placemarks, {coordinates:d} coordinates, {bytes:d} bytes".format(**document), file=sys.stderr)
+        results = benchmark(args, kml_file, combine_file, document['coordinates'])
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'parameters': params,
+        'document': document,
+        'results': results,
+    }
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = dict((result['operation'], result) for result in json.load(previous_file)['results'])
+        print("=== Compared to %s ===" % args.compare, file=sys.stderr)
+        for result in results:
+            print(format_result(result, previous.get(result['operation'])), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""
+report the time spent importing each module, like 'python -X importtime' which python 2 lacks
+
+    tools/importtime.py kmlutil
+    tools/importtime.py --cli="--help" --json
+
+modules are imported in the order given, --cli runs the kmlutil command line with the given arguments afterwards so
+the imports made by a whole run are included
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import __builtin__
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+original_import = __builtin__.__import__
+records = []  # (depth, module name, self seconds, cumulative seconds) in the order the imports finish
+stack = []    # time spent in nested imports of each import in progress
+
+
+def timed_import(name, *args, **kwargs):
+    before = len(sys.modules)
+    stack.append(0.0)
+    started = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        cumulative = time.time() - started
+        nested = stack.pop()
+        if len(sys.modules) != before:
+            records.append((len(stack), name, cumulative - nested, cumulative))
+            if len(stack):
+                stack[-1] += cumulative
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="report the time spent importing each module")
+    parser.add_argument("modules", nargs='*', help="modules to import")
+    parser.add_argument("--cli", action="store", default=None, metavar='ARGS',
+                        help="run the kmlutil command line with ARGS after importing the modules")
+    parser.add_argument("--json", action="store_true",
+                        help="output JSON with the imports and the modules loaded at the end")
+    args = parser.parse_args(argv)
+
+    preloaded = set(sys.modules)
+    __builtin__.__import__ = timed_import
+    try:
+        for module in args.modules:
+            __import__(module)
+        if args.cli is not None:
+            import imp
+            import shlex
+            # the script has no .py extension, don't leave a 'kmlutilc' behind
+            sys.dont_write_bytecode = True
+            cli = imp.load_source('kmlutil_cli', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kmlutil'))
+            sys.stdout = sys.stderr
+            try:
+                cli.main(shlex.split(args.cli))
+            except SystemExit:
+                pass
+            finally:
+                sys.stdout = sys.__stdout__
+    finally:
+        __builtin__.__import__ = original_import
+
+    loaded = sorted(name for name in set(sys.modules) - preloaded if sys.modules[name] is not None)
+    if args.json:
+        import json
+        print(json.dumps({
+            'imports': [{'depth': depth, 'module': name, 'self_us': int(own * 1e6), 'cumulative_us': int(total * 1e6)}
+                        for depth, name, own, total in records],
+            'loaded': loaded,
+        }, indent=2))
+    else:
+        print("import time: self [us] | cumulative | imported package", file=sys.stderr)
+        for depth, name, own, total in records:
+            print("import time: {0:>9d} | {1:>10d} | {2}{3}".format(int(own * 1e6), int(total * 1e6), '  ' * depth, name),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,22 +1,29 @@
 from __future__ import print_function
 import sys
+import importlib
 from cStringIO import StringIO
-import attrdict
-import json
 
-_verbose = 0
 
+class LazyModule(object):
+    """
+    stand-in for a module that is imported on first attribute access, used for modules that only some stages need
+    so that startup, --help and small runs don't pay for them
+    """
 
-def set_verbosity(n):
-    global _verbose
-    _verbose = n
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
 
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
 
-class AttrDictEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, attrdict.AttrDict):
-            return obj._mapping
-        return json.JSONEncoder.default(self, obj)
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module '%s'%s>" % (self._name, '' if self._module is None else ' (loaded)')
 
 
 class CapturingStdout(list):
@@ -91,7 +98,28 @@ def chain(el, attr_chain, cache=None):
     return it
 
 
-def xp(el, xpath):
-    if _verbose > 2:
-        pass # print('xpath={xpath} on {tag}[{el}]'.format(xpath=xpath, tag=el.tag.split('}')[-1], el=el.getroottree().getpath(el)), file=sys.stderr)
+_malloc_trim = []
+
+
+def release_memory():
+    """
+    return the memory the C library freed to the system, glibc keeps freed blocks in the middle of its heap until
+    malloc_trim() is called, does nothing where it isn't available
+    """
+    if not _malloc_trim:
+        try:
+            import ctypes
+            _malloc_trim.append(ctypes.CDLL(None).malloc_trim)
+        except (ImportError, OSError, AttributeError):
+            _malloc_trim.append(None)
+    if _malloc_trim[0] is not None:
+        _malloc_trim[0](0)
+
+
+def xp(el, xpath, trace_file=None):
+    """
+    evaluate xpath on el with the kml prefix and the prefixes of el, each evaluation is traced to trace_file if given
+    """
+    if trace_file is not None:
+        print('TRACE: xpath={xpath} on {tag}[{el}]'.format(xpath=xpath, tag=el.tag.split('}')[-1], el=el.getroottree().getpath(el)), file=trace_file)
     return el.xpath(xpath, namespaces=dict({'kml': 'http://www.opengis.net/kml/2.2'}, **{k: v for k, v in el.nsmap.items() if k is not None}))